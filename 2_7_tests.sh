@@ -9,3 +9,13 @@ python2.7 -m "nose" -v test_rendezvous_server.py
 python2.7 -m "nose" -v test_sock.py
 python2.7 -m "nose" -v test_unl.py
 python2.7 -m "nose" -v test_upnp.py
+python2.7 -m "nose" -v test_lease_manager.py
+python2.7 -m "nose" -v test_event_loop.py
+python2.7 -m "nose" -v test_dup_filter.py
+python2.7 -m "nose" -v test_scheduler.py
+python2.7 -m "nose" -v test_node_registry.py
+python2.7 -m "nose" -v test_rendezvous_log.py
+python2.7 -m "nose" -v test_rendezvous_cluster.py
+
+# asyncio tests use async / await (Python 3.5+.)
+python2.7 -c "import sys; sys.exit(sys.version_info < (3, 5))" && python2.7 -m "nose" -v test_aio.py
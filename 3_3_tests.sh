@@ -8,4 +8,14 @@ python3.3 -m "nose" -v test_rendezvous_client.py
 python3.3 -m "nose" -v test_rendezvous_server.py
 python3.3 -m "nose" -v test_sock.py
 python3.3 -m "nose" -v test_unl.py
-python3.3 -m "nose" -v test_upnp.py
\ No newline at end of file
+python3.3 -m "nose" -v test_upnp.py
+python3.3 -m "nose" -v test_lease_manager.py
+python3.3 -m "nose" -v test_event_loop.py
+python3.3 -m "nose" -v test_dup_filter.py
+python3.3 -m "nose" -v test_scheduler.py
+python3.3 -m "nose" -v test_node_registry.py
+python3.3 -m "nose" -v test_rendezvous_log.py
+python3.3 -m "nose" -v test_rendezvous_cluster.py
+
+# asyncio tests use async / await (Python 3.5+.)
+python3.3 -c "import sys; sys.exit(sys.version_info < (3, 5))" && python3.3 -m "nose" -v test_aio.py
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Local harness for bootstrapping: measures how long it takes to fill
+Net's outbound slots from a node list full of dead and slow nodes,
+connecting one at a time (add_node) vs concurrently
+(add_passive_nodes.)
+
+* Dead nodes are listeners with a full backlog so connects hang
+  until they time out (like a host dropping packets.)
+* Slow nodes start out the same way but drain their backlog after a
+  delay so connects complete on a SYN retransmit.
+* Live nodes accept straight away.
+
+Usage: python -m benchmarks.bench_bootstrap [dead] [slow] [live]
+"""
+
+import socket
+import sys
+import threading
+import time
+from pyp2p.net import Net
+
+
+def make_listener(backlog=5):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(backlog)
+    return listener
+
+
+def make_dead():
+    # Fill the backlog so new connects go unanswered.
+    listener = make_listener(0)
+    fill = []
+    for i in range(0, 5):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        s.connect_ex(listener.getsockname())
+        fill.append(s)
+
+    return listener, fill
+
+
+def make_slow(delay):
+    listener, fill = make_dead()
+
+    def drain():
+        time.sleep(delay)
+        listener.setblocking(0)
+        for s in fill:
+            s.close()
+        while 1:
+            try:
+                listener.accept()
+            except socket.error:
+                break
+
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return listener, fill
+
+
+def build(dead_no, slow_no, live_no):
+    sockets = []
+    addrs = []
+    for i in range(0, dead_no):
+        listener, fill = make_dead()
+        sockets += [listener] + fill
+        addrs.append(listener.getsockname())
+
+    for i in range(0, slow_no):
+        listener, fill = make_slow(0.5)
+        sockets += [listener] + fill
+        addrs.append(listener.getsockname())
+
+    for i in range(0, live_no):
+        listener = make_listener()
+        sockets.append(listener)
+        addrs.append(listener.getsockname())
+
+    return sockets, addrs
+
+
+def new_net(slots):
+    net = Net(max_outbound=slots, passive_port=0, wan_ip="8.8.4.4")
+    net.enable_duplicate_ip_cons = 1
+    return net
+
+
+def sequential(net, addrs, slots):
+    for ip, port in addrs:
+        if len(net.outbound) >= slots:
+            break
+
+        net.add_node(ip, port, "passive")
+
+
+def concurrent(net, addrs, slots):
+    net.add_passive_nodes(addrs, slots)
+
+
+def run(name, connect, dead_no, slow_no, live_no):
+    sockets, addrs = build(dead_no, slow_no, live_no)
+    slots = slow_no + live_no
+    net = new_net(slots)
+    time.sleep(0.1)
+    start = time.time()
+    connect(net, addrs, slots)
+    elapsed = time.time() - start
+    print("%-12s %6d / %-6d %10.2f" % (name, len(net.outbound), slots, elapsed))
+
+    for node in net.outbound:
+        node["con"].close()
+    for s in sockets:
+        s.close()
+
+
+if __name__ == "__main__":
+    counts = [4, 2, 4]
+    for i, arg in enumerate(sys.argv[1:4]):
+        counts[i] = int(arg)
+
+    print("dead = %d, slow = %d, live = %d" % tuple(counts))
+    print("%-12s %15s %10s" % ("mode", "slots filled", "time (s)"))
+    run("sequential", sequential, *counts)
+    run("concurrent", concurrent, *counts)
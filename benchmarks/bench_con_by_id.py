@@ -0,0 +1,101 @@
+"""
+Time per con_by_id lookup with 10, 100 and 1000 connections. The old
+version scanned every connection and derived its con ID (four SHA-256
+hashes) on each call. Now IDs are derived once, with the WAN IP
+fingerprint memoized, and looked up in Net.cons_by_id.
+
+Usage: python -m benchmarks.bench_con_by_id
+"""
+
+import hashlib
+import time
+from pyp2p.net import Net
+from pyp2p.sock import Sock
+from pyp2p.lib import is_ip_private, get_lan_ip
+
+
+class PeerSocket():
+    # Just enough of a socket for con ID derivation.
+    def __init__(self, ip):
+        self.ip = ip
+
+    def getpeername(self):
+        return (self.ip, 50500)
+
+    def close(self):
+        pass
+
+
+def legacy_generate_con_id(nonce, their_wan_ip, our_wan_ip):
+    their_wan_ip = hashlib.sha256(their_wan_ip.encode("ascii")).hexdigest().encode("ascii")
+    our_wan_ip = hashlib.sha256(our_wan_ip.encode("ascii")).hexdigest().encode("ascii")
+    if int(our_wan_ip, 16) > int(their_wan_ip, 16):
+        fingerprint = hashlib.sha256(our_wan_ip + their_wan_ip)
+    else:
+        fingerprint = hashlib.sha256(their_wan_ip + our_wan_ip)
+    fingerprint = fingerprint.hexdigest().encode("ascii")
+
+    return hashlib.sha256(nonce.encode("ascii") + fingerprint).hexdigest()
+
+
+def legacy_con_by_id(net, expected_id):
+    for node in net.outbound + net.inbound:
+        if node["con"].nonce is None:
+            continue
+
+        their_wan_ip, junk = node["con"].s.getpeername()
+        if is_ip_private(their_wan_ip):
+            our_wan_ip = get_lan_ip(net.interface)
+        else:
+            our_wan_ip = net.wan_ip
+        found_id = legacy_generate_con_id(
+            node["con"].nonce,
+            their_wan_ip,
+            our_wan_ip
+        )
+        if found_id == expected_id:
+            return node["con"]
+
+    return None
+
+
+def build_net(con_no):
+    net = Net(wan_ip="8.8.4.4", passive_port=0)
+    for i in range(0, con_no):
+        ip = "1.%d.%d.1" % (i // 256, i % 256)
+        con = Sock()
+        con.s.close()
+        con.s = PeerSocket(ip)
+        con.connected = 1
+        net.add_connection({
+            "con": con,
+            "type": "accept",
+            "ip": ip,
+            "port": 50500
+        }, net.inbound)
+        con.nonce = "%064x" % i
+
+    return net
+
+
+def time_lookups(con_by_id, net, ids):
+    start = time.time()
+    for con_id in ids:
+        assert(con_by_id(net, con_id) is not None)
+
+    return (time.time() - start) / len(ids)
+
+
+if __name__ == "__main__":
+    print("%-8s %14s %14s %10s" % ("cons", "legacy (us)", "new (us)", "speedup"))
+    for con_no in [10, 100, 1000]:
+        net = build_net(con_no)
+        ids = [node["con"].con_id for node in net.inbound]
+
+        # Last con is the worst case for a scan.
+        lookups = [ids[-1]] * 20 + ids[::max(1, con_no // 20)]
+        legacy = time_lookups(legacy_con_by_id, net, lookups)
+        new = time_lookups(Net.con_by_id, net, lookups * 100)
+        print("%-8d %14.2f %14.2f %9.0fx" % (
+            con_no, legacy * 1e6, new * 1e6, legacy / max(new, 1e-12)
+        ))
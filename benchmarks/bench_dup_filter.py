@@ -0,0 +1,53 @@
+"""
+Memory used by each duplicate filter after a million unique messages
+(measured with tracemalloc) along with the time taken (including
+tracemalloc overhead) and the false positive rate for messages that
+were never seen.
+
+Usage: python -m benchmarks.bench_dup_filter [message count]
+"""
+
+import sys
+import time
+import tracemalloc
+from pyp2p.dup_filter import SeenCache, RotatingBloomFilter
+
+
+def run(name, build, msg_no):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    dup_filter = build()
+    start = time.time()
+    for i in range(0, msg_no):
+        dup_filter.check(u"msg %d" % i, record_seen=1)
+    elapsed = time.time() - start
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    # Never seen messages that are reported as duplicates.
+    sample = 100000
+    false_positives = 0
+    for i in range(msg_no, msg_no + sample):
+        false_positives += dup_filter.check(u"msg %d" % i)
+
+    print("%-28s %10.1f %10.2f %10.5f" % (
+        name,
+        used / (1024.0 * 1024) * (1000000.0 / msg_no),
+        elapsed,
+        false_positives / float(sample)
+    ))
+
+
+if __name__ == "__main__":
+    msg_no = 1000000
+    if len(sys.argv) > 1:
+        msg_no = int(sys.argv[1])
+
+    print("%-28s %10s %10s %10s" % ("filter", "MB / 1M", "time (s)", "fp rate"))
+    run("SeenCache", lambda: SeenCache(max_size=msg_no), msg_no)
+    for error_rate in [0.01, 0.001, 0.0001]:
+        run(
+            "RotatingBloomFilter p=%s" % error_rate,
+            lambda: RotatingBloomFilter(msg_no, error_rate),
+            msg_no
+        )
@@ -0,0 +1,76 @@
+"""
+Compares the old character by character parse_buf with the
+incremental delimiter scan in Sock. Data arrives in 4 KB chunks
+(the default Sock.chunk_size) and the buffer is parsed after
+every chunk, like Sock.update() does.
+
+Usage: python -m benchmarks.bench_parse_buf
+"""
+
+import time
+from pyp2p.sock import Sock
+
+
+def legacy_parse_buf(sock):
+    buf_len = len(sock.buf)
+    replies = []
+    reply = u""
+    chop = 0
+    skip = 0
+    i = 0
+    for ch in sock.buf:
+        if skip:
+            skip -= 1
+            i += 1
+            continue
+
+        nxt = i + 1
+        if nxt < buf_len:
+            if ch == u"\r" and sock.buf[nxt] == u"\n":
+                if reply != u"":
+                    replies.append(reply)
+                    reply = u""
+
+                chop = nxt + 1
+                skip = 1
+                i += 1
+                continue
+
+        reply += ch
+        i += 1
+
+    if chop:
+        sock.buf = sock.buf[chop:]
+
+    return replies
+
+
+def run(parse, buf_size, chunk_size=4096):
+    # One line that fills the whole buffer.
+    data = u"x" * (buf_size - 2) + u"\r\n"
+    sock = Sock()
+    replies = []
+    start = time.time()
+    for i in range(0, len(data), chunk_size):
+        sock.buf += data[i:i + chunk_size]
+        replies += parse(sock)
+    elapsed = time.time() - start
+    sock.close()
+    assert(replies == [data[:-2]])
+
+    return elapsed
+
+
+if __name__ == "__main__":
+    sizes = [
+        ("1 KB", 1024),
+        ("64 KB", 64 * 1024),
+        ("1 MB", 1024 * 1024)
+    ]
+    print("%-8s %12s %12s %10s" % ("size", "legacy (s)", "new (s)", "speedup"))
+    for name, size in sizes:
+        legacy = run(legacy_parse_buf, size)
+        new = run(Sock.parse_buf, size)
+        print("%-8s %12.6f %12.6f %9.0fx" % (
+            name, legacy, new, legacy / max(new, 1e-9)
+        ))
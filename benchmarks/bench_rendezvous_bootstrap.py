@@ -0,0 +1,100 @@
+"""
+Load benchmark for the rendezvous server's BOOTSTRAP command with
+100 to 1,000,000 registered passive nodes. The old handler copied
+every registered IP into a list and removed each chosen IP from it
+(O(n) per request.) Now nodes live in a NodeRegistry and a request
+samples n random positions, so BOOTSTRAP 100 costs the same however
+many nodes are registered.
+
+"legacy" and "sample" time just the node selection, "BOOTSTRAP" is
+the whole line through RendezvousProtocol.lineReceived.
+
+Usage: python -m benchmarks.bench_rendezvous_bootstrap [nodes ...]
+"""
+
+import random
+import sys
+import time
+from pyp2p.rendezvous_server import RendezvousFactory
+from twisted.internet.address import IPv4Address
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+
+def legacy_bootstrap(nodes, n, our_ip):
+    # Selection loop from the old BOOTSTRAP handler.
+    chosen = []
+    ip_addr_list = list(nodes)
+    for i in range(0, n):
+        if not len(ip_addr_list):
+            break
+
+        rand_index = random.randrange(0, len(ip_addr_list))
+        ip_addr = ip_addr_list[rand_index]
+        if our_ip == ip_addr:
+            ip_addr_list.remove(ip_addr)
+            continue
+
+        chosen.append(ip_addr)
+        ip_addr_list.remove(ip_addr)
+
+    return chosen
+
+
+def build(node_no):
+    factory = RendezvousFactory()
+    legacy = {}
+
+    # Every node shares one details dict to keep memory down.
+    node = {"port": "50500", "time": time.time(), "max_inbound": "10"}
+    for i in range(0, node_no):
+        ip = "%d.%d.%d.%d" % (
+            1 + i // 16777216, (i // 65536) % 256, (i // 256) % 256, i % 256
+        )
+        factory.nodes["passive"][ip] = node
+        legacy[ip] = node
+
+    return factory, legacy
+
+
+def time_calls(call, reps):
+    start = time.time()
+    for i in range(0, reps):
+        call()
+
+    return (time.time() - start) / reps
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 10000, 100000, 1000000]
+    print("BOOTSTRAP 100, time per request")
+    print("%-10s %14s %14s %16s" % (
+        "nodes", "legacy (ms)", "sample (ms)", "BOOTSTRAP (ms)"
+    ))
+    for node_no in sizes:
+        factory, legacy = build(node_no)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(
+            StringTransport(peerAddress=IPv4Address("TCP", "8.8.8.8", 40000))
+        )
+
+        def legacy_call():
+            legacy_bootstrap(legacy, 100, "8.8.8.8")
+
+        def sample_call():
+            factory.nodes["passive"].sample(100)
+
+        def bootstrap_call():
+            protocol.lineReceived(b"BOOTSTRAP 100")
+            protocol.transport.clear()
+
+        legacy_reps = max(3, min(1000, 10000000 // max(node_no, 1) // 100))
+        print("%-10d %14.3f %14.3f %16.3f" % (
+            node_no,
+            time_calls(legacy_call, legacy_reps) * 1000,
+            time_calls(sample_call, 1000) * 1000,
+            time_calls(bootstrap_call, 1000) * 1000
+        ))
@@ -0,0 +1,106 @@
+"""
+Connection churn through a rendezvous cluster with 1 to N worker
+processes. Load processes open connections from different loopback
+source IPs, send BOOTSTRAP 10, wait for the reply and close, as fast
+as they can; the result is completed connections per second.
+
+Run it on the hardware being sized: load processes share the same
+cores as the workers, so leave some cores for them.
+
+Usage: python -m benchmarks.bench_rendezvous_cluster [workers ...]
+"""
+
+import multiprocessing
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+from pyp2p.rendezvous_cluster import start_workers
+
+duration = 5
+load_no = max(2, multiprocessing.cpu_count())
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def connect(port, source_ip):
+    con = socket.create_connection(("127.0.0.1", port), 5, (source_ip, 0))
+
+    # Reset on close so churn doesn't run out of ports in TIME_WAIT.
+    con.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    return con
+
+
+def load(port, load_id, deadline, results):
+    done = 0
+    i = 0
+    while time.time() < deadline:
+        i += 1
+        source_ip = "127.%d.%d.%d" % (1 + load_id, (i // 250) % 250, 1 + i % 250)
+        try:
+            con = connect(port, source_ip)
+            con.sendall(b"BOOTSTRAP 10\r\n")
+            if con.recv(4096):
+                done += 1
+            con.close()
+        except socket.error:
+            pass
+    results.put(done)
+
+
+def run(worker_no):
+    port = free_port()
+    ipc_dir = tempfile.mkdtemp()
+    workers = start_workers(worker_no, port, ipc_dir, "127.0.0.1")
+    try:
+        # Wait for the workers to listen.
+        for i in range(0, 100):
+            try:
+                connect(port, "127.0.0.1").close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+        # Passive nodes to bootstrap from.
+        for i in range(0, 500):
+            con = connect(port, "127.200.%d.%d" % (i // 250, 1 + i % 250))
+            con.sendall(b"PASSIVE READY 50500 10\r\n")
+            con.close()
+        time.sleep(0.5)
+
+        results = multiprocessing.Queue()
+        deadline = time.time() + duration
+        loads = [
+            multiprocessing.Process(target=load, args=(port, i, deadline, results))
+            for i in range(0, load_no)
+        ]
+        for process in loads:
+            process.start()
+        done = sum([results.get() for process in loads])
+        for process in loads:
+            process.join()
+
+        return done / float(duration)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or sorted(set([1, 2, multiprocessing.cpu_count()]))
+    print("%d cores, %d load processes, %d s per run" % (
+        multiprocessing.cpu_count(), load_no, duration
+    ))
+    print("%-8s %16s" % ("workers", "connections/s"))
+    for worker_no in sizes:
+        print("%-8d %16d" % (worker_no, run(worker_no)))
@@ -0,0 +1,127 @@
+"""
+Lines per second through RendezvousProtocol.lineReceived for each
+command type, for sizing rendezvous hardware.
+
+The old lineReceived matched every line against all six command
+patterns in turn (even after one had handled it) and the BOOTSTRAP,
+CANDIDATE and ACCEPT branches ran re.findall with patterns compiled
+on the fly. "legacy" replays those regex calls before running the
+same handler; "dispatch" is the current lineReceived, which looks up
+the first token and runs one precompiled validator and handler.
+
+Usage: python -m benchmarks.bench_rendezvous_dispatch [lines per command]
+"""
+
+import re
+import sys
+import time
+from pyp2p.rendezvous_server import RendezvousFactory, RendezvousProtocol
+from twisted.internet.address import IPv4Address
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+
+# Patterns from the old lineReceived cascade: (match, findall.)
+legacy_patterns = [
+    ("^BOOTSTRAP", "^BOOTSTRAP ([0-9]+)"),
+    (
+        "^(SIMULTANEOUS|PASSIVE) READY [0-9]+ [0-9]+$",
+        "^(SIMULTANEOUS|PASSIVE) READY ([0-9]+) ([0-9]+)"
+    ),
+    ("^SOURCE TCP", None),
+    (
+        "^CANDIDATE",
+        r"^CANDIDATE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) (TCP|UDP) ((?:[0-9]+\s?)+)$"
+    ),
+    (
+        "^ACCEPT",
+        r"^ACCEPT ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP) ([0-9]+(?:[.][0-9]+)?)$"
+    ),
+    ("^CLEAR", None)
+]
+
+
+class LegacyProtocol(RendezvousProtocol):
+    def lineReceived(self, line):
+        line = line.decode("utf-8")
+        for match_pattern, findall_pattern in legacy_patterns:
+            if re.match(match_pattern, line) is None:
+                continue
+            if findall_pattern is not None:
+                if not len(re.findall(findall_pattern, line)):
+                    continue
+
+            # Same handler as the dispatcher.
+            validator, handler = self.commands[line.split(" ", 1)[0]]
+            handler(self, validator.match(line))
+
+    def is_valid_port(self, port):
+        port = re.findall("^[0-9]+$", str(port))
+        if len(port):
+            port = int(port[0])
+            if 0 < port <= 65535:
+                return 1
+        return 0
+
+
+def connect(factory, protocol_class, ip, port=40000):
+    protocol = protocol_class(factory)
+    transport = StringTransport(peerAddress=IPv4Address("TCP", ip, port))
+    protocol.makeConnection(transport)
+    return protocol, transport
+
+
+def lines_per_second(protocol_class, line, sender, reps):
+    factory = RendezvousFactory()
+
+    # Passive nodes to bootstrap from.
+    for i in range(0, 1000):
+        factory.nodes["passive"]["1.1.%d.%d" % (i // 256, i % 256)] = {
+            "port": "50500", "time": time.time(), "max_inbound": "10"
+        }
+
+    # Simultaneous node with a candidate for CANDIDATE/ACCEPT.
+    sim, sim_transport = connect(factory, protocol_class, "2.2.2.2")
+    sim.lineReceived(b"SIMULTANEOUS READY 0 0")
+    client, client_transport = connect(factory, protocol_class, "3.3.3.3")
+    client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 5001")
+    other, other_transport = connect(factory, protocol_class, "4.4.4.4")
+
+    protocol, transport = {
+        "client": (client, client_transport),
+        "sim": (sim, sim_transport),
+        "other": (other, other_transport)
+    }[sender]
+    start = time.time()
+    for i in range(0, reps):
+        protocol.lineReceived(line)
+        if not i % 100:
+            sim_transport.clear()
+            client_transport.clear()
+            other_transport.clear()
+
+    return reps / (time.time() - start)
+
+
+if __name__ == "__main__":
+    reps = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    ntp = str(time.time()).encode("ascii")
+    lines = [
+        (b"BOOTSTRAP 10", "other"),
+        (b"PASSIVE READY 50500 10", "other"),
+        (b"SOURCE TCP", "other"),
+        (b"CANDIDATE 2.2.2.2 TCP 5000 5001", "client"),
+        (b"ACCEPT 3.3.3.3 6000 6001 TCP " + ntp, "sim"),
+        (b"CLEAR", "other"),
+        (b"JUNK", "other")
+    ]
+    print("%-12s %14s %14s %8s" % ("command", "legacy (l/s)", "dispatch (l/s)", "speedup"))
+    for line, sender in lines:
+        legacy = lines_per_second(LegacyProtocol, line, sender, reps)
+        dispatch = lines_per_second(RendezvousProtocol, line, sender, reps)
+        print("%-12s %14d %14d %7.2fx" % (
+            line.split(b" ")[0].decode("ascii"), legacy, dispatch, dispatch / legacy
+        ))
@@ -0,0 +1,125 @@
+"""
+Line handling latency of the rendezvous server with 500,000
+registered nodes. Clients connect, send BOOTSTRAP 10 and disconnect
+at a fixed rate on a simulated clock; each one's latency is the time
+from when it arrived to when the server was done with it (queueing
+behind earlier work included), using the measured CPU time of every
+step.
+
+The old server swept every node and candidate list from inside
+connectionLost every 5 minutes, so whoever disconnected at that
+moment (and everyone queued behind them) waited for the whole sweep.
+Now every node has its own deadline in a heap and a single
+reactor.callLater evicts nodes as they expire.
+
+Usage: python -m benchmarks.bench_rendezvous_expiry [nodes] [lines/s] [seconds]
+"""
+
+import random
+import sys
+import time
+from pyp2p.rendezvous_server import RendezvousFactory
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+
+# Old connectionLost cleanup interval.
+cleanup = 5 * 60
+
+
+def legacy_sweep(factory, t):
+    # Cleanup from the old connectionLost.
+    for node_type in ["passive", "simultaneous"]:
+        old_node_ips = []
+        for node_ip in list(factory.nodes[node_type]):
+            if t - factory.nodes[node_type][node_ip]["time"] >= factory.node_lifetime:
+                old_node_ips.append(node_ip)
+        for node_ip in old_node_ips:
+            del factory.nodes[node_type][node_ip]
+
+    old_node_ips = []
+    for node_ip in list(factory.candidates):
+        old_candidates = []
+        for candidate in factory.candidates[node_ip]:
+            if not node_ip in factory.nodes["simultaneous"] and t - candidate["time"] >= factory.challege_timeout * 5:
+                old_candidates.append(candidate)
+        for candidate in old_candidates:
+            factory.candidates[node_ip].remove(candidate)
+        if not len(factory.candidates[node_ip]) and not node_ip in factory.nodes["simultaneous"]:
+            old_node_ips.append(node_ip)
+    for node_ip in old_node_ips:
+        del factory.candidates[node_ip]
+
+
+def build(node_no, use_heap):
+    clock = Clock()
+    clock.advance(time.time())
+    factory = RendezvousFactory(reactor=clock)
+    now = clock.seconds()
+
+    # Registered over the last node life time so some expire
+    # while the benchmark runs.
+    for i in range(0, node_no):
+        ip = "%d.%d.%d.%d" % (
+            1 + i // 16777216, (i // 65536) % 256, (i // 256) % 256, i % 256
+        )
+        age = random.uniform(0, factory.node_lifetime)
+        factory.nodes["passive"][ip] = {
+            "port": "50500", "time": now - age, "max_inbound": "10"
+        }
+        if use_heap:
+            factory.expire_later(
+                ("passive", ip), factory.node_lifetime - age,
+                lambda ip=ip: factory.nodes["passive"].__delitem__(ip)
+            )
+
+    return clock, factory
+
+
+def run(node_no, rate, duration, use_heap):
+    clock, factory = build(node_no, use_heap)
+    start = clock.seconds()
+    last_cleanup = start
+    busy_until = start
+    latencies = []
+    for i in range(0, int(rate * duration)):
+        arrival = start + i / float(rate)
+        now = max(arrival, busy_until)
+
+        # Timers due by now run first (they're reactor work too.)
+        cpu = time.time()
+        if use_heap:
+            clock.advance(now - clock.seconds())
+
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(
+            StringTransport(peerAddress=IPv4Address("TCP", "8.8.8.8", 40000))
+        )
+        protocol.lineReceived(b"BOOTSTRAP 10")
+        protocol.connectionLost(None)
+        if not use_heap and now - last_cleanup >= cleanup:
+            last_cleanup = now
+            legacy_sweep(factory, now)
+        busy_until = now + (time.time() - cpu)
+
+        latencies.append(busy_until - arrival)
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return percentile(0.5), percentile(0.99), percentile(0.999), latencies[-1] * 1000
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    node_no, rate, duration = args + [500000, 1000, 600][len(args):]
+    print("%d nodes, %d lines/s for %d simulated seconds" % (node_no, rate, duration))
+    print("%-8s %10s %10s %10s %10s" % ("expiry", "p50 (ms)", "p99 (ms)", "p99.9 (ms)", "max (ms)"))
+    for name, use_heap in [("sweep", 0), ("heap", 1)]:
+        print("%-8s %10.3f %10.3f %10.3f %10.3f" % ((name,) + run(node_no, rate, duration, use_heap)))
@@ -0,0 +1,127 @@
+"""
+Connection flood throughput of the rendezvous server with different
+logging setups. Each connection opens, sends BOOTSTRAP 10 and SOURCE
+TCP and closes, so a fully logged connection is 6 entries.
+
+"legacy" is the old debug = 1 logging: a log_entry formatted with
+time.strftime and two transport.getPeer() calls per entry and printed
+to stdout (redirected to a file here) from the reactor thread. The
+others use the ServerLog with a BufferedSink writing to the same kind
+of file.
+
+Usage: python -m benchmarks.bench_rendezvous_log [connections]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import pyp2p.rendezvous_server
+from pyp2p.rendezvous_server import RendezvousFactory, RendezvousProtocol
+from pyp2p.rendezvous_log import *
+from twisted.internet.address import IPv4Address
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+
+class LegacyLog():
+    # Old log_entry + print for every entry.
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def log_entry(self, msg, direction="none"):
+        if sys.version_info >= (3,0,0):
+            if type(msg) == bytes:
+                msg = msg.decode("utf-8")
+        ip_addr = str(self.protocol.transport.getPeer().host)
+        port = str(self.protocol.transport.getPeer().port)
+        when = time.strftime("%H:%M:%S %Y-%m-%d")
+        who = """%s:%s""" % (ip_addr, port)
+        if direction == "send":
+            direction = " -> "
+        elif direction == "recv":
+            direction = " <- "
+        else:
+            direction = " "
+
+        return """[%s] %s%s%s""" % (when, msg, direction, who)
+
+    def debug(self, msg, peer=None, direction="none"):
+        print(self.log_entry(msg, direction))
+
+    error = debug
+
+
+class LegacyProtocol(RendezvousProtocol):
+    # Swaps the module log for the legacy printer around each call.
+    def call(self, method, *args):
+        log = pyp2p.rendezvous_server.log
+        pyp2p.rendezvous_server.log = LegacyLog(self)
+        try:
+            return method(self, *args)
+        finally:
+            pyp2p.rendezvous_server.log = log
+
+    def connectionMade(self):
+        return self.call(RendezvousProtocol.connectionMade)
+
+    def connectionLost(self, reason):
+        return self.call(RendezvousProtocol.connectionLost, reason)
+
+    def lineReceived(self, line):
+        return self.call(RendezvousProtocol.lineReceived, line)
+
+
+def connections_per_second(protocol_class, log, connection_no):
+    pyp2p.rendezvous_server.log = log
+    factory = RendezvousFactory()
+    for i in range(0, 1000):
+        factory.nodes["passive"]["1.1.%d.%d" % (i // 256, i % 256)] = {
+            "port": "50500", "time": time.time(), "max_inbound": "10"
+        }
+
+    start = time.time()
+    for i in range(0, connection_no):
+        protocol = protocol_class(factory)
+        protocol.makeConnection(StringTransport(
+            peerAddress=IPv4Address("TCP", "8.8.8.8", 1024 + i % 60000)
+        ))
+        protocol.lineReceived(b"BOOTSTRAP 10")
+        protocol.lineReceived(b"SOURCE TCP")
+        protocol.connectionLost(None)
+    elapsed = time.time() - start
+
+    # Time to drain what the reactor queued (off the reactor thread.)
+    log.close()
+    return connection_no / elapsed
+
+
+if __name__ == "__main__":
+    connection_no = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    stdout = sys.stdout
+    setups = [
+        ("legacy", LegacyProtocol, DEBUG, 1),
+        ("DEBUG", RendezvousProtocol, DEBUG, 1),
+        ("DEBUG 1%", RendezvousProtocol, DEBUG, 0.01),
+        ("INFO", RendezvousProtocol, INFO, 1)
+    ]
+    results = []
+    try:
+        for name, protocol_class, level, sample_rate in setups:
+            with open(path, "w") as out:
+                sys.stdout = out
+                log = ServerLog(level, BufferedSink(path), sample_rate)
+                results.append((name, connections_per_second(protocol_class, log, connection_no)))
+                sys.stdout = stdout
+    finally:
+        sys.stdout = stdout
+        os.remove(path)
+
+    print("%-10s %16s" % ("logging", "connections/s"))
+    for name, rate in results:
+        print("%-10s %16d" % (name, rate))
@@ -0,0 +1,703 @@
+"""
+asyncio versions of Sock, Net and UNL.connect. Requires Python 3.5+.
+
+The blocking API spawns a thread for every UNL.connect() and has
+get_connection() sleep in a loop for up to a minute waiting for
+the other side to connect. Here, connections are asyncio protocols
+and anything waiting for an inbound connection waits on a future
+that's resolved as soon as the matching connection (or nonce)
+arrives, so thousands of pending connections cost no threads.
+
+Node detection (NAT type, port forwarding) and TCP hole punching
+are still done by the blocking code in a thread pool executor since
+they only happen once or rely on precise sleeps.
+
+Example:
+    async def main():
+        net = AsyncNet(net_type="p2p")
+        await net.start()
+        await net.bootstrap()
+        await net.advertise()
+        for con in net:
+            con.send_line("Hello.")
+            reply = await con.recv_line()
+"""
+
+import asyncio
+import re
+
+from .lib import *
+from .sock import Sock, split_lines
+from .net import Net, rendezvous_interval, advertise_interval, interval_jitter
+from .unl import UNL
+
+
+class AsyncSock(asyncio.Protocol):
+    """
+    Line delimited connection. Replies are queued and returned by
+    recv_line() / async iteration unless the Net has reply handlers.
+    In direct nets the first 64 bytes received are the nonce.
+    """
+
+    def __init__(self, net=None, direction="outbound", nonce=None):
+        self.net = net
+        self.direction = direction
+        self.transport = None
+        self.buf = bytearray()
+        self.buf_scanned = 0
+        self.max_buf = 1024 * 1024 # 1 MB.
+        self.delimiter = b"\r\n"
+        self.replies = asyncio.Queue()
+        self.connected = 0
+        self.ip = None
+        self.port = None
+        self.unl = None
+        self.nonce = nonce
+        self.nonce_buf = b""
+        self.con_id = None
+        self.alive = time.time()
+        self.closed = asyncio.Event()
+
+        # Flow control from the transport.
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = 1
+        peer = transport.get_extra_info("peername")
+        if peer is not None:
+            self.ip, self.port = peer[0], peer[1]
+
+        if self.net is not None:
+            self.net.add_connection(self)
+
+    def connection_lost(self, exc):
+        self.connected = 0
+        self.can_write.set()
+        self.closed.set()
+        if self.net is not None:
+            self.net.remove_connection(self)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def expects_nonce(self):
+        if self.net is None or self.nonce is not None:
+            return 0
+
+        return self.net.net.net_type == "direct"
+
+    def data_received(self, data):
+        self.alive = time.time()
+
+        # Nonce comes before any lines.
+        if self.expects_nonce():
+            remaining = 64 - len(self.nonce_buf)
+            self.nonce_buf += data[:remaining]
+            data = data[remaining:]
+            if len(self.nonce_buf) < 64:
+                return
+
+            self.nonce = self.nonce_buf.decode("latin-1")
+            self.net.nonce_received(self)
+
+        self.buf += data
+        replies, self.buf, self.buf_scanned = split_lines(
+            self.buf, self.buf_scanned, self.delimiter
+        )
+
+        # Don't let a peer fill memory with one huge line.
+        if len(self.buf) >= self.max_buf:
+            self.close()
+            return
+
+        for reply in replies:
+            try:
+                reply = reply.decode("utf-8")
+            except UnicodeDecodeError:
+                continue
+
+            if self.net is not None:
+                self.net.reply_received(self, reply)
+            else:
+                self.replies.put_nowait(reply)
+
+    def send(self, msg):
+        if not self.connected:
+            return 0
+
+        if type(msg) == str:
+            msg = msg.encode("ascii")
+        self.transport.write(msg)
+
+        return len(msg)
+
+    def send_line(self, msg):
+        if type(msg) == str:
+            msg = msg.encode("ascii")
+
+        return self.send(msg + self.delimiter)
+
+    async def drain(self):
+        # Wait until the transport's write buffer is below its limit.
+        await self.can_write.wait()
+
+    async def recv_line(self, timeout=5):
+        try:
+            return await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return u""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.connected and self.replies.empty():
+            raise StopAsyncIteration
+
+        # Wake up for replies or for the connection closing.
+        get_reply = asyncio.ensure_future(self.replies.get())
+        closed = asyncio.ensure_future(self.closed.wait())
+        done, pending = await asyncio.wait(
+            [get_reply, closed], return_when=asyncio.FIRST_COMPLETED
+        )
+        for future in pending:
+            future.cancel()
+
+        if get_reply in done:
+            return get_reply.result()
+
+        raise StopAsyncIteration
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.connected = 0
+
+
+class AsyncNet():
+    """
+    Async counterpart to Net. Takes the same keyword arguments as
+    Net and uses a Net object for configuration and node detection.
+    """
+
+    def __init__(self, **kwargs):
+        self.net = Net(**kwargs)
+        self.inbound = []
+        self.outbound = []
+        self.server = None
+        self.unl = None
+
+        # Called with (con, reply.) Replies are queued on the
+        # con instead if there are no handlers.
+        self.reply_handlers = set()
+
+        # Futures for pending direct connections by con ID or IP.
+        self.waiters = {}
+
+        # Only one TCP hole punch can happen at a time.
+        self.sim_open_lock = None
+
+    def debug_print(self, msg):
+        self.net.debug_print(msg)
+
+    def add_reply_handler(self, handler):
+        self.reply_handlers.add(handler)
+
+    def add_connection(self, con):
+        if con.direction == "inbound":
+            self.inbound.append(con)
+        else:
+            self.outbound.append(con)
+
+        # Cons that don't need a nonce can be matched by IP now.
+        if not con.expects_nonce():
+            self.resolve_waiters(con.ip, con)
+
+    def remove_connection(self, con):
+        for cons in [self.inbound, self.outbound]:
+            if con in cons:
+                cons.remove(con)
+
+    def reply_received(self, con, reply):
+        # Drop duplicate messages.
+        if not self.net.filter_msg_check(reply):
+            return
+
+        if len(self.reply_handlers):
+            for handler in list(self.reply_handlers):
+                handler(con, reply)
+        else:
+            con.replies.put_nowait(reply)
+
+    def our_wan_ip(self, their_ip):
+        if is_ip_private(their_ip):
+            return get_lan_ip(self.net.interface)
+
+        return self.net.wan_ip
+
+    def nonce_received(self, con):
+        con.con_id = self.net.generate_con_id(
+            con.nonce, con.ip, self.our_wan_ip(con.ip)
+        )
+        self.resolve_waiters(con.con_id, con)
+        self.resolve_waiters(con.ip, con)
+
+    def resolve_waiters(self, key, con):
+        for future in self.waiters.pop(key, []):
+            if not future.done():
+                future.set_result(con)
+
+    def con_by_ip(self, ip):
+        for con in self.outbound + self.inbound:
+            # Direct cons can't be used until the nonce arrives.
+            if con.expects_nonce():
+                continue
+
+            if con.ip == ip and con.connected:
+                return con
+
+        return None
+
+    def con_by_id(self, con_id):
+        for con in self.outbound + self.inbound:
+            if con.con_id == con_id and con.connected:
+                return con
+
+        return None
+
+    async def wait_for_con(self, key, timeout=60, by_id=0):
+        """
+        Returns a con with the given con ID (by_id) or IP as soon as
+        it's connected or None after timeout seconds.
+        """
+        if by_id:
+            con = self.con_by_id(key)
+        else:
+            con = self.con_by_ip(key)
+        if con is not None:
+            return con
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if key in self.waiters and future in self.waiters[key]:
+                self.waiters[key].remove(future)
+                if not len(self.waiters[key]):
+                    del self.waiters[key]
+
+    async def start_server(self):
+        # Serve inbound cons on Net's bound passive socket.
+        loop = asyncio.get_event_loop()
+        if self.net.passive is None:
+            self.net.start_passive_server()
+        self.server = await loop.create_server(
+            lambda: AsyncSock(self, "inbound"), sock=self.net.passive
+        )
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.net.start)
+        await self.start_server()
+        self.unl = AsyncUNL(self)
+
+        return self
+
+    async def stop(self):
+        loop = asyncio.get_event_loop()
+        if self.net.last_advertise is not None:
+            try:
+                await loop.run_in_executor(None, self.net.rendezvous.leave_fight)
+            except Exception as e:
+                error = parse_exception(e)
+                log_exception(self.net.error_log_path, error)
+
+        for con in self.inbound + self.outbound:
+            con.close()
+
+        # The server owns Net's passive socket.
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.net.passive = None
+
+    async def adopt(self, con, direction):
+        # Turn a connected blocking Sock into an AsyncSock.
+        loop = asyncio.get_event_loop()
+        sock = con.s
+        con.s = None
+        con.connected = 0
+        sock.setblocking(0)
+        transport, async_con = await loop.connect_accepted_socket(
+            lambda: AsyncSock(self, direction), sock=sock
+        )
+
+        return async_con
+
+    async def rendezvous_request(self, msg, expect_reply=0, timeout=2):
+        """
+        Sends one line to the first rendezvous server that
+        answers and returns its reply (if expected.)
+        """
+        for server in self.net.rendezvous.rendezvous_servers:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(server["addr"], server["port"]),
+                    timeout
+                )
+            except Exception:
+                continue
+
+            try:
+                writer.write(msg.encode("ascii") + b"\r\n")
+                reply = u""
+                if expect_reply:
+                    reply = await asyncio.wait_for(reader.readline(), timeout)
+                    reply = reply.decode("utf-8").rstrip(u"\r\n")
+                return reply
+            finally:
+                writer.close()
+
+        raise Exception("All rendezvous servers are down.")
+
+    async def add_node(self, node_ip, node_port, node_type, timeout=5):
+        node_port = int(node_port)
+        self.debug_print("Attempting to connect to %s:%s:%s" % (
+            node_ip, str(node_port), node_type
+        ))
+
+        # Already connected to them.
+        if not self.net.enable_duplicate_ip_cons:
+            for con in self.outbound + self.inbound:
+                if con.ip == node_ip:
+                    return con
+
+        # Avoid connecting to ourself.
+        if not self.net.validate_node(node_ip, node_port, same_nodes=0):
+            return None
+
+        loop = asyncio.get_event_loop()
+        if node_type == "simultaneous" and self.net.enable_simultaneous:
+            if not self.net.is_net_started:
+                raise Exception("Make sure to start net before you add node.")
+
+            if self.net.nat_type not in self.net.rendezvous.predictable_nats:
+                return None
+
+            # Hole punching relies on timing so it's done in a thread.
+            if self.sim_open_lock is None:
+                self.sim_open_lock = asyncio.Lock()
+            async with self.sim_open_lock:
+                rendezvous = self.net.rendezvous
+                old_timeout = rendezvous.timeout
+                rendezvous.timeout = timeout
+                try:
+                    con = await loop.run_in_executor(
+                        None, rendezvous.simultaneous_challenge,
+                        node_ip, node_port, "TCP"
+                    )
+                except Exception as e:
+                    error = parse_exception(e)
+                    log_exception(self.net.error_log_path, error)
+                    return None
+                finally:
+                    rendezvous.timeout = old_timeout
+                    rendezvous.simultaneous_cons = []
+
+            if con is None:
+                return None
+
+            return await self.adopt(con, "outbound")
+
+        if node_type == "passive":
+            local_addr = None
+            if self.net.interface != "default":
+                local_addr = (get_lan_ip(self.net.interface), 0)
+
+            try:
+                transport, con = await asyncio.wait_for(
+                    loop.create_connection(
+                        lambda: AsyncSock(self, "outbound"),
+                        node_ip, node_port, local_addr=local_addr
+                    ),
+                    timeout
+                )
+            except Exception as e:
+                self.debug_print("FAILURE")
+                error = parse_exception(e)
+                log_exception(self.net.error_log_path, error)
+                return None
+
+            return con
+
+        return None
+
+    async def bootstrap(self):
+        net = self.net
+        if not net.enable_bootstrap:
+            return None
+
+        # Avoid raping the rendezvous server.
+        # Shares Net's scheduler so both front ends run on one timing.
+        t = time.time()
+        if not net.scheduler.is_due("bootstrap", t):
+            return None
+        net.last_bootstrap = t
+        net.scheduler.schedule(
+            "bootstrap", rendezvous_interval, jitter=interval_jitter
+        )
+
+        connection_slots = net.max_outbound - len(self.outbound)
+        if connection_slots <= 0:
+            return self
+
+        try:
+            choices = await self.rendezvous_request(
+                "BOOTSTRAP " + str(net.max_outbound * 2), expect_reply=1
+            )
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(net.error_log_path, error)
+            return self
+
+        choices = re.findall(r"(?:(p|s)[:]([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)[:]([0-9]+))+\s?", choices)
+        passive_nodes = [node for node in choices if node[0] == "p"]
+
+        # Connect to all of them at once and keep the first to succeed.
+        pending = set()
+        for node_type, node_ip, node_port in passive_nodes:
+            pending.add(asyncio.ensure_future(
+                self.add_node(node_ip, node_port, "passive")
+            ))
+
+        while len(pending) and connection_slots > 0:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.result() is None:
+                    continue
+
+                if connection_slots > 0:
+                    connection_slots -= 1
+                else:
+                    future.result().close()
+
+        for future in pending:
+            future.cancel()
+
+        return self
+
+    async def advertise(self):
+        net = self.net
+        if not net.enable_advertise:
+            return None
+
+        # Direct net server is reserved for direct connections only.
+        if net.net_type == "direct" and net.node_type == "passive":
+            return None
+
+        if not net.is_net_started:
+            raise Exception("Please call start() before you call advertise()")
+
+        # Avoid raping the rendezvous server with excessive requests.
+        t = time.time()
+        if not net.scheduler.is_due("advertise", t):
+            return None
+
+        if net.last_advertise is not None:
+            if len(self.inbound) >= net.min_connected:
+                return None
+
+        net.last_advertise = t
+        net.scheduler.schedule(
+            "advertise", advertise_interval, jitter=interval_jitter
+        )
+
+        try:
+            if net.node_type == "passive" and net.passive_port is not None:
+                msg = "PASSIVE READY %s %s" % (
+                    str(net.passive_port), str(net.max_inbound)
+                )
+                await self.rendezvous_request(msg)
+
+            if net.node_type == "simultaneous":
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(
+                    None, net.rendezvous.simultaneous_listen
+                )
+                self.watch_challenges()
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(net.error_log_path, error)
+
+        return self
+
+    def watch_challenges(self):
+        # Hole punching challenges arrive on the rendezvous con.
+        server_con = self.net.rendezvous.server_con
+        if server_con is None or not server_con.connected:
+            return
+
+        loop = asyncio.get_event_loop()
+
+        def on_readable():
+            loop.remove_reader(server_con.s)
+            asyncio.ensure_future(self.accept_simultaneous())
+
+        loop.add_reader(server_con.s, on_readable)
+
+    async def accept_simultaneous(self):
+        loop = asyncio.get_event_loop()
+        before = list(self.net.inbound)
+        await loop.run_in_executor(None, self.net.accept_simultaneous)
+        for node in self.net.inbound[:]:
+            if node not in before:
+                self.net.remove_connection(node)
+                await self.adopt(node["con"], "inbound")
+
+        # The rendezvous con may have been replaced.
+        self.watch_challenges()
+
+    def broadcast(self, msg, source_con=None):
+        # Encode + frame once for every peer.
+        if type(msg) == str:
+            msg = msg.encode("ascii")
+        data = bytes(msg) + b"\r\n"
+
+        # Same result format as Net.queue_broadcast.
+        results = {
+            "accepted": [],
+            "skipped": []
+        }
+        for con in self.outbound + self.inbound:
+            if con == source_con:
+                continue
+
+            # Transport buffer is over its high water mark.
+            if not con.can_write.is_set() or not con.send(data):
+                results["skipped"].append(con)
+            else:
+                results["accepted"].append(con)
+
+        return results
+
+    def __iter__(self):
+        cons = []
+        for con in self.inbound + self.outbound:
+            if con.expects_nonce():
+                continue
+
+            cons.append(con)
+
+        return iter(cons)
+
+    def __len__(self):
+        return len(self.inbound) + len(self.outbound)
+
+
+class AsyncUNL(UNL):
+    def __init__(self, async_net, value=None, debug=0):
+        self.async_net = async_net
+        net = async_net.net
+        UNL.__init__(
+            self, net=net, dht_node=net.dht_node, value=value,
+            wan_ip=net.wan_ip, debug=debug
+        )
+
+    async def connect(self, their_unl, force_master=1, hairpin=1, nonce="0" * 64, timeout=60):
+        """
+        Coroutine version of UNL.connect. Returns the connection
+        or None instead of calling success / failure events.
+        """
+        loop = asyncio.get_event_loop()
+        our_unl = self.deconstruct(self.value)
+        their_unl = self.deconstruct(their_unl)
+        if our_unl is None:
+            raise Exception("Unable to deconstruct our UNL.")
+        if their_unl is None:
+            raise Exception("Unable to deconstruct their UNL.")
+
+        master = self.is_master(their_unl["value"])
+        if force_master:
+            master = 1
+
+        # This means the nodes are behind the same router.
+        if our_unl["wan_ip"] == their_unl["wan_ip"]:
+            our_unl["wan_ip"] = our_unl["lan_ip"]
+            their_unl["wan_ip"] = their_unl["lan_ip"]
+            if hairpin:
+                our_unl["node_type"] = "passive"
+                their_unl["node_type"] = "passive"
+
+        con_id = None
+        if nonce != "0" * 64:
+            assert(len(nonce) == 64)
+            con_id = self.net.generate_con_id(
+                nonce, our_unl["wan_ip"], their_unl["wan_ip"]
+            )
+
+        for node_type in ["passive", "simultaneous"]:
+            nodes = []
+            if our_unl["node_type"] == node_type:
+                nodes.append(our_unl)
+            if their_unl["node_type"] == node_type:
+                nodes.append(their_unl)
+            if not len(nodes):
+                continue
+
+            # We only want one connection.
+            if len(nodes) == 2:
+                if not master:
+                    nodes.remove(their_unl)
+                else:
+                    nodes.remove(our_unl)
+
+            if nodes[0] == their_unl:
+                # We connect to them.
+                con = await self.async_net.add_node(
+                    their_unl["wan_ip"], their_unl["listen_port"],
+                    their_unl["node_type"], timeout=timeout
+                )
+                if con is None or not con.connected:
+                    continue
+
+                con.nonce = nonce
+                con.send(nonce)
+                con.unl = their_unl["value"]
+                return con
+
+            # Tell them to connect to us.
+            if self.dht_node is not None and force_master:
+                con_request = "REVERSE_CONNECT:%s:%s" % (self.value, nonce)
+                node_id = their_unl["node_id"]
+                if int(binascii.hexlify(node_id), 16):
+                    await loop.run_in_executor(
+                        None, self.dht_node.relay_message, node_id,
+                        con_request
+                    )
+
+            # They will connect to us.
+            if con_id is None:
+                con = await self.async_net.wait_for_con(
+                    their_unl["wan_ip"], timeout
+                )
+            else:
+                con = await self.async_net.wait_for_con(
+                    con_id, timeout, by_id=1
+                )
+
+            if con is not None and con.connected:
+                con.unl = their_unl["value"]
+                return con
+
+        return None
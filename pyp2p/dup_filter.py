@@ -0,0 +1,292 @@
+"""
+Duplicate message filtering for Net.
+
+SeenCache remembers the SHA-256 digest of every message a node has
+seen so that gossiped messages are only processed (and retransmitted)
+a limited number of times. Unlike the old module-level table it's
+bounded: entries expire after ttl seconds without being seen and the
+least recently seen entries are evicted once max_size is reached.
+
+RotatingBloomFilter is a probabilistic alternative for high volume
+gossip. It uses a fixed amount of memory no matter how many messages
+pass through it, at the cost of a configurable false positive rate
+(new messages wrongly dropped as duplicates.) It only answers "seen or
+not" so messages aren't retransmitted after min_retransmit_interval.
+
+Both have the same check / record / clear interface so either can be
+passed to Net as dup_filter.
+"""
+
+import hashlib
+import math
+import struct
+import time
+from collections import OrderedDict
+
+# Minimum time that must pass between retransmissions.
+min_retransmit_interval = 5
+
+# How many times a single message can be retransmitted.
+max_retransmissions = 100
+
+
+def msg_digest(msg):
+    # Raw 32 byte digest (half the size of hexdigest.)
+    if type(msg) == type(u""):
+        msg = msg.encode("ascii")
+
+    return hashlib.sha256(msg).digest()
+
+
+class SeenCache():
+    def __init__(self, ttl=10 * 60, max_size=100000,
+                 retransmit_interval=min_retransmit_interval,
+                 max_times=max_retransmissions, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.retransmit_interval = retransmit_interval
+        self.max_times = max_times
+        self.clock = clock
+
+        # Digest -> [times, last], oldest "last" first.
+        self.entries = OrderedDict()
+
+        # Stats.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, msg):
+        return msg_digest(msg) in self.entries
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+
+        # Entries are ordered by last seen so stop at the first live one.
+        cutoff = now - self.ttl
+        while len(self.entries):
+            digest, entry = next(iter(self.entries.items()))
+            if entry[1] > cutoff:
+                break
+
+            del self.entries[digest]
+            self.evictions += 1
+
+    def is_old(self, digest, now):
+        entry = self.entries.get(digest)
+        if entry is None:
+            return 0
+
+        if now - entry[1] < self.retransmit_interval:
+            return 1
+
+        if entry[0] >= self.max_times:
+            return 1
+
+        return 0
+
+    def check(self, msg, record_seen=0):
+        """
+        Returns 1 if msg is a duplicate that shouldn't be processed
+        again, otherwise 0. With record_seen new messages are also
+        recorded (the message is only hashed once either way.)
+        """
+        now = self.clock()
+        self.expire(now)
+        digest = msg_digest(msg)
+        if self.is_old(digest, now):
+            self.hits += 1
+            return 1
+
+        self.misses += 1
+        if record_seen:
+            self.add(digest, now)
+
+        return 0
+
+    def record(self, msg):
+        now = self.clock()
+        self.expire(now)
+        digest = msg_digest(msg)
+        if self.is_old(digest, now):
+            return 0
+
+        self.add(digest, now)
+        return 1
+
+    def add(self, digest, now):
+        entry = self.entries.pop(digest, None)
+        if entry is None:
+            entry = [0, now]
+
+            # Make room by dropping the least recently seen.
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        entry[0] += 1
+        entry[1] = now
+        self.entries[digest] = entry
+
+    def clear(self):
+        self.entries = OrderedDict()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class BloomFilter():
+    def __init__(self, capacity, error_rate):
+        assert(capacity > 0)
+        assert(0 < error_rate < 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # Optimal bit and hash count for the capacity + error rate.
+        self.bit_no = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        ))
+        self.hash_no = max(1, int(round(
+            (self.bit_no / float(capacity)) * math.log(2)
+        )))
+        self.bits = bytearray((self.bit_no + 7) // 8)
+        self.count = 0
+
+    def indexes(self, digest):
+        # Double hashing: k indexes from two 64 bit halves of the digest.
+        h1, h2 = struct.unpack("<QQ", digest[:16])
+        h2 |= 1
+        bit_no = self.bit_no
+        return [(h1 + i * h2) % bit_no for i in range(0, self.hash_no)]
+
+    def has_indexes(self, indexes):
+        bits = self.bits
+        for index in indexes:
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return 0
+
+        return 1
+
+    def add_indexes(self, indexes):
+        bits = self.bits
+        for index in indexes:
+            bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return self.has_indexes(self.indexes(digest))
+
+    def add(self, digest):
+        self.add_indexes(self.indexes(digest))
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class RotatingBloomFilter():
+    """
+    Two generations of Bloom filters. New digests go into the current
+    generation and when it's full the previous generation is dropped.
+    A message is remembered for at least capacity more messages and
+    the false positive rate stays below about 2 * error_rate.
+
+    Either pass capacity or max_bytes (total memory for both
+    generations) and the capacity is worked out from the error rate.
+    """
+    def __init__(self, capacity=None, error_rate=0.0001, max_bytes=None):
+        if capacity is None:
+            if max_bytes is None:
+                max_bytes = 4 * 1024 * 1024
+
+            # Bits per generation -> capacity for the error rate.
+            bit_no = (max_bytes // 2) * 8
+            capacity = int(
+                bit_no * (math.log(2) ** 2) / -math.log(error_rate)
+            )
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+
+        # Stats.
+        self.hits = 0
+        self.misses = 0
+        self.rotations = 0
+
+    def __len__(self):
+        size = self.current.count
+        if self.previous is not None:
+            size += self.previous.count
+
+        return size
+
+    def __contains__(self, msg):
+        return self.is_old(self.current.indexes(msg_digest(msg)))
+
+    def memory_usage(self):
+        size = len(self.current.bits)
+        if self.previous is not None:
+            size += len(self.previous.bits)
+
+        return size
+
+    def is_old(self, indexes):
+        # Every generation has the same size so the indexes are shared.
+        if self.current.has_indexes(indexes):
+            return 1
+
+        if self.previous is not None and self.previous.has_indexes(indexes):
+            return 1
+
+        return 0
+
+    def add(self, indexes):
+        if self.current.is_full():
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotations += 1
+
+        self.current.add_indexes(indexes)
+
+    def check(self, msg, record_seen=0):
+        indexes = self.current.indexes(msg_digest(msg))
+        if self.is_old(indexes):
+            self.hits += 1
+            return 1
+
+        self.misses += 1
+        if record_seen:
+            self.add(indexes)
+
+        return 0
+
+    def record(self, msg):
+        indexes = self.current.indexes(msg_digest(msg))
+        if self.is_old(indexes):
+            return 0
+
+        self.add(indexes)
+        return 1
+
+    def clear(self):
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.previous = None
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rotations": self.rotations,
+            "bytes": self.memory_usage()
+        }
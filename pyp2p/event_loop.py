@@ -0,0 +1,143 @@
+"""
+A small event loop built on the selectors module (epoll on Linux,
+kqueue on BSD / OSX and select elsewhere.) It's used by Net.poll()
+to wait for I/O on every connection at once instead of calling
+recv() on each connection every time the program loops.
+
+Anything with a fileno() method can be registered (including Sock
+objects.) Each registration has a read callback and an optional
+write callback that are called with the registered object when
+the selector reports it as readable or writable.
+"""
+
+import time
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+# Seconds to sleep when poll() has nothing to wait on and no timeout.
+idle_timeout = 1
+
+
+class EventLoop():
+    def __init__(self):
+        if selectors is None:
+            raise Exception("The event loop requires Python 3.4+ (selectors.)")
+
+        self.selector = selectors.DefaultSelector()
+
+        # Fileobj -> {"read": callback, "write": callback}
+        self.callbacks = {}
+
+    def events_for(self, callbacks):
+        events = 0
+        if callbacks["read"] is not None:
+            events |= selectors.EVENT_READ
+        if callbacks["write"] is not None:
+            events |= selectors.EVENT_WRITE
+
+        return events
+
+    def update(self, fileobj):
+        callbacks = self.callbacks[fileobj]
+        events = self.events_for(callbacks)
+        try:
+            key = self.selector.get_key(fileobj)
+        except (KeyError, ValueError):
+            key = None
+
+        # No interest left: remove from the selector but keep callbacks.
+        if not events:
+            if key is not None:
+                self.selector.unregister(fileobj)
+            return
+
+        if key is None:
+            self.selector.register(fileobj, events)
+        elif key.events != events:
+            self.selector.modify(fileobj, events)
+
+    def register(self, fileobj, read=None, write=None):
+        self.callbacks[fileobj] = {
+            "read": read,
+            "write": write
+        }
+
+        try:
+            self.update(fileobj)
+        except (KeyError, ValueError, OSError):
+            # Closed or otherwise invalid file descriptor.
+            del self.callbacks[fileobj]
+            return 0
+
+        return 1
+
+    def set_read(self, fileobj, callback):
+        if fileobj not in self.callbacks:
+            return 0
+
+        self.callbacks[fileobj]["read"] = callback
+        self.update(fileobj)
+        return 1
+
+    def set_write(self, fileobj, callback):
+        if fileobj not in self.callbacks:
+            return 0
+
+        self.callbacks[fileobj]["write"] = callback
+        self.update(fileobj)
+        return 1
+
+    def unregister(self, fileobj):
+        if fileobj not in self.callbacks:
+            return
+
+        del self.callbacks[fileobj]
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def is_registered(self, fileobj):
+        return fileobj in self.callbacks
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for registered
+        objects to become readable / writable and runs their callbacks.
+        With nothing registered it sleeps for timeout (idle_timeout if
+        None) instead. Returns the number of callbacks run.
+        """
+
+        # Nothing to wait on: sleep instead of returning straight away
+        # so callers looping on poll() don't spin.
+        if not len(self.selector.get_map()):
+            if timeout is None:
+                timeout = idle_timeout
+            if timeout > 0:
+                time.sleep(timeout)
+            return 0
+
+        ran = 0
+        for key, events in self.selector.select(timeout):
+            fileobj = key.fileobj
+            if events & selectors.EVENT_WRITE:
+                # Callbacks may have unregistered this object.
+                callbacks = self.callbacks.get(fileobj)
+                if callbacks is not None and callbacks["write"] is not None:
+                    callbacks["write"](fileobj)
+                    ran += 1
+
+            if events & selectors.EVENT_READ:
+                callbacks = self.callbacks.get(fileobj)
+                if callbacks is not None and callbacks["read"] is not None:
+                    callbacks["read"](fileobj)
+                    ran += 1
+
+        return ran
+
+    def close(self):
+        self.callbacks = {}
+        self.selector.close()
@@ -0,0 +1,165 @@
+"""
+Keeps port forwarding mappings alive.
+
+UPnP and NAT-PMP mappings are leases: NAT-PMP asks for an hour and
+the gateway drops the mapping after that unless it's renewed, which
+leaves a passive node unreachable until it restarts. LeaseManager
+renews each batch of mappings (with the forwarder that created them)
+when renew_fraction of its lifetime has passed and removes them all
+again on close(). Renewals happen on a background thread so they
+don't depend on Net.synchronize() being called.
+
+A forwarder is anything with forward_ports(mappings, dest_ip,
+lifetime) and remove_ports(mappings), i.e. UPnP or NatPMP.
+"""
+
+import itertools
+import threading
+
+from .scheduler import Scheduler
+
+
+class LeaseManager():
+    def __init__(self, renew_fraction=0.5, retry_interval=60):
+        # Renew when this much of a lease has passed.
+        self.renew_fraction = renew_fraction
+
+        # Seconds to wait before retrying a failed renewal.
+        self.retry_interval = retry_interval
+
+        # Name -> {"forwarder", "mappings", "dest_ip", "lifetime",
+        # "granted", "renewals", "failures"}
+        self.leases = {}
+        self.seq = itertools.count()
+        self.scheduler = Scheduler()
+        self.lock = threading.RLock()
+
+        # Set to wake the renewal thread up early.
+        self.wake = threading.Event()
+        self.thread = None
+        self.running = 0
+
+    def __len__(self):
+        return len(self.leases)
+
+    def renew_delay(self, granted):
+        return max(1, granted * self.renew_fraction)
+
+    def add(self, forwarder, mappings, dest_ip, lifetime=3600):
+        """
+        Forwards a list of (proto, src_port, dest_port) mappings and
+        keeps them renewed. Returns the lease name (or raises if the
+        forwarder couldn't map them.)
+        """
+        granted = forwarder.forward_ports(mappings, dest_ip, lifetime)
+        return self.track(forwarder, mappings, dest_ip, lifetime, granted)
+
+    def track(self, forwarder, mappings, dest_ip, lifetime, granted):
+        # Keeps mappings the forwarder has already made renewed.
+        name = "lease " + str(next(self.seq))
+        lease = {
+            "forwarder": forwarder,
+            "mappings": list(mappings),
+            "dest_ip": dest_ip,
+            "lifetime": lifetime,
+            "granted": min(granted) if len(granted) else 0,
+            "renewals": 0,
+            "failures": 0
+        }
+        with self.lock:
+            self.leases[name] = lease
+
+            # Permanent leases only need removing.
+            if lease["granted"]:
+                self.schedule_renewal(name, self.renew_delay(lease["granted"]))
+
+        return name
+
+    def schedule_renewal(self, name, delay):
+        def renew():
+            self.renew(name)
+
+        self.scheduler.schedule(name, delay, renew)
+        self.start()
+        self.wake.set()
+
+    def renew(self, name):
+        with self.lock:
+            lease = self.leases.get(name)
+            if lease is None or not self.running:
+                return 0
+            forwarder = lease["forwarder"]
+            mappings = lease["mappings"]
+            dest_ip = lease["dest_ip"]
+            lifetime = lease["lifetime"]
+
+        # Talk to the gateway without holding the lock.
+        try:
+            granted = forwarder.forward_ports(mappings, dest_ip, lifetime)
+        except Exception:
+            with self.lock:
+                lease["failures"] += 1
+
+                # Try again well before the mapping actually expires.
+                if name in self.leases and self.running:
+                    delay = min(
+                        self.retry_interval,
+                        self.renew_delay(lease["granted"])
+                    )
+                    self.schedule_renewal(name, delay)
+            return 0
+
+        with self.lock:
+            lease["granted"] = min(granted) if len(granted) else 0
+            lease["renewals"] += 1
+            lease["failures"] = 0
+            if name in self.leases and self.running and lease["granted"]:
+                self.schedule_renewal(name, self.renew_delay(lease["granted"]))
+
+        return 1
+
+    def remove(self, name):
+        with self.lock:
+            lease = self.leases.pop(name, None)
+            self.scheduler.cancel(name)
+        if lease is None:
+            return 0
+
+        try:
+            lease["forwarder"].remove_ports(lease["mappings"])
+            return 1
+        except Exception:
+            return 0
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.running = 1
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.scheduler.run_due()
+            self.wake.wait(self.scheduler.time_until_next())
+            self.wake.clear()
+
+    def close(self):
+        # Stop renewing and wait for any renewal in progress to finish
+        # so nothing is mapped again after the mappings are removed.
+        with self.lock:
+            self.running = 0
+            thread = self.thread
+            self.thread = None
+        self.wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        removed = 0
+        for name in list(self.leases):
+            removed += self.remove(name)
+
+        return removed
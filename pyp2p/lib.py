@@ -31,6 +31,12 @@ import traceback
 from decimal import Decimal
 from .ipgetter import *
 
+# Suggested place to remember slow to detect results between runs
+# (pass it as Net's profile_path to opt in.)
+default_cache_path = os.path.join(
+    os.path.expanduser("~"), ".pyp2p", "cache.json"
+)
+
 class Tee(object):
     def __init__(self, name, mode, lock):
         self.lock = lock
@@ -150,6 +156,33 @@ def get_lan_ip(interface="default"):
     except:
         return None
 
+def get_gateway_mac(gateway_ip):
+    # Linux only (ARP table from procfs.)
+    try:
+        with open("/proc/net/arp", "r") as arp:
+            for line in arp.readlines()[1:]:
+                parts = line.split()
+                if len(parts) >= 4 and parts[0] == gateway_ip:
+                    if parts[3] != "00:00:00:00:00:00":
+                        return parts[3]
+    except:
+        pass
+
+    return None
+
+def network_fingerprint(interface="default"):
+    """
+    Identifies the network a node is on by the interface, default
+    gateway and (where available) the gateway's MAC address. Returns
+    None if there's no gateway.
+    """
+    gateway_ip = get_default_gateway(interface)
+    if gateway_ip is None:
+        return None
+
+    gateway_mac = get_gateway_mac(gateway_ip)
+    return "%s %s %s" % (interface, gateway_ip, gateway_mac)
+
 def sequential_bind(n, interface="default"):
     bound = 0
     mappings = []
@@ -255,6 +288,33 @@ def is_valid_port(port):
     else:
         return 1
 
+def parse_port_mappings(mappings):
+    """
+    Checks a list of (proto, src_port, dest_port) port forwarding
+    mappings. Dest_port can be None (or left out) to use src_port.
+    Returns them as (PROTO, src_port, dest_port.)
+    """
+    parsed = []
+    for mapping in mappings:
+        proto, src_port = mapping[0], mapping[1]
+        dest_port = mapping[2] if len(mapping) > 2 else None
+        proto = proto.upper()
+        if proto not in ["TCP", "UDP"]:
+            raise Exception("Invalid protocol for forwarding.")
+
+        if not is_valid_port(src_port):
+            raise Exception("Invalid port for forwarding.")
+
+        # Source port is forwarded to same destination port number.
+        if dest_port == None:
+            dest_port = src_port
+        if not is_valid_port(dest_port):
+            raise Exception("Invalid port for forwarding.")
+
+        parsed.append((proto, int(src_port), int(dest_port)))
+
+    return parsed
+
 def memoize(function):
     memo = {}
     def wrapper(*args):
@@ -266,6 +326,75 @@ def memoize(function):
             return rv
     return wrapper
 
+class DiskCache():
+    """
+    JSON file of values that expire after a TTL. Used to remember
+    results that are slow to work out (like the NAT type) across
+    restarts. Read and write errors are ignored since it's only a
+    cache.
+    """
+    def __init__(self, path, ttl=24 * 60 * 60, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.loads(cache_file.read())
+            if type(entries) == dict:
+                self.entries = entries
+        except:
+            self.entries = {}
+
+    def save(self):
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            # Write then rename so readers never see half a file.
+            tmp_path = self.path + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_path, "w") as cache_file:
+                cache_file.write(json.dumps(self.entries))
+            getattr(os, "replace", os.rename)(tmp_path, self.path)
+            return 1
+        except:
+            return 0
+
+    def get(self, key, now=None):
+        if now is None:
+            now = self.clock()
+
+        entry = self.entries.get(key)
+        if entry is None or entry["expires"] <= now:
+            return None
+
+        return entry["value"]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        # Merge with anything other processes have written since.
+        self.load()
+        self.entries[key] = {
+            "value": value,
+            "expires": self.clock() + ttl
+        }
+
+        return self.save()
+
+    def delete(self, key):
+        self.load()
+        if key in self.entries:
+            del self.entries[key]
+            return self.save()
+
+        return 0
+
 @memoize
 def get_wan_ip(n=0):
     """
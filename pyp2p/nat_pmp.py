@@ -57,6 +57,8 @@ __author__ = "Yiming Liu <http://www.yimingliu.com/>"
 import struct, socket, select, time, platform
 import sys, os, re
 
+from .lib import get_default_gateway, parse_port_mappings
+
 NATPMP_PORT = 5351
 
 NATPMP_RESERVED_VAL = 0
@@ -315,6 +317,53 @@ def map_port(protocol, public_port, private_port, lifetime=3600, gateway_ip=None
     return port_mapping_response
 
 
+def map_ports(requests, gateway_ip=None, retry=9):
+    """A function to send several PortMapRequests at once.  Requests
+       that haven't been answered are resent with the same back off as
+       send_request_with_retry().  Responses are matched to requests by
+       opcode and private port.  Returns a list of responses in request
+       order (None for requests that were never answered.)
+    """
+    if gateway_ip == None:
+        gateway_ip = get_gateway_addr()
+    gateway_socket = get_gateway_socket(gateway_ip)
+    responses = [None] * len(requests)
+    try:
+        n = 1
+        while n <= retry and None in responses:
+            for i in range(0, len(requests)):
+                if responses[i] is None:
+                    send_request(gateway_socket, requests[i])
+
+            future = time.time() + n * NATPMPRequest.retry_increment
+            while None in responses:
+                remaining = future - time.time()
+                if remaining <= 0:
+                    break
+                data, source_addr = read_response(gateway_socket, remaining)
+                if not data or len(data) < 16:
+                    continue
+                if source_addr[0] != gateway_ip or source_addr[1] != NATPMP_PORT:
+                    continue # discard data if source mismatch, as per specification
+
+                response = PortMapResponse(data)
+                for i in range(0, len(requests)):
+                    if responses[i] is not None:
+                        continue
+                    if response.opcode != requests[i].opcode + 128:
+                        continue
+                    if response.private_port != requests[i].private_port:
+                        continue
+                    responses[i] = response
+                    break
+            n += 1
+    finally:
+        gateway_socket.close()
+
+    if responses.count(None) == len(responses):
+        raise NATPMPUnsupportedError(NATPMP_GATEWAY_NO_SUPPORT, error_str(NATPMP_GATEWAY_NO_SUPPORT))
+    return responses
+
 def send_request(gateway_socket, request):
     gateway_socket.sendall(request.toBytes())
 
@@ -350,25 +399,65 @@ class NatPMP:
     def __init__(self, interface="default"):
         self.interface = interface
 
+        # Gateway to send requests to (found automatically.)
+        self.gateway_ip = None
+
+        # Number of times to send each request.
+        self.retry = 9
+
+    def get_gateway(self):
+        if self.gateway_ip is None:
+            self.gateway_ip = get_default_gateway(self.interface)
+        if self.gateway_ip is None:
+            self.gateway_ip = get_gateway_addr()
+        return self.gateway_ip
+
+    def send_mappings(self, requests):
+        responses = map_ports(requests, self.get_gateway(), self.retry)
+        for response in responses:
+            if response is None:
+                raise NATPMPNetworkError(NATPMP_GATEWAY_NO_SUPPORT, error_str(NATPMP_GATEWAY_NO_SUPPORT))
+            if response.result != 0:
+                raise NATPMPResultError(response.result, error_str(response.result), response)
+        return responses
+
+    def map_ports(self, mappings, lifetime=3600):
+        # Returns the PortMapResponse for each mapping.
+        requests = []
+        for proto, src_port, dest_port in parse_port_mappings(mappings):
+            if proto == "TCP":
+                proto = NATPMP_PROTOCOL_TCP
+            else:
+                proto = NATPMP_PROTOCOL_UDP
+            requests.append(PortMapRequest(proto, dest_port, src_port, lifetime))
+
+        return self.send_mappings(requests)
+
+    def forward_ports(self, mappings, dest_ip=None, lifetime=3600):
+        """
+        Forwards a list of (proto, src_port, dest_port) mappings with
+        one batch of requests. NAT-PMP always maps to the host sending
+        the request so dest_ip is ignored. Returns a list of the
+        lifetimes granted.
+        """
+        responses = self.map_ports(mappings, lifetime)
+        return [response.lifetime for response in responses]
+
+    def remove_ports(self, mappings):
+        # A zero lifetime and public port deletes a mapping.
+        requests = []
+        for proto, src_port, dest_port in parse_port_mappings(mappings):
+            if proto == "TCP":
+                proto = NATPMP_PROTOCOL_TCP
+            else:
+                proto = NATPMP_PROTOCOL_UDP
+            requests.append(PortMapRequest(proto, dest_port, 0, 0))
+
+        return len(self.send_mappings(requests))
+
     def forward_port(self, proto, src_port, dest_ip, dest_port=None):
-        proto = proto.upper()
-        valid_protos = ["TCP", "UDP"]
-        if proto not in valid_protos:
-            raise Exception("Invalid protocol for forwarding.")
-
-        valid_ports = range(1, 65535)
-        if src_port not in valid_ports:
-            raise Exception("Invalid port for forwarding.")
-
-        #Source port is forwarded to same destination port number.
-        if dest_port == None:
-            dest_port = src_port
-
-        if proto == "TCP":
-            proto = 1
-        else:
-            proto = 2
-        return map_port(proto, src_port, dest_port)
+        # Returns the gateway's PortMapResponse.
+        return self.map_ports([(proto, src_port, dest_port)])[0]
 
 if __name__ == "__main__":
     #
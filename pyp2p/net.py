@@ -8,7 +8,8 @@ import socket
 import select
 import hashlib
 import re
-from threading import Thread
+import itertools
+from threading import Thread, Event, RLock
 import signal
 
 from .upnp import *
@@ -19,18 +20,29 @@ from .rendezvous_client import *
 from .hybrid_reply import *
 from .unl import UNL
 from .dht_msg import DHT
-
-# How many times a single message can be retransmitted.
-max_retransmissions = 100
-
-# Minimum time that must pass between retransmissions.
-min_retransmit_interval = 5
+from .event_loop import EventLoop
+from .dup_filter import *
+from .scheduler import Scheduler
+from .lease_manager import LeaseManager
 
 # A theoretical time for a message to propagate across the network.
 propagation_delay = 5
 
-# A table of message hashes for received messages.
-seen_messages = {}
+# How long a message hash is remembered after it was last seen.
+seen_message_ttl = 10 * 60
+
+# Most message hashes remembered by a single Net.
+max_seen_messages = 100000
+
+# Shared table of message hashes for the module level functions below.
+# (Each Net has its own self.seen_messages.)
+seen_messages = SeenCache(seen_message_ttl, max_seen_messages)
+
+# How long the LAN IP is cached for.
+lan_ip_ttl = 60
+
+# Most WAN IP fingerprints cached for con IDs.
+max_con_fingerprints = 10000
 
 # How often to get new DHT messages.
 dht_msg_interval = 5
@@ -45,6 +57,19 @@ advertise_interval = 10 * 60
 # Time that must elapse between accepting simultaneous opens.
 sim_open_interval = 2
 
+# Longest poll(None) blocks for when nothing is scheduled.
+idle_poll_timeout = 1
+
+# Lease to ask for when forwarding the passive port (it's renewed.)
+forwarding_lifetime = 3600
+
+# How long a saved connectivity profile is trusted for.
+profile_ttl = 7 * 24 * 60 * 60
+
+# Random variation of the intervals above (as a fraction) so nodes
+# started at the same time don't contact servers in lockstep.
+interval_jitter = 0.1
+
 # Bootstrapping + TCP hole punching server.
 rendezvous_servers = [
     {
@@ -74,55 +99,22 @@ forwarding_servers = [
 
 
 def is_msg_old(msg, record_seen=0):
-    if type(msg) == str:
-        msg = msg.encode("ascii")
-    response_hash = hashlib.sha256(msg).hexdigest()
-    if response_hash in seen_messages:
-        seen = seen_messages[response_hash]
-        elapsed = int(time.time()) - seen["last"]
-        if elapsed < min_retransmit_interval:
-            return 1
-
-        if seen["times"] >= max_retransmissions:
-            return 1
-
-    if record_seen:
-        record_msg_hash(msg)
-
-    return 0
+    return seen_messages.check(msg, record_seen)
 
 
 def record_msg_hash(msg):
-    if type(msg) == str:
-        msg = msg.encode("ascii")
-    response_hash = hashlib.sha256(msg).hexdigest()
-
-    if not is_msg_old(msg):
-        timestamp = int(time.time())
-        if response_hash in seen_messages:
-            seen = seen_messages[response_hash]
-            seen["times"] += 1
-            seen["last"] = timestamp
-        else:
-            seen_messages[response_hash] = {
-                "times": 1,
-                "last": timestamp
-            }
-
-        return 1
-    else:
-        return 0
+    return seen_messages.record(msg)
 
 
 def clear_seen_messages():
-    global seen_messages
-    seen_messages = {}
+    seen_messages.clear()
 
 class Net():
     def __init__(self, net_type="p2p", nat_type="unknown", node_type="unknown",
                  max_outbound=10, max_inbound=10, passive_bind="0.0.0.0",
                  passive_port=50500, interface="default", wan_ip=None, dht_node=None,
-                 error_log_path="error.log", debug=0):
+                 error_log_path="error.log", debug=0, dup_filter=None,
+                 profile_path=None):
         # List of outbound connections (from us, to another node.)
         self.outbound = []
 
@@ -153,6 +145,10 @@ class Net():
         # List of servers to do port forwarding checks.
         self.forwarding_servers = forwarding_servers
 
+        # Deadlines for bootstrapping, advertising, DHT polling,
+        # reverse query expiry and simultaneous opens.
+        self.scheduler = Scheduler()
+
         # Unix timestamp of last bootstrap.
         self.last_bootstrap = None
 
@@ -174,6 +170,13 @@ class Net():
         # Does this Net instance need to bootstrap?
         self.enable_bootstrap = 1
 
+        # Connect to bootstrap nodes in parallel.
+        self.enable_concurrent_bootstrap = 1
+        self.bootstrap_max_in_flight = 10
+
+        # Overall time limit for concurrent bootstrap connects.
+        self.bootstrap_timeout = 10
+
         # Does this Net instance need to advertise?
         self.enable_advertise = 1
 
@@ -193,6 +196,13 @@ class Net():
         # Indicates port forwarding state.
         self.forwarding_type = "manual"
 
+        # UPnP gateway found by determine_node() (reused next time.)
+        self.upnp_gateway = None
+
+        # Renews UPnP / NATPMP port mappings until stop().
+        self.leases = LeaseManager()
+        self.passive_lease = None
+
         # Debug mode shows debug messages.
         self.debug = debug
 
@@ -202,7 +212,7 @@ class Net():
         # Rendezvous / boostrapping client.
         self.rendezvous = RendezvousClient(
             self.nat_type, rendezvous_servers=rendezvous_servers,
-            interface=self.interface
+            interface=self.interface, cache_path=profile_path
         )
 
         # DHT node for receiving direct messages from other nodes.
@@ -220,10 +230,10 @@ class Net():
                     '^REVERSE_CONNECT',
                     '^REVERSE_QUERY',
                     '^REVERSE_ORIGIN',
-                    """u?("|')status("|')(:|,)\s+u?("|')SYN("|')""",
-                    """u?("|')status("|')(:|,)\s+u?("|')SYN-ACK("|')""",
-                    """u?("|')status("|')(:|,)\s+u?("|')ACK("|')""",
-                    """u?("|')status("|')(:|,)\s+u?("|')RST("|')""",
+                    r"""u?("|')status("|')(:|,)\s+u?("|')SYN("|')""",
+                    r"""u?("|')status("|')(:|,)\s+u?("|')SYN-ACK("|')""",
+                    r"""u?("|')status("|')(:|,)\s+u?("|')ACK("|')""",
+                    r"""u?("|')status("|')(:|,)\s+u?("|')RST("|')""",
                 ]
 
                 for needle in valid_needles:
@@ -243,8 +253,44 @@ class Net():
         if self.dht_node is not None:
             self.dht_node.add_message_handler(self.dht_msg_handler)
 
+            # Check for reverse connect requests.
+            if self.net_type == "direct":
+                self.scheduler.schedule(
+                    "dht", dht_msg_interval, self.process_dht_messages,
+                    dht_msg_interval
+                )
+
+        # Connectivity details saved by start() on this network
+        # (used by the next start() and checked again in the
+        # background.) Off unless profile_path is set, e.g. to
+        # default_cache_path.
+        self.profile_cache = None
+        if profile_path is not None:
+            self.profile_cache = DiskCache(profile_path, profile_ttl)
+        self.profile = self.load_profile()
+
+        # Profile details start() used instead of detecting them.
+        self.profile_fields = set()
+
+        # Background profile check started by start().
+        self.profile_thread = None
+
+        # Held while the background threads change connectivity
+        # details (WAN IP, NAT / node type, UNL) so they're never
+        # seen half updated.
+        self.state_lock = RLock()
+
+        # Progress of start(background=1): an event per phase and one
+        # for when everything is done.
+        self.phases = {}
+        for phase in ["rendezvous", "nat", "forwarding", "node"]:
+            self.phases[phase] = Event()
+        self.phase_errors = {}
+        self.ready = Event()
+        self.start_thread = None
+
         # External IP of this node.
-        self.wan_ip = wan_ip or get_wan_ip()
+        self.wan_ip = wan_ip or self.profile.get("wan_ip") or get_wan_ip()
 
         # Node type details only known after network is start()ed.
         self.unl = None
@@ -256,6 +302,9 @@ class Net():
         # Time frame for connection to respond to reverse query.
         self.reverse_query_expiry = 60
 
+        # Used to name reverse query expiry tasks.
+        self.reverse_query_seq = itertools.count()
+
         # Enable more than one connection to the same IP.
         self.enable_duplicate_ip_cons = 0
 
@@ -267,6 +316,50 @@ class Net():
         # Set to 1 when self.start() has been called.
         self.is_net_started = 0
 
+        # Selector based event loop (created by the first poll().)
+        self.event_loop = None
+
+        # Rendezvous server con currently watched by the event loop.
+        self.event_server_con = None
+
+        # Hashes of received messages (for rejecting duplicates.)
+        # Any object with the SeenCache interface can be used
+        # e.g. a RotatingBloomFilter for high volume gossip.
+        if dup_filter is None:
+            dup_filter = SeenCache(seen_message_ttl, max_seen_messages)
+        self.seen_messages = dup_filter
+
+        # Called with (con, reply) for replies received by poll().
+        self.reply_handlers = set()
+
+        # Lookup indexes for connections.
+        self.nodes_by_ip = {} # IP -> [nodes]
+        self.cons_by_unl = {} # UNL -> [cons]
+        self.cons_by_id = {} # con_id -> con
+        self.con_id_wan_ip = None # WAN IP the con_ids were made with.
+
+        # (their_wan_ip, our_wan_ip) -> fingerprint for generate_con_id.
+        self.con_fingerprints = {}
+
+        # Cached get_lan_ip() result.
+        self.lan_ip = None
+        self.lan_ip_expiry = 0
+
+        # Con -> node for cons in inbound / outbound.
+        self.node_by_con = {}
+
+        # Closed cons waiting to be reaped by synchronize.
+        self.closed_cons = set()
+
+        # Direct cons that still need to send their nonce.
+        self.nonce_pending = set()
+
+        # Whether we've told the rendezvous server we're full.
+        self.inbound_full = 0
+
+        # Cons with queued outbound data (used without an event loop.)
+        self.pending_send_cons = set()
+
     def debug_print(self, msg):
         if self.debug:
             print(str(msg))
@@ -277,6 +370,9 @@ class Net():
     def disable_bootstrap(self):
         self.enable_bootstrap = 0
 
+    def disable_concurrent_bootstrap(self):
+        self.enable_concurrent_bootstrap = 0
+
     def disable_advertise(self):
         self.enable_advertise = 0
 
@@ -286,9 +382,142 @@ class Net():
     def disable_forwarding(self):
         self.enable_forwarding = 0
 
+    # get_lan_ip() for our interface (cached for lan_ip_ttl seconds.)
+    def get_lan_ip(self):
+        if time.time() >= self.lan_ip_expiry:
+            self.lan_ip = get_lan_ip(self.interface)
+            self.lan_ip_expiry = time.time() + lan_ip_ttl
+
+        return self.lan_ip
+
     def get_connection_no(self):
         return (len(self.outbound) + len(self.inbound))
 
+    def add_reply_handler(self, handler):
+        self.reply_handlers.add(handler)
+
+    # Record a new connection in the inbound or outbound list.
+    def add_connection(self, node, node_list):
+        node_list.append(node)
+        con = node["con"]
+        self.node_by_con[con] = node
+        con.add_send_queue_handler(self.on_con_send_queued)
+        con.add_close_handler(self.on_con_closed)
+        if not con.connected:
+            self.closed_cons.add(con)
+        if self.net_type == "direct" and con.nonce is None:
+            self.nonce_pending.add(con)
+
+        # Index the con.
+        self.nodes_by_ip.setdefault(node["ip"], []).append(node)
+        if con.unl is not None:
+            self.cons_by_unl.setdefault(con.unl, []).append(con)
+        if con.nonce is not None:
+            self.index_con_id(con)
+        con.add_change_handler(self.on_con_changed)
+
+        if self.event_loop is not None:
+            self.register_con(con)
+
+    # Forget a connection (doesn't close it.)
+    def remove_connection(self, node):
+        for node_list in [self.inbound, self.outbound]:
+            if node in node_list:
+                node_list.remove(node)
+
+        con = node["con"]
+        if self.node_by_con.get(con) is node:
+            del self.node_by_con[con]
+        con.remove_send_queue_handler(self.on_con_send_queued)
+        con.remove_change_handler(self.on_con_changed)
+        con.remove_close_handler(self.on_con_closed)
+        self.pending_send_cons.discard(con)
+        self.closed_cons.discard(con)
+        self.nonce_pending.discard(con)
+
+        # Remove from indexes.
+        nodes = self.nodes_by_ip.get(node["ip"], [])
+        if node in nodes:
+            nodes.remove(node)
+            if not len(nodes):
+                del self.nodes_by_ip[node["ip"]]
+        self.unindex_unl(con, con.unl)
+        if self.cons_by_id.get(con.con_id) is con:
+            del self.cons_by_id[con.con_id]
+
+    def unindex_unl(self, con, unl):
+        cons = self.cons_by_unl.get(unl, [])
+        if con in cons:
+            cons.remove(con)
+            if not len(cons):
+                del self.cons_by_unl[unl]
+
+    def index_con_id(self, con):
+        # Remove old ID.
+        if con.con_id is not None and self.cons_by_id.get(con.con_id) is con:
+            del self.cons_by_id[con.con_id]
+        con.con_id = None
+
+        if con.nonce is None:
+            return
+
+        # Generate con_id from con.
+        try:
+            their_wan_ip, junk = con.s.getpeername()
+        except:
+            return
+        if is_ip_private(their_wan_ip):
+            our_wan_ip = self.get_lan_ip()
+        else:
+            our_wan_ip = self.wan_ip
+        con.con_id = self.generate_con_id(
+            con.nonce,
+            their_wan_ip,
+            our_wan_ip
+        )
+        self.cons_by_id[con.con_id] = con
+        self.con_id_wan_ip = self.wan_ip
+
+    # Keeps the indexes up to date when a con's nonce or UNL changes
+    # (or a closed con reconnects.)
+    def on_con_changed(self, con, name, old, new):
+        if name == "unl":
+            self.unindex_unl(con, old)
+            if new is not None:
+                self.cons_by_unl.setdefault(new, []).append(con)
+        elif name == "nonce":
+            self.index_con_id(con)
+            if new is None and self.net_type == "direct":
+                self.nonce_pending.add(con)
+            else:
+                self.nonce_pending.discard(con)
+        elif name == "connected":
+            # Reconnected before it was reaped: keep it.
+            self.closed_cons.discard(con)
+            if self.event_loop is not None and con in self.node_by_con:
+                self.register_con(con)
+
+    # Reaped on the next synchronize.
+    def on_con_closed(self, con):
+        self.closed_cons.add(con)
+        self.nonce_pending.discard(con)
+
+    # Closes con if they don't answer our reverse query in time.
+    def add_reverse_query(self, query):
+        self.pending_reverse_queries.append(query)
+
+        def expire():
+            # Already answered.
+            if query not in self.pending_reverse_queries:
+                return
+
+            query["con"].close()
+            self.pending_reverse_queries.remove(query)
+
+        name = "reverse query %d" % next(self.reverse_query_seq)
+        delay = query["timestamp"] + self.reverse_query_expiry - time.time()
+        self.scheduler.schedule(name, delay, expire)
+
     # Used to reject duplicate connections.
     def validate_node(self, node_ip, node_port=None, same_nodes=1):
         self.debug_print("Validating: " + node_ip)
@@ -311,7 +540,7 @@ class Net():
         if not self.enable_duplicate_ip_cons:
             # Don't connect to ourself.
             if (node_ip == "127.0.0.1" or
-                    node_ip == get_lan_ip(self.interface) or
+                    node_ip == self.get_lan_ip() or
                     node_ip == self.wan_ip):
                 self.debug_print("Cannot connect to ourself.")
                 return 0
@@ -322,16 +551,9 @@ class Net():
                 return 0
 
             # Don't connect to same nodes.
-            if same_nodes:
-                for node in self.outbound + self.inbound:
-                    try:
-                        addr, port = node["con"].s.getpeername()
-                        if node_ip == addr:
-                            self.debug_print("Already connected to this node.")
-                            return 0
-                    except Exception as e:
-                        print(e)
-                        return 0
+            if same_nodes and node_ip in self.nodes_by_ip:
+                self.debug_print("Already connected to this node.")
+                return 0
 
         return 1
 
@@ -348,10 +570,10 @@ class Net():
 
         # Already connected to them.
         if not self.enable_duplicate_ip_cons:
-            for node in self.outbound + self.inbound:
-                if node_ip == node["ip"]:
-                    self.debug_print("Already connected.")
-                    return node["con"]
+            nodes = self.nodes_by_ip.get(node_ip)
+            if nodes:
+                self.debug_print("Already connected.")
+                return nodes[0]["con"]
 
         # Avoid connecting to ourself.
         if not self.validate_node(node_ip, node_port):
@@ -389,7 +611,7 @@ class Net():
                         "ip": node_ip,
                         "port": 0
                     }
-                    self.outbound.append(node)
+                    self.add_connection(node, self.outbound)
                     self.debug_print("SUCCESS")
                 else:
                     self.debug_print("FAILURE")
@@ -406,7 +628,7 @@ class Net():
                     "ip": node_ip,
                     "port": node_port
                 }
-                self.outbound.append(node)
+                self.add_connection(node, self.outbound)
                 self.debug_print("SUCCESS")
             except Exception as e:
                 self.debug_print("FAILURE")
@@ -418,6 +640,56 @@ class Net():
         # Return new connection.
         return con
 
+    def add_passive_nodes(self, candidates, want, timeout=None):
+        """
+        Concurrent version of add_node for passive nodes. Connects to
+        (ip, port) candidates in parallel (bootstrap_max_in_flight at a
+        time, all within timeout) and keeps the first want that succeed.
+        Returns a list of the new cons.
+        """
+        if timeout is None:
+            timeout = self.bootstrap_timeout
+
+        # Filter out ourself + nodes we're already connected to.
+        addrs = []
+        ips = set()
+        for node_ip, node_port in candidates:
+            node_port = int(node_port)
+            if node_ip in ips and not self.enable_duplicate_ip_cons:
+                continue
+            if (node_ip, node_port) in addrs:
+                continue
+
+            if not self.validate_node(node_ip, node_port):
+                self.debug_print("Validate node failed.")
+                continue
+
+            addrs.append((node_ip, node_port))
+            ips.add(node_ip)
+
+        cons = []
+        connected = connect_many(
+            addrs, want, timeout, self.bootstrap_max_in_flight,
+            self.interface
+        )
+        for node_ip, node_port, s in connected:
+            con = Sock(blocking=0, timeout=timeout, interface=self.interface)
+            con.set_sock(s)
+            if not con.connected:
+                continue
+
+            node = {
+                "con": con,
+                "type": "passive",
+                "ip": node_ip,
+                "port": node_port
+            }
+            self.add_connection(node, self.outbound)
+            cons.append(con)
+
+        self.debug_print("Connected to %d / %d nodes." % (len(cons), len(addrs)))
+        return cons
+
     def bootstrap(self):
         """
         When the software is first started, it needs to retrieve
@@ -438,36 +710,29 @@ class Net():
 
         # Avoid raping the rendezvous server.
         t = time.time()
-        if self.last_bootstrap is not None:
-            if t - self.last_bootstrap <= rendezvous_interval:
-                self.debug_print("Bootstrapped recently")
-                return None
+        if not self.scheduler.is_due("bootstrap", t):
+            self.debug_print("Bootstrapped recently")
+            return None
         self.last_bootstrap = t
+        self.scheduler.schedule(
+            "bootstrap", rendezvous_interval, jitter=interval_jitter
+        )
         self.debug_print("Searching for nodes to connect to.")
 
         try:
             connection_slots = self.max_outbound - (len(self.outbound))
             if connection_slots > 0:
-                # Connect to rendezvous server.
-                rendezvous_con = Sock(
-                    self.rendezvous.rendezvous_servers[0]["addr"],
-                    self.rendezvous.rendezvous_servers[0]["port"],
-                    blocking=1, interface=self.interface, timeout=3
-                )
-
                 # Retrieve random nodes to bootstrap with.
-                rendezvous_con.send_line("BOOTSTRAP " + str(self.max_outbound * 2))
-                choices = rendezvous_con.recv_line(timeout=2)
+                msg = "BOOTSTRAP " + str(self.max_outbound * 2)
+                choices = self.rendezvous.session.request(msg)
                 if choices == "NODES EMPTY":
-                    rendezvous_con.close()
                     self.debug_print("Node list is empty.")
                     return self
                 else:
                     self.debug_print("Found node list.")
 
                 # Parse node list.
-                choices = re.findall("(?:(p|s)[:]([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)[:]([0-9]+))+\s?", choices)
-                rendezvous_con.s.close()
+                choices = re.findall(r"(?:(p|s)[:]([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)[:]([0-9]+))+\s?", choices)
 
                 # Attempt to make active simultaneous connections.
                 passive_nodes = []
@@ -477,9 +742,15 @@ class Net():
                         break
 
                     # Add to list of passive nodes.
-                    if node_type == "p":
+                    if node[0] == "p":
                         passive_nodes.append(node)
 
+                # Race connects to every passive node at once.
+                if self.enable_concurrent_bootstrap:
+                    candidates = [(ip, port) for t, ip, port in passive_nodes]
+                    self.add_passive_nodes(candidates, connection_slots)
+                    return self
+
                 # Use passive to make up the remaining cons.
                 i = 0
                 while i < len(passive_nodes) and connection_slots > 0:
@@ -522,14 +793,17 @@ class Net():
 
         # Avoid raping the rendezvous server with excessive requests.
         t = time.time()
-        if self.last_advertise is not None:
-            if t - self.last_advertise <= advertise_interval:
-                return None
+        if not self.scheduler.is_due("advertise", t):
+            return None
 
+        if self.last_advertise is not None:
             if len(self.inbound) >= self.min_connected:
                 return None
 
         self.last_advertise = t
+        self.scheduler.schedule(
+            "advertise", advertise_interval, jitter=interval_jitter
+        )
 
         # Tell rendezvous server to list us.
         try:
@@ -548,9 +822,22 @@ class Net():
 
         return self
 
-    def determine_node(self):
+    def relist(self):
+        """
+        Advertises straight away instead of at the next advertise
+        interval. Used when the node type is upgraded in the
+        background so passive nodes are listed and simultaneous
+        nodes start listening for challenges as soon as they can.
+        """
+        self.scheduler.cancel("advertise")
+        self.last_advertise = None
+
+        return self.advertise()
+
+    def determine_node(self, forwarded=None):
         """
         Determines the type of node based on a combination of forwarding reachability and NAT type.
+        Forwarded is the result of an earlier forward_passive_port() call (if any.)
         """
 
         # Manually set node_type as simultaneous.
@@ -558,6 +845,24 @@ class Net():
             if self.nat_type != "unknown":
                 return "simultaneous"
 
+        # Passive node checks.
+        if forwarded is None:
+            forwarded = self.forward_passive_port()
+        if forwarded:
+            return "passive"
+
+        # Fail-safe node types.
+        if self.nat_type != "unknown":
+            return "simultaneous"
+        else:
+            return "active"
+
+    def forward_passive_port(self):
+        """
+        Checks if the passive port is reachable from the Internet and
+        if not tries to forward it with UPnP and NATPMP. Returns 1 if
+        the node can run as passive.
+        """
         # Get IP of binding interface.
         unspecific_bind = ["0.0.0.0", "127.0.0.1", "localhost"]
         if self.passive_bind in unspecific_bind:
@@ -574,20 +879,33 @@ class Net():
                 self.debug_print("Port already forwarded. Skipping NAT traversal.")
 
                 self.forwarding_type = "forwarded"
-                return "passive"
+                return 1
             else:
                 self.debug_print("Port is not already forwarded.")
 
+            # Replace any mapping from an earlier check.
+            if self.passive_lease is not None:
+                self.leases.remove(self.passive_lease)
+                self.passive_lease = None
+            mappings = [("TCP", self.passive_port, None)]
+
             # Most routers.
             try:
                 self.debug_print("Trying UPnP")
 
-                UPnP(self.interface).forward_port("TCP", self.passive_port, lan_ip)
+                upnp = UPnP(self.interface)
+                upnp.gateway_addr = self.upnp_gateway
+                lease = self.leases.add(
+                    upnp, mappings, lan_ip, forwarding_lifetime
+                )
+                self.upnp_gateway = upnp.gateway_addr
 
                 if is_port_forwarded(lan_ip, self.passive_port, "TCP", self.forwarding_servers):
                     self.forwarding_type = "UPnP"
+                    self.passive_lease = lease
                     self.debug_print("Forwarded port with UPnP.")
                 else:
+                    self.leases.remove(lease)
                     self.debug_print("UPnP failed to forward port.")
 
             except Exception as e:
@@ -599,11 +917,16 @@ class Net():
                 # Apple devices.
                 try:
                     self.debug_print("Trying NATPMP.")
-                    NatPMP(self.interface).forward_port("TCP", self.passive_port, lan_ip)
+                    lease = self.leases.add(
+                        NatPMP(self.interface), mappings, lan_ip,
+                        forwarding_lifetime
+                    )
                     if is_port_forwarded(lan_ip, self.passive_port, "TCP", self.forwarding_servers):
                         self.forwarding_type = "NATPMP"
+                        self.passive_lease = lease
                         self.debug_print("Port forwarded with NATPMP.")
                     else:
+                        self.leases.remove(lease)
                         self.debug_print("Failed to forward port with NATPMP.")
                         self.debug_print("Falling back on TCP hole punching or proxying.")
                 except Exception as e:
@@ -614,13 +937,214 @@ class Net():
 
             # Check it worked.
             if self.forwarding_type != "manual":
-                return "passive"
+                return 1
 
-        # Fail-safe node types.
-        if self.nat_type != "unknown":
-            return "simultaneous"
+        return 0
+
+    def select_node_type(self, node_type, forwarded=None):
+        # Check NAT type if node is simultaneous
+        # is manually specified.
+        if node_type == "simultaneous":
+            if self.nat_type not in self.rendezvous.predictable_nats:
+                self.debug_print("Manual setting of simultanous specified but ignored since NAT does not support it.")
+                node_type = "active"
         else:
-            return "active"
+            # Determine node type.
+            self.debug_print("Determining node type.")
+
+            # No checks for manually specifying passive
+            # (there probably should be.)
+            if node_type == "unknown":
+                node_type = self.determine_node(forwarded)
+
+
+        # Prevent P2P nodes from running as simultaneous.
+        if self.net_type == "p2p":
+            """
+            TCP hole punching is reserved specifically for direct networks (a net object reserved for receiving direct connections -- p2p is for connecting to the main network. The reason for this is you can't do multiple TCP hole punches at the same time so its reserved for direct network where it's most needed.
+            """
+            if node_type == "simultaneous":
+                self.debug_print("Simultaneous is not allowed for P2P")
+                node_type = "active"
+                self.disable_simultaneous()
+
+        return node_type
+
+    def determine_nat(self):
+        if self.nat_type == "unknown":
+            self.debug_print("Determining NAT type.")
+            nat_type = self.rendezvous.determine_nat()
+            if nat_type is not None and nat_type != "unknown":
+                with self.state_lock:
+                    self.nat_type = nat_type
+                    self.rendezvous.nat_type = nat_type
+                self.debug_print("NAT type = " + nat_type)
+            else:
+                self.debug_print("Unable to determine NAT type.")
+
+        return self.nat_type
+
+    def profile_key(self):
+        # Profiles are per network, net type and passive port.
+        if self.profile_cache is None:
+            return None
+
+        network = network_fingerprint(self.interface)
+        if network is None:
+            return None
+
+        return "profile %s %s %s" % (network, self.net_type, self.passive_port)
+
+    def load_profile(self):
+        key = self.profile_key()
+        if key is None:
+            return {}
+
+        profile = self.profile_cache.get(key)
+        if type(profile) != dict:
+            return {}
+
+        # Only trust it if we're still on the same LAN IP.
+        if profile.get("lan_ip") != get_lan_ip(self.interface):
+            return {}
+
+        return profile
+
+    def save_profile(self):
+        key = self.profile_key()
+        if key is None:
+            return 0
+
+        lan_ip = get_lan_ip(self.interface)
+        with self.state_lock:
+            self.profile = {
+                "wan_ip": self.wan_ip,
+                "lan_ip": lan_ip,
+                "nat_type": self.nat_type,
+                "delta": self.rendezvous.delta,
+                "node_type": self.node_type,
+                "forwarding_type": self.forwarding_type,
+                "upnp_gateway": self.upnp_gateway
+            }
+
+        return self.profile_cache.set(key, self.profile)
+
+    def apply_profile(self):
+        """
+        Fills in NAT and node details that weren't passed to Net()
+        from the saved profile so start() can skip detecting them.
+        Returns the set of fields that were used.
+        """
+        profile = self.profile
+        fields = set()
+        if not len(profile):
+            return fields
+
+        if profile.get("upnp_gateway") is not None:
+            self.upnp_gateway = profile["upnp_gateway"]
+
+        if self.nat_type == "unknown" and profile.get("nat_type", "unknown") != "unknown":
+            self.nat_type = profile["nat_type"]
+            self.rendezvous.nat_type = self.nat_type
+            self.rendezvous.delta = profile.get("delta", 0)
+            fields.add("nat_type")
+
+        if self.node_type == "unknown" and profile.get("node_type", "unknown") != "unknown":
+            self.node_type = profile["node_type"]
+            self.forwarding_type = profile.get("forwarding_type", "manual")
+            fields.add("node_type")
+
+        self.profile_fields = fields
+        return fields
+
+    def update_unl(self):
+        # Re-issue our UNL after connectivity details change.
+        if self.unl is None:
+            return
+
+        with self.state_lock:
+            self.unl.wan_ip = self.wan_ip
+            self.unl.value = self.unl.construct()
+
+    def revalidate_profile(self):
+        """
+        Checks the details start() took from the saved profile still
+        hold, detects anything that changed and then saves the
+        profile again. Runs in a background thread after start().
+        """
+        try:
+            changed = 0
+            relist = 0
+
+            # WAN IP.
+            wan_ip = get_wan_ip()
+            if wan_ip is not None and wan_ip != self.wan_ip:
+                self.debug_print("WAN IP changed = " + str(wan_ip))
+                with self.state_lock:
+                    self.wan_ip = wan_ip
+                changed = 1
+
+            # NAT type (skipping the NAT type cache.)
+            if "nat_type" in self.profile_fields:
+                nat_type = self.rendezvous.detect_nat()
+                if nat_type != self.nat_type:
+                    self.debug_print("NAT type changed = " + nat_type)
+                    with self.state_lock:
+                        self.nat_type = nat_type
+                        self.rendezvous.nat_type = nat_type
+                    changed = 1
+
+            # Node type.
+            if "node_type" in self.profile_fields:
+                valid = 1
+                if self.node_type == "passive":
+                    lan_ip = get_lan_ip(self.interface)
+
+                    # Take over the lease on the last run's mapping.
+                    if self.forwarding_type in ["UPnP", "NATPMP"]:
+                        if self.forwarding_type == "UPnP":
+                            forwarder = UPnP(self.interface)
+                            forwarder.gateway_addr = self.upnp_gateway
+                        else:
+                            forwarder = NatPMP(self.interface)
+                        try:
+                            self.passive_lease = self.leases.add(
+                                forwarder, [("TCP", self.passive_port, None)],
+                                lan_ip, forwarding_lifetime
+                            )
+                        except Exception as e:
+                            error = parse_exception(e)
+                            log_exception(self.error_log_path, error)
+                    valid = is_port_forwarded(
+                        lan_ip, self.passive_port, "TCP",
+                        self.forwarding_servers
+                    )
+                if self.node_type == "simultaneous":
+                    valid = self.nat_type in self.rendezvous.predictable_nats
+
+                # Active nodes try to upgrade.
+                if self.node_type == "active" or not valid:
+                    self.forwarding_type = "manual"
+                    node_type = self.select_node_type("unknown")
+                    if node_type != self.node_type:
+                        self.debug_print("Node type changed = " + node_type)
+                        with self.state_lock:
+                            self.node_type = node_type
+                        changed = 1
+
+                        if node_type in ["passive", "simultaneous"]:
+                            relist = 1
+
+            with self.state_lock:
+                if changed:
+                    self.update_unl()
+                self.save_profile()
+
+            if relist:
+                self.relist()
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(self.error_log_path, error)
 
     # Receive inbound connections.
     def start_passive_server(self):
@@ -633,26 +1157,120 @@ class Net():
         if not self.passive_port:
             self.passive_port = self.passive.getsockname()[1]
 
-    def start(self):
+        # Listen for inbound cons with the event loop.
+        if self.event_loop is not None:
+            self.event_loop.register(self.passive, read=self.on_passive_readable)
+
+    def run_phase(self, name, target, *args):
+        # Runs one start() phase, recording errors and marking it done.
+        try:
+            return target(*args)
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(self.error_log_path, error)
+            self.phase_errors[name] = error
+            self.debug_print("Start phase failed: " + name)
+        finally:
+            self.phases[name].set()
+
+    def run_start_phases(self, node_type):
+        """
+        Background part of start(background=1). The rendezvous check,
+        NAT detection and port forwarding run at the same time. The
+        node type is then worked out from their results and the UNL is
+        re-issued.
+        """
+        forwarded = []
+        def forward():
+            forwarded.append(self.forward_passive_port())
+
+        threads = [
+            Thread(target=self.run_phase, args=(
+                "rendezvous", self.rendezvous.session.connect
+            ))
+        ]
+        if len(self.profile_fields):
+            # Check saved details instead of detecting everything.
+            def revalidate():
+                self.revalidate_profile()
+                self.phases["nat"].set()
+                self.phases["forwarding"].set()
+            threads.append(Thread(target=self.run_phase, args=(
+                "node", revalidate
+            )))
+        else:
+            threads.append(Thread(target=self.run_phase, args=(
+                "nat", self.determine_nat
+            )))
+            if node_type == "unknown":
+                threads.append(Thread(target=self.run_phase, args=(
+                    "forwarding", forward
+                )))
+            else:
+                self.phases["forwarding"].set()
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Upgrade from active now NAT type + forwarding are known.
+        if not len(self.profile_fields):
+            def select():
+                selected = self.select_node_type(
+                    node_type, forwarded[0] if len(forwarded) else 0
+                )
+                with self.state_lock:
+                    self.node_type = selected
+                    self.update_unl()
+                    self.save_profile()
+                self.debug_print("Node type = " + self.node_type)
+
+                # Started as active: list the new node type now.
+                if selected in ["passive", "simultaneous"]:
+                    self.relist()
+            self.run_phase("node", select)
+
+        self.ready.set()
+
+    def wait_ready(self, timeout=None):
+        # Waits for start(background=1) to finish detecting details.
+        self.ready.wait(timeout)
+        return self.ready.is_set()
+
+    def start(self, background=0):
         """
         This function determines node and NAT type, saves connectivity details,
         and starts any needed servers to be a part of the network. This is
         usually the first function called after initialising the Net class.
+
+        With background set the passive server accepts connections
+        straight away and everything else runs in threads. The node
+        starts as active and its UNL is re-issued when detection
+        finishes (see wait_ready() and self.phases.)
         """
 
         self.debug_print("Starting networking.")
         self.debug_print("Make sure to iterate over replies if you need connection alive management!")
 
         # Register a cnt + c handler
-        signal.signal(signal.SIGINT, self.stop)
+        # (Only possible from the main thread.)
+        try:
+            signal.signal(signal.SIGINT, self.stop)
+        except ValueError:
+            self.debug_print("Not in main thread: SIGINT handler skipped.")
 
         # Save WAN IP.
         self.debug_print("WAN IP = " + str(self.wan_ip))
 
+        if background:
+            return self.start_background()
+
         # Check rendezvous server is up.
+        # (The connection is kept for later commands.)
         try:
-            rendezvous_con = self.rendezvous.server_connect()
-            rendezvous_con.close()
+            self.rendezvous.session.connect()
         except:
             raise Exception("Unable to connect to rendezvous server.")
 
@@ -660,43 +1278,15 @@ class Net():
         # since LAN connections are always possible.
         self.start_passive_server()
 
-        # Determine NAT type.
-        if self.nat_type == "unknown":
-            self.debug_print("Determining NAT type.")
-            nat_type = self.rendezvous.determine_nat()
-            if nat_type is not None and nat_type != "unknown":
-                self.nat_type = nat_type
-                self.rendezvous.nat_type = nat_type
-                self.debug_print("NAT type = " + nat_type)
-            else:
-                self.debug_print("Unable to determine NAT type.")
-
-        # Check NAT type if node is simultaneous
-        # is manually specified.
-        if self.node_type == "simultaneous":
-            if self.nat_type not in self.rendezvous.predictable_nats:
-                self.debug_print("Manual setting of simultanous specified but ignored since NAT does not support it.")
-                self.node_type = "active"
-        else:
-            # Determine node type.
-            self.debug_print("Determining node type.")
+        # Use details saved by the last start() on this network.
+        if len(self.apply_profile()):
+            self.debug_print("Using saved connectivity profile.")
 
-            # No checks for manually specifying passive
-            # (there probably should be.)
-            if self.node_type == "unknown":
-                self.node_type = self.determine_node()
-
-
-        # Prevent P2P nodes from running as simultaneous.
-        if self.net_type == "p2p":
-            """
-            TCP hole punching is reserved specifically for direct networks (a net object reserved for receiving direct connections -- p2p is for connecting to the main network. The reason for this is you can't do multiple TCP hole punches at the same time so its reserved for direct network where it's most needed.
-            """
-            if self.node_type == "simultaneous":
-                self.debug_print("Simultaneous is not allowed for P2P")
-                self.node_type = "active"
-                self.disable_simultaneous()
+        # Determine NAT type.
+        self.determine_nat()
 
+        # Determine node type.
+        self.node_type = self.select_node_type(self.node_type)
         self.debug_print("Node type = " + self.node_type)
 
         # Close stray cons from determine_node() tests.
@@ -712,6 +1302,44 @@ class Net():
             wan_ip=self.wan_ip
         )
 
+        # Check saved details in the background (or save new ones.)
+        if len(self.profile_fields):
+            self.profile_thread = Thread(
+                target=self.revalidate_profile
+            )
+            self.profile_thread.daemon = True
+            self.profile_thread.start()
+        else:
+            self.save_profile()
+
+        # Nestled calls.
+        return self
+
+    def start_background(self):
+        # LAN connections can be accepted straight away.
+        self.start_passive_server()
+
+        # Use details saved by the last start() on this network.
+        if len(self.apply_profile()):
+            self.debug_print("Using saved connectivity profile.")
+
+        # Run as active until the real node type is known.
+        node_type = self.node_type
+        if self.node_type == "unknown":
+            self.node_type = "active"
+        self.is_net_started = 1
+        self.unl = UNL(
+            net=self,
+            dht_node=self.dht_node,
+            wan_ip=self.wan_ip
+        )
+
+        self.start_thread = Thread(
+            target=self.run_start_phases, args=(node_type,)
+        )
+        self.start_thread.daemon = True
+        self.start_thread.start()
+
         # Nestled calls.
         return self
 
@@ -719,12 +1347,19 @@ class Net():
         self.debug_print("Stopping networking.")
 
         if self.passive is not None:
+            if self.event_loop is not None:
+                self.event_loop.unregister(self.passive)
             self.passive.shutdown(1)
             self.passive.close()
             self.passive = None
 
         if self.last_advertise is not None:
             self.rendezvous.leave_fight()
+        self.rendezvous.session.close()
+
+        # Remove UPnP / NATPMP port mappings.
+        self.leases.close()
+        self.passive_lease = None
 
         """
         Just let the threads timeout by themselves.
@@ -736,13 +1371,23 @@ class Net():
         for con in self:
             con.close()
 
+        if self.event_loop is not None:
+            self.event_loop.close()
+            self.event_loop = None
+            self.event_server_con = None
+
         if signum is not None:
             raise Exception("Process was interrupted.")
 
     # Return a connection that matches a remote UNL.
     def con_by_unl(self, unl, cons=None):
         if cons is None:
-            cons = self.outbound + self.inbound
+            cons = self.cons_by_unl.get(unl, [])
+            if len(cons):
+                return cons[0]
+
+            return None
+
         for con in cons:
             if not isinstance(con, Sock):
                 con = con["con"]
@@ -762,31 +1407,36 @@ class Net():
 
     # Return a connection by its IP.
     def con_by_ip(self, ip):
-        for node in self.outbound + self.inbound:
+        for node in self.nodes_by_ip.get(ip, []):
             # Used to block UNLs until nonces are received.
             # Otherwise they might try do I/O and ruin their protocols.
             if self.net_type == "direct":
                 if node["con"].nonce == None:
                     continue
 
-            if node["ip"] == ip:
-                return node["con"]
+            return node["con"]
 
         return None
 
-    def generate_con_id(self, nonce, their_wan_ip, our_wan_ip):
+    def con_fingerprint(self, their_wan_ip, our_wan_ip):
+        # Memoized: the same IPs always give the same fingerprint.
+        key = (their_wan_ip, our_wan_ip)
+        fingerprint = self.con_fingerprints.get(key)
+        if fingerprint is not None:
+            return fingerprint
+
         # Convert WAN IPs to bytes.
         if sys.version_info >= (3, 0, 0):
             if type(their_wan_ip) == str:
                 their_wan_ip = their_wan_ip.encode("ascii")
 
-                if type(our_wan_ip) == str:
-                    our_wan_ip = our_wan_ip.encode("ascii")
+            if type(our_wan_ip) == str:
+                our_wan_ip = our_wan_ip.encode("ascii")
         else:
             if type(their_wan_ip) == unicode:
                 their_wan_ip = str(their_wan_ip)
 
-            if type(our_wan_ip) == our_wan_ip:
+            if type(our_wan_ip) == unicode:
                 our_wan_ip = str(our_wan_ip)
 
         # Hash WAN IPs to make them the same length.
@@ -803,6 +1453,16 @@ class Net():
             fingerprint = hashlib.sha256(their_wan_ip + our_wan_ip)
         fingerprint = fingerprint.hexdigest().encode("ascii")
 
+        # Keep the cache bounded.
+        if len(self.con_fingerprints) >= max_con_fingerprints:
+            self.con_fingerprints = {}
+        self.con_fingerprints[key] = fingerprint
+
+        return fingerprint
+
+    def generate_con_id(self, nonce, their_wan_ip, our_wan_ip):
+        fingerprint = self.con_fingerprint(their_wan_ip, our_wan_ip)
+
         # Convert nonce to bytes.
         if sys.version_info >= (3, 0, 0):
             if type(nonce) == str:
@@ -826,32 +1486,18 @@ class Net():
         return con_id
 
     def con_by_id(self, expected_id):
-        for node in self.outbound + self.inbound:
-            # Nothing to test.
-            if node["con"].nonce is None:
-                self.debug_print("Nonce not set")
-                continue
-
-            # Generate con_id from con.
-            try:
-                their_wan_ip, junk = node["con"].s.getpeername()
-            except:
-                continue
-            if is_ip_private(their_wan_ip):
-                our_wan_ip = get_lan_ip(self.interface)
-            else:
-                our_wan_ip = self.wan_ip
-            found_id = self.generate_con_id(
-                node["con"].nonce,
-                their_wan_ip,
-                our_wan_ip
-            )
+        # IDs depend on our WAN IP so redo them if it changed.
+        if self.con_id_wan_ip != self.wan_ip:
+            for node in self.outbound + self.inbound:
+                self.index_con_id(node["con"])
+            self.con_id_wan_ip = self.wan_ip
 
-            # Check result.
-            if found_id == expected_id:
-                return node["con"]
+        # Closed cons have no ID.
+        con = self.cons_by_id.get(expected_id)
+        if con is None or con.s is None:
+            return None
 
-        return None
+        return con
 
     # Send a message to all currently established connections.
     def broadcast(self, msg, source_con=None):
@@ -859,6 +1505,39 @@ class Net():
             if node["con"] != source_con:
                 node["con"].send_line(msg)
 
+    def queue_broadcast(self, msg, source_con=None):
+        """
+        Non-blocking broadcast. The line is encoded and framed once and
+        the same immutable buffer is added to every con's send queue
+        (flushed by poll / synchronize.) Cons that are paused for
+        backpressure or can't take the message are skipped.
+
+        Returns {"accepted": [cons], "skipped": [cons]}.
+        """
+        # Encode + frame once for every peer.
+        if sys.version_info >= (3,0,0):
+            if type(msg) == str:
+                msg = msg.encode("ascii")
+            data = bytes(msg) + b"\r\n"
+        else:
+            data = str(msg) + "\r\n"
+
+        results = {
+            "accepted": [],
+            "skipped": []
+        }
+        for node in self.outbound + self.inbound:
+            con = node["con"]
+            if con == source_con:
+                continue
+
+            if con.send_paused or not con.queue_send(data):
+                results["skipped"].append(con)
+            else:
+                results["accepted"].append(con)
+
+        return results
+
     def close_cons(self):
         # Close all connections.
         for node in self.inbound + self.outbound:
@@ -866,243 +1545,385 @@ class Net():
 
         # Flush client queue for passive server.
         if self.node_type == "passive" and self.passive is not None:
+            if self.event_loop is not None:
+                self.event_loop.unregister(self.passive)
             self.passive.close()
             self.start_passive_server()
 
         # Start from scratch.
-        self.inbound = []
-        self.outbound = []
+        for node in self.inbound + self.outbound:
+            self.remove_connection(node)
+
+    def receive_nonce(self, con):
+        # Receive nonce part.
+        if len(con.nonce_buf) < 64:
+            assert(con.blocking != 1)
+            remaining = 64 - len(con.nonce_buf)
+            nonce_part = con.recv(remaining)
+            if len(nonce_part):
+                con.nonce_buf += nonce_part
+
+        # Set nonce.
+        if len(con.nonce_buf) == 64:
+            con.nonce = con.nonce_buf
+
+    def accept_inbound(self):
+        # Accept a new con from the listen queue.
+        client, address = self.passive.accept()
+        con = Sock(blocking=0)
+        con.set_sock(client)
+        node_ip, node_port = con.s.getpeername()
+
+        # Reject duplicate connections.
+        if self.validate_node(node_ip, node_port):
+            node = {
+                "type": "accept",
+                "con": con,
+                "ip": con.s.getpeername()[0],
+                "port": con.s.getpeername()[1],
+            }
+            self.add_connection(node, self.inbound)
+            self.debug_print("Accepted new passive connection: " + str(node))
+        else:
+            con.close()
 
-    def synchronize(self):
-        # Clean up dead connections.
-        for node_list_name in ["self.inbound", "self.outbound"]:
-            node_list = eval(node_list_name)[:]
-            for node in node_list:
-                if not node["con"].connected:
-                    self.debug_print("\a")
-                    self.debug_print("Removing disconnected: " + str(node))
-                    eval(node_list_name).remove(node)
-
-        # Timeout connections that haven't responded to reverse query.
-        old_reverse_queries = []
-        for reverse_query in self.pending_reverse_queries:
-            duration = time.time() - reverse_query["timestamp"]
-            if duration >= self.reverse_query_expiry:
-                reverse_query["con"].close()
-                old_reverse_queries.append(reverse_query)
-
-        # Remove old reverse queries.
-        for reverse_query in old_reverse_queries:
-            self.pending_reverse_queries.remove(reverse_query)
+    def accept_simultaneous(self):
+        """
+        This is basically the code that passive simultaneous
+        nodes periodically call to parse any responses from the
+        Rendezvous Server which should hopefully be new
+        requests to initiate hole punching from active
+        simultaneous nodes.
+
+        If a challenge comes in, the passive simultaneous
+        node accepts the challenge by giving details to the
+        server for the challenging node (active simultaneous)
+        to complete the simultaneous open.
+        """
 
-        # Get connection nonce (for building IDs.)
-        if self.net_type == "direct":
-            for node in self.inbound + self.outbound:
-                if node["con"].nonce != None:
+        # try:
+        t = time.time()
+        if self.rendezvous.server_con is not None:
+            for reply in self.rendezvous.server_con:
+                # Reconnect.
+                if re.match("^RECONNECT$", reply) is not None:
+                    if self.enable_advertise:
+                        self.rendezvous.simultaneous_listen()
+                    continue
+
+                # Find any challenges.
+                # CHALLENGE 192.168.0.1 50184 50185 50186 50187 TCP
+                parts = re.findall(r"^CHALLENGE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP)$", reply)
+                if not len(parts):
                     continue
+                (candidate_ip, candidate_predictions, candidate_proto) = parts[0]
 
-                # Receive nonce part.
-                if len(node["con"].nonce_buf) < 64:
-                    assert(node["con"].blocking != 1)
-                    remaining = 64 - len(node["con"].nonce_buf)
-                    nonce_part = node["con"].recv(remaining)
-                    if len(nonce_part):
-                        node["con"].nonce_buf += nonce_part
+                # Already connected.
+                if not self.validate_node(candidate_ip):
+                    continue
 
-                # Set nonce.
-                if len(node["con"].nonce_buf) == 64:
-                    node["con"].nonce = node["con"].nonce_buf
+                # Last meeting was too recent.
+                if not self.scheduler.is_due("sim open", t):
+                    continue
 
-        # Check for reverse connect requests.
-        if self.dht_node is not None and self.net_type == "direct":
-            # Don't do this every synch cycle.
-            t = time.time()
-            skip_dht_check = 0
-            if self.last_dht_msg is not None:
-                if t - self.last_dht_msg > dht_msg_interval:
-                    skip_dht_check = 1
-
-            if not skip_dht_check and len(self.dht_messages):
-                processed = []
-                for dht_response in self.dht_messages:
-                    # Found reverse connect request.
-                    msg = str(dht_response["message"])
-                    if re.match("^REVERSE_CONNECT:[a-zA-Z0-9+/-=_\s]+:[a-fA-F0-9]{64}$", msg) is not None:
-                        call, their_unl, nonce = msg.split(":")
-                        their_unl = UNL(value=their_unl).deconstruct()
-                        node_id = their_unl["node_id"]
-
-                        # Ask if the source sent it.
-                        def success_builder():
-                            def success(con):
-                                # Indicate status.
-                                self.debug_print("Received reverse connect notice")
-                                self.debug_print(nonce)
-
-                                # Did you send this?
-                                query = "REVERSE_QUERY:" + self.unl.value
-                                self.dht_node.relay_message(node_id, query)
-
-                                # Record pending query state.
-                                query = {
-                                    "unl": their_unl["value"],
-                                    "con": con,
-                                    "timestamp": time.time()
-                                }
-                                self.pending_reverse_queries.append(query)
-
-                            return success
-
-                        self.debug_print("Attempting to do reverse connect")
-                        self.unl.connect(their_unl["value"], {"success": success_builder()}, nonce=nonce)
+                # Accept challenge.
+                our_ntp = get_ntp()
+                if our_ntp is None:
+                    continue
+                msg = "ACCEPT %s %s TCP %s" % (
+                    candidate_ip,
+                    self.rendezvous.predictions,
+                    str(our_ntp)
+                )
+                ret = self.rendezvous.server_con.send_line(msg)
+                if not ret:
+                    continue
 
-                        processed.append(dht_response)
+                """
+                Adding threading here doesn't work because Python's
+                fake threads and the act of starting a thread ruins
+                the timing between code synchronisation - especially
+                code running on the same host or in a LAN. Will
+                compensate by reducing the NTP delay to have the
+                meetings occur faster and setting a limit for meetings
+                to occur within the same period.
+                """
+                # Walk to fight and return holes made.
+                self.last_passive_sim_open = t
+                self.scheduler.schedule("sim open", sim_open_interval)
+                con = self.rendezvous.attend_fight(
+                    self.rendezvous.mappings, candidate_ip,
+                    candidate_predictions, our_ntp, passive_sim=1
+                )
+                if con is not None:
+                    node = {
+                        "type": "simultaneous",
+                        "con": con,
+                        "ip": con.s.getpeername()[0],
+                        "port": con.s.getpeername()[1],
+                    }
+                    self.add_connection(node, self.inbound)
+
+                # Create new predictions ready to accept next client.
+                self.rendezvous.simultaneous_cons = []
+                if self.enable_advertise:
+                    self.rendezvous.simultaneous_listen()
+
+
+    # Watch a connection for replies with the event loop.
+    def register_con(self, con):
+        if not con.connected or self.event_loop.is_registered(con):
+            return
+
+        write = None
+        if len(con.send_queue):
+            write = self.on_con_writable
+
+        if self.event_loop.register(con, read=self.on_con_readable, write=write):
+            con.add_close_handler(self.event_loop.unregister)
+
+    # A con's outbound queue went from empty to non-empty.
+    def on_con_send_queued(self, con):
+        if self.event_loop is not None and self.event_loop.is_registered(con):
+            self.event_loop.set_write(con, self.on_con_writable)
+        else:
+            self.pending_send_cons.add(con)
+
+    def on_con_writable(self, con):
+        con.flush()
+
+        # Stop waiting for writability once the queue is empty.
+        if not len(con.send_queue) and self.event_loop.is_registered(con):
+            self.event_loop.set_write(con, None)
+
+    def on_con_readable(self, con):
+        # Direct cons must send their nonce before anything else.
+        if self.net_type == "direct" and con.nonce is None:
+            self.receive_nonce(con)
+            return
+
+        con.reply_filter = self.filter_msg_check
+        for reply in con:
+            for handler in list(self.reply_handlers):
+                handler(con, reply)
+
+        # Stop watching dead cons.
+        if not con.connected:
+            self.event_loop.unregister(con)
+
+    def on_passive_readable(self, passive):
+        if len(self.inbound) < self.max_inbound:
+            self.accept_inbound()
+
+    def on_server_con_readable(self, server_con):
+        if self.node_type == "simultaneous":
+            self.accept_simultaneous()
+
+    def poll(self, timeout=None):
+        """
+        Event driven alternative to iterating over the Net object.
+        Waits up to timeout seconds for any connection, the passive
+        server, or the rendezvous server to have data then processes
+        only those sockets. Replies are passed to the handlers
+        added with add_reply_handler(). It never sleeps past the next
+        scheduled task (bootstrap, advertise, etc.) or idle_poll_timeout
+        when nothing is scheduled so it can be called in a loop with
+        timeout=None.
+        """
+        if self.event_loop is None:
+            self.event_loop = EventLoop()
+            if self.passive is not None:
+                self.event_loop.register(self.passive, read=self.on_passive_readable)
+
+            for node in self.inbound + self.outbound:
+                self.register_con(node["con"])
+
+        # Only accept when there's a free inbound slot.
+        if self.passive is not None:
+            if len(self.inbound) < self.max_inbound:
+                self.event_loop.set_read(self.passive, self.on_passive_readable)
+            else:
+                self.event_loop.set_read(self.passive, None)
+
+        # The rendezvous con is replaced when relisting.
+        server_con = self.rendezvous.server_con
+        if server_con is not self.event_server_con:
+            if self.event_server_con is not None:
+                self.event_loop.unregister(self.event_server_con)
+            self.event_server_con = None
+            if server_con is not None and server_con.connected:
+                if self.event_loop.register(server_con, read=self.on_server_con_readable):
+                    self.event_server_con = server_con
+
+        # Sleep until the next scheduled task at most.
+        wait = self.scheduler.time_until_next()
+        if wait is None and timeout is None:
+            wait = idle_poll_timeout
+        if wait is not None and (timeout is None or wait < timeout):
+            timeout = wait
+
+        self.event_loop.poll(timeout)
+
+        # The handlers already accepted and read whatever was ready so
+        # only do the bookkeeping they reported (no per-tick selects.)
+        if len(self.pending_send_cons):
+            self.flush_pending_sends()
+        if len(self.closed_cons):
+            self.reap_closed_cons()
+
+        # Reverse query timeouts, DHT messages, etc.
+        self.scheduler.run_due()
+        self.update_inbound_full()
+
+        # Both return straight away unless they're due.
+        self.bootstrap()
+        self.advertise()
+
+        return self
 
-                    # Found reverse query (did you make this?)
-                    elif re.match("^REVERSE_QUERY:[a-zA-Z0-9+/-=_\s]+$", msg) is not None:
-                        self.debug_print("Received reverse query")
-                        call, their_unl = msg.split(":")
-                        their_unl = UNL(value=their_unl).deconstruct()
-                        node_id = their_unl["node_id"]
-                        query = "REVERSE_ORIGIN:" + self.unl.value
+    def filter_msg_check(self, msg):
+        # Allow duplicate replies?
+        record_seen = not self.enable_duplicates
+
+        # Check if message is old.
+        return not self.seen_messages.check(msg, record_seen)
+
+    def process_dht_messages(self):
+        # Check for reverse connect requests.
+        if not len(self.dht_messages):
+            return
+
+        processed = []
+        for dht_response in self.dht_messages:
+            # Found reverse connect request.
+            msg = str(dht_response["message"])
+            if re.match(r"^REVERSE_CONNECT:[a-zA-Z0-9+/-=_\s]+:[a-fA-F0-9]{64}$", msg) is not None:
+                call, their_unl, nonce = msg.split(":")
+                their_unl = UNL(value=their_unl).deconstruct()
+                node_id = their_unl["node_id"]
+
+                # Ask if the source sent it.
+                def success_builder():
+                    def success(con):
+                        # Indicate status.
+                        self.debug_print("Received reverse connect notice")
+                        self.debug_print(nonce)
+
+                        # Did you send this?
+                        query = "REVERSE_QUERY:" + self.unl.value
                         self.dht_node.relay_message(node_id, query)
 
+                        # Record pending query state.
+                        query = {
+                            "unl": their_unl["value"],
+                            "con": con,
+                            "timestamp": time.time()
+                        }
+                        self.add_reverse_query(query)
+
+                    return success
+
+                self.debug_print("Attempting to do reverse connect")
+                self.unl.connect(their_unl["value"], {"success": success_builder()}, nonce=nonce)
+
+                processed.append(dht_response)
+
+            # Found reverse query (did you make this?)
+            elif re.match(r"^REVERSE_QUERY:[a-zA-Z0-9+/-=_\s]+$", msg) is not None:
+                self.debug_print("Received reverse query")
+                call, their_unl = msg.split(":")
+                their_unl = UNL(value=their_unl).deconstruct()
+                node_id = their_unl["node_id"]
+                query = "REVERSE_ORIGIN:" + self.unl.value
+                self.dht_node.relay_message(node_id, query)
+
+                processed.append(dht_response)
+
+
+            # Found reverse origin (yes I made this.)
+            elif re.match(r"^REVERSE_ORIGIN:[a-zA-Z0-9+/-=_\s]+$", msg) is not None:
+                self.debug_print("Received reverse origin")
+                for reverse_query in self.pending_reverse_queries[:]:
+                    pattern = "^REVERSE_ORIGIN:" + reverse_query["unl"]
+                    pattern += "$"
+                    if re.match(pattern, msg) is not None:
+                        self.debug_print("Removing pending reverse query: success!")
+                        self.pending_reverse_queries.remove(reverse_query)
                         processed.append(dht_response)
 
+        # Remove processed messages.
+        for msg in processed:
+            self.debug_print(msg)
+            self.dht_messages.remove(msg)
 
-                    # Found reverse origin (yes I made this.)
-                    elif re.match("^REVERSE_ORIGIN:[a-zA-Z0-9+/-=_\s]+$", msg) is not None:
-                        self.debug_print("Received reverse origin")
-                        for reverse_query in self.pending_reverse_queries:
-                            pattern = "^REVERSE_ORIGIN:" + reverse_query["unl"]
-                            pattern += "$"
-                            if re.match(pattern, msg) is not None:
-                                self.debug_print("Removing pending reverse query: success!")
-                                self.pending_reverse_queries.remove(reverse_query)
-                                processed.append(dht_response)
+        self.last_dht_msg = time.time()
 
-                # Remove processed messages.
-                for msg in processed:
-                    self.debug_print(msg)
-                    self.dht_messages.remove(msg)
+    # Send queued data for cons not watched by the event loop.
+    def flush_pending_sends(self):
+        for con in list(self.pending_send_cons):
+            if con.connected:
+                con.flush()
 
-            self.last_dht_msg = t
+            if not len(con.send_queue) or not con.connected:
+                self.pending_send_cons.discard(con)
+
+    # Clean up connections reported closed by on_con_closed.
+    def reap_closed_cons(self):
+        for con in list(self.closed_cons):
+            node = self.node_by_con.get(con)
+            self.closed_cons.discard(con)
+            if node is not None:
+                self.debug_print("\a")
+                self.debug_print("Removing disconnected: " + str(node))
+                self.remove_connection(node)
+
+    # QUIT - remove us from bootstrapping server.
+    # (Only when we become full, not every time.)
+    def update_inbound_full(self):
+        if len(self.inbound) >= self.max_inbound:
+            if not self.inbound_full:
+                self.inbound_full = 1
+                try:
+                    # Remove advertise.
+                    self.rendezvous.leave_fight()
+                except:
+                    pass
+        else:
+            self.inbound_full = 0
+
+    def synchronize(self):
+        self.flush_pending_sends()
+        self.reap_closed_cons()
+
+        # Timeout unanswered reverse queries and check DHT messages.
+        self.scheduler.run_due()
+
+        # Get connection nonce (for building IDs.)
+        # Only cons with data waiting are read.
+        if self.net_type == "direct" and len(self.nonce_pending):
+            cons = [con for con in self.nonce_pending if con.s is not None]
+            try:
+                r, w, e = select.select(cons, [], [], 0)
+            except (select.error, ValueError):
+                r = cons
+
+            for con in r:
+                self.receive_nonce(con)
 
         # Accept inbound connections.
         if len(self.inbound) < self.max_inbound:
             # Accept new passive inbound connections.
             if self.passive is not None:
                 r, w, e = select.select([self.passive], [], [], 0)
-                for s in r:
-                    if s == self.passive:
-                        # Accept a new con from the listen queue.
-                        client, address = self.passive.accept()
-                        con = Sock(blocking=0)
-                        con.set_sock(client)
-                        node_ip, node_port = con.s.getpeername()
-
-                        # Reject duplicate connections.
-                        if self.validate_node(node_ip, node_port):
-                            node = {
-                                "type": "accept",
-                                "con": con,
-                                "ip": con.s.getpeername()[0],
-                                "port": con.s.getpeername()[1],
-                            }
-                            self.inbound.append(node)
-                            self.debug_print("Accepted new passive connection: " + str(node))
-                        else:
-                            con.close()
+                for sock in r:
+                    if sock == self.passive:
+                        self.accept_inbound()
 
             # Accept new passive simultaneous connections.
             if self.node_type == "simultaneous":
-                """
-                This is basically the code that passive simultaneous
-                nodes periodically call to parse any responses from the
-                Rendezvous Server which should hopefully be new
-                requests to initiate hole punching from active
-                simultaneous nodes.
-
-                If a challenge comes in, the passive simultaneous
-                node accepts the challenge by giving details to the
-                server for the challenging node (active simultaneous)
-                to complete the simultaneous open.
-                """
+                self.accept_simultaneous()
 
-                # try:
-                t = time.time()
-                if self.rendezvous.server_con is not None:
-                    for reply in self.rendezvous.server_con:
-                        # Reconnect.
-                        if re.match("^RECONNECT$", reply) is not None:
-                            if self.enable_advertise:
-                                self.rendezvous.simultaneous_listen()
-                            continue
-
-                        # Find any challenges.
-                        # CHALLENGE 192.168.0.1 50184 50185 50186 50187 TCP
-                        parts = re.findall("^CHALLENGE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP)$", reply)
-                        if not len(parts):
-                            continue
-                        (candidate_ip, candidate_predictions, candidate_proto) = parts[0]
-
-                        # Already connected.
-                        if not self.validate_node(candidate_ip):
-                            continue
-
-                        # Last meeting was too recent.
-                        if t - self.last_passive_sim_open < sim_open_interval:
-                            continue
-
-                        # Accept challenge.
-                        our_ntp = get_ntp()
-                        if our_ntp is None:
-                            continue
-                        msg = "ACCEPT %s %s TCP %s" % (
-                            candidate_ip,
-                            self.rendezvous.predictions,
-                            str(our_ntp)
-                        )
-                        ret = self.rendezvous.server_con.send_line(msg)
-                        if not ret:
-                            continue
-
-                        """
-                        Adding threading here doesn't work because Python's
-                        fake threads and the act of starting a thread ruins
-                        the timing between code synchronisation - especially
-                        code running on the same host or in a LAN. Will
-                        compensate by reducing the NTP delay to have the
-                        meetings occur faster and setting a limit for meetings
-                        to occur within the same period.
-                        """
-                        # Walk to fight and return holes made.
-                        self.last_passive_sim_open = t
-                        con = self.rendezvous.attend_fight(
-                            self.rendezvous.mappings, candidate_ip,
-                            candidate_predictions, our_ntp, passive_sim=1
-                        )
-                        if con is not None:
-                            node = {
-                                "type": "simultaneous",
-                                "con": con,
-                                "ip": con.s.getpeername()[0],
-                                "port": con.s.getpeername()[1],
-                            }
-                            self.inbound.append(node)
-
-                        # Create new predictions ready to accept next client.
-                        self.rendezvous.simultaneous_cons = []
-                        if self.enable_advertise:
-                            self.rendezvous.simultaneous_listen()
-
-        # QUIT - remove us from bootstrapping server.
-        if len(self.inbound) == self.max_inbound:
-            try:
-                # Remove advertise.
-                self.rendezvous.leave_fight()
-            except:
-                pass
+        self.update_inbound_full()
 
         # Bootstrap again if needed.
         self.bootstrap()
@@ -1124,18 +1945,6 @@ class Net():
         # Process connections.
         self.synchronize()
 
-        # Filter(): Remove undesirable messages from replies.
-        # Save message: 0 = no, 1 = yes.
-        def filter_msg_check_builder():
-            def filter_msg_check(msg):
-                # Allow duplicate replies?
-                record_seen = not self.enable_duplicates
-
-                # Check if message is old.
-                return not is_msg_old(msg, record_seen)
-
-            return filter_msg_check
-
         # Copy all connections to single buffer.
         cons = []
         for node in self.inbound + self.outbound:
@@ -1149,7 +1958,7 @@ class Net():
         # (if enabled)
         for con in cons:
             if con is not None:
-                con.reply_filter = filter_msg_check_builder()
+                con.reply_filter = self.filter_msg_check
 
         # Return all cons.
         return iter(cons)
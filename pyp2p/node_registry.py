@@ -0,0 +1,88 @@
+"""
+Node tables for the rendezvous server.
+
+BOOTSTRAP used to copy every registered IP into a list and remove
+the chosen ones from it, which is O(n) per request (O(n^2) with the
+removes) in the number of registered nodes. NodeRegistry keeps the
+IPs in a dense list with an IP -> position dict next to it: inserts
+append, deletes swap the last IP into the hole and sampling picks
+random positions, so all three are O(1) per node no matter how many
+nodes are registered.
+
+It behaves like the dict it replaces (nodes[ip], ip in nodes,
+del nodes[ip], len(nodes), iteration.)
+"""
+
+import random
+
+
+class NodeRegistry():
+    def __init__(self, rand=random):
+        self.rand = rand
+
+        # Dense list of keys + key -> position in it.
+        self.keys = []
+        self.positions = {}
+
+        # Key -> node details.
+        self.values = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.values:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        # Move the last key into the hole.
+        position = self.positions.pop(key)
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self.positions[last] = position
+        del self.values[key]
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def items(self):
+        return [(key, self.values[key]) for key in self.keys]
+
+    def sample(self, n, skip=None):
+        """
+        Returns up to n distinct keys chosen uniformly at random.
+        Keys where skip(key, value) is true aren't returned (and don't
+        count towards n.) Costs O(n + skipped) however many keys are
+        registered.
+        """
+        # Partial Fisher-Yates shuffle over the key list. Swaps are
+        # kept in a dict so the list itself isn't touched.
+        keys = self.keys
+        size = len(keys)
+        swaps = {}
+        chosen = []
+        i = 0
+        while len(chosen) < n and i < size:
+            j = self.rand.randrange(i, size)
+            picked = swaps.get(j, j)
+            swaps[j] = swaps.get(i, i)
+            i += 1
+
+            key = keys[picked]
+            if skip is not None and skip(key, self.values[key]):
+                continue
+            chosen.append(key)
+
+        return chosen
@@ -38,13 +38,146 @@ import sys
 import ntplib
 import datetime
 import random
+import threading
+import select
 from multiprocessing.dummy import Pool
 
 from .sock import *
 from .lib import *
 
+class RendezvousSession():
+    """
+    A long lived connection to a rendezvous server for short commands
+    (PASSIVE READY, CLEAR, BOOTSTRAP, SOURCE TCP.) Commands are
+    pipelined - written together and their replies matched in order -
+    and the connection is re-established (and the commands retried)
+    if it has gone away. Commands without a reply can't detect a dead
+    connection themselves so the connection is checked for EOF before
+    it's reused and replaced once it has been idle for idle_timeout
+    seconds (servers drop idle clients.) Commands that need their own
+    source port
+    (NAT tests) or that register for challenges (simultaneous_listen)
+    still use their own connections.
+    """
+
+    # Commands that get a reply and what the reply looks like.
+    reply_patterns = [
+        ("BOOTSTRAP", "^NODES"),
+        ("SOURCE TCP", "^REMOTE (TCP|UDP) ")
+    ]
+
+    def __init__(self, client, timeout=5, retries=1, idle_timeout=60):
+        self.client = client
+        self.timeout = timeout
+        self.retries = retries
+        self.idle_timeout = idle_timeout
+        self.con = None
+        self.connects = 0
+        self.last_used = None
+        self.lock = threading.RLock()
+
+    def reply_pattern(self, line):
+        for command, pattern in self.reply_patterns:
+            if line.startswith(command):
+                return pattern
+
+        return None
+
+    def is_stale(self):
+        con = self.con
+        if con is None or not con.connected or con.s is None:
+            return 1
+
+        # Idle long enough that the server may have dropped it.
+        if self.last_used is not None:
+            if time.time() - self.last_used >= self.idle_timeout:
+                return 1
+
+        # Readable with nothing to read = the server closed it.
+        try:
+            r, w, e = select.select([con.s], [], [], 0)
+            if len(r):
+                return not len(con.s.recv(1, socket.MSG_PEEK))
+        except (select.error, socket.error, ValueError):
+            return 1
+
+        return 0
+
+    def connect(self):
+        with self.lock:
+            if self.is_stale():
+                self.close()
+                self.con = self.client.server_connect(binary=1)
+                self.connects += 1
+            self.last_used = time.time()
+
+            return self.con
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def exchange(self, lines, timeout):
+        con = self.connect()
+
+        # Write every command at once.
+        msg = u"".join([line + u"\r\n" for line in lines])
+        if con.send(msg, send_all=1, timeout=timeout) != len(msg):
+            raise Exception("Rendezvous session send failed.")
+
+        # Replies come back in the same order.
+        replies = []
+        for line in lines:
+            pattern = self.reply_pattern(line)
+            if pattern is None:
+                replies.append(None)
+                continue
+
+            future = time.time() + timeout
+            while 1:
+                remaining = future - time.time()
+                if remaining <= 0:
+                    raise Exception("Rendezvous session reply timeout.")
+
+                reply = con.recv_line(timeout=remaining)
+                if not con.connected:
+                    raise Exception("Rendezvous session closed.")
+
+                # Skip unrelated messages.
+                if re.match(pattern, reply) is not None:
+                    replies.append(reply)
+                    break
+
+        return replies
+
+    def pipeline(self, lines, timeout=None):
+        """
+        Sends lines as one write and returns their replies in the same
+        order (None for commands without a reply.) Raises an exception
+        if the server can't be reached after self.retries reconnects.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        with self.lock:
+            error = None
+            for attempt in range(0, self.retries + 1):
+                try:
+                    return self.exchange(lines, timeout)
+                except Exception as e:
+                    # Start over on a new connection.
+                    self.close()
+                    error = e
+
+            raise error
+
+    def request(self, line, timeout=None):
+        return self.pipeline([line], timeout)[0]
+
+
 class RendezvousClient:
-    def __init__(self, nat_type, rendezvous_servers, interface="default"):
+    def __init__(self, nat_type, rendezvous_servers, interface="default", cache_path=None):
         self.nat_type = nat_type
         self.delta = 0
         self.port_collisions = 1
@@ -61,35 +194,124 @@ class RendezvousClient:
         self.timeout = 5 # Socket timeout.
         self.predictable_nats = ["preserving", "delta"]
 
-    def server_connect(self, sock=None):
-        for server in self.rendezvous_servers:
-            try:
-                # Blank socket object.
-                con = Sock(
-                    blocking=1,
-                    interface=self.interface,
-                    timeout=2
-                )
+        # Connecting to rendezvous servers.
+        self.server_connect_timeout = 2
+        self.server_connect_stagger = 0.25
+
+        # (addr, port) -> {"rtt", "failures", "last_failure"}
+        self.server_stats = {}
+
+        # Shared connection for one line commands.
+        self.session = RendezvousSession(self)
+
+        # NAT tests: probe all mappings at once (falls back to one at
+        # a time if that fails.)
+        self.concurrent_nat_tests = 1
+        self.nat_test_timeout = 2
+
+        # Detected NAT types are cached per network (None disables.)
+        self.nat_cache = None
+        if cache_path is not None:
+            self.nat_cache = DiskCache(cache_path)
+        self.nat_cache_ttl = 24 * 60 * 60
+
+        # Whether every probe in the last detect_nat() got an answer.
+        self.nat_test_complete = 0
+
+    def record_server_result(self, addr, port, connected, rtt):
+        stats = self.server_stats.setdefault((addr, int(port)), {
+            "rtt": None,
+            "failures": 0,
+            "last_failure": None
+        })
+        if connected:
+            # Smoothed RTT (like TCP's SRTT.)
+            if stats["rtt"] is None:
+                stats["rtt"] = rtt
+            else:
+                stats["rtt"] = 0.875 * stats["rtt"] + 0.125 * rtt
+            stats["failures"] = 0
+        else:
+            stats["failures"] += 1
+            stats["last_failure"] = time.time()
 
-                # Pre-bound socket.
-                if sock != None:
+    def ordered_servers(self):
+        """
+        Rendezvous servers best first: fewest recent failures, then
+        lowest RTT. Servers without any history keep their configured
+        order after the ones known to work (but ahead of servers that
+        have failed.)
+        """
+        def key(item):
+            i, server = item
+            stats = self.server_stats.get((server["addr"], int(server["port"])))
+            if stats is None:
+                return (0, 1, 0, i)
+
+            rtt = stats["rtt"]
+            if rtt is None:
+                rtt = self.timeout
+            return (stats["failures"], 0, rtt, i)
+
+        servers = sorted(enumerate(self.rendezvous_servers), key=key)
+        return [server for i, server in servers]
+
+    def server_connect(self, sock=None, binary=0):
+        servers = self.ordered_servers()
+
+        # Pre-bound sockets can only be connected one at a time.
+        if sock != None:
+            for server in servers:
+                started = time.time()
+                try:
+                    # Blank socket object.
+                    con = Sock(
+                        blocking=1,
+                        interface=self.interface,
+                        timeout=2,
+                        binary=binary
+                    )
+
+                    # Pre-bound socket.
                     con.set_sock(sock)
 
-                # Connect the socket.
-                con.connect(server["addr"], server["port"])
-
-                # Return Sock object.
-                return con
-            except:
-                continue
+                    # Connect the socket.
+                    con.connect(server["addr"], server["port"])
+                    self.record_server_result(
+                        server["addr"], server["port"], 1,
+                        time.time() - started
+                    )
 
-        raise Exception("All rendezvous servers are down.")
+                    # Return Sock object.
+                    return con
+                except:
+                    self.record_server_result(
+                        server["addr"], server["port"], 0, None
+                    )
+                    continue
+
+            raise Exception("All rendezvous servers are down.")
+
+        # Race staggered connects to every server (best first.)
+        addrs = [(server["addr"], server["port"]) for server in servers]
+        connected = connect_many(
+            addrs, want=1, timeout=self.server_connect_timeout,
+            max_in_flight=len(addrs), interface=self.interface,
+            stagger=self.server_connect_stagger,
+            on_result=self.record_server_result
+        )
+        if not len(connected):
+            raise Exception("All rendezvous servers are down.")
+
+        # Return Sock object.
+        addr, port, s = connected[0]
+        con = Sock(blocking=1, interface=self.interface, timeout=2, binary=binary)
+        con.set_sock(s)
+        return con
 
     # Delete any old rendezvous server state for node.
     def leave_fight(self):
-        con = self.server_connect()
-        con.send_line("CLEAR")
-        con.close()
+        self.session.request("CLEAR")
         return 1
 
     def attend_fight(self, mappings, node_ip, predictions, ntp, passive_sim=0):
@@ -216,10 +438,8 @@ class RendezvousClient:
 
     def passive_listen(self, port, max_inbound=10):
         try:
-            con = self.server_connect()
             msg = "PASSIVE READY %s %s" % (str(port), str(max_inbound))
-            con.send_line(msg)
-            con.close()
+            self.session.request(msg)
             return 1
         except:
             return 0
@@ -544,20 +764,184 @@ http://www.researchgate.net/publication/239801764_Implementing_NAT_Traversal_on_
         # Already set.
         if self.nat_type != "unknown":
             return self.nat_type
+
+        # Detected before on this network.
+        cache_key = self.nat_cache_key()
+        if cache_key is not None:
+            cached = self.nat_cache.get(cache_key)
+            if cached is not None:
+                self.delta = cached["delta"]
+                return cached["nat_type"]
+
+        # Results from failed probes are only a guess: don't keep them.
+        nat_type = self.detect_nat()
+        if cache_key is not None and self.nat_test_complete:
+            self.nat_cache.set(cache_key, {
+                "nat_type": nat_type,
+                "delta": self.delta
+            }, self.nat_cache_ttl)
+
+        return nat_type
+
+    def nat_cache_key(self):
+        if self.nat_cache is None:
+            return None
+
+        network = network_fingerprint(self.interface)
+        if network is None:
+            return None
+
+        return "nat " + network
+
+    def probe_mappings(self, socks, timeout=2, server=None):
+        """
+        Asks a rendezvous server (the best one by default) for the
+        remote port of several pre-bound sockets at once. The connects
+        are started in the order given so a NAT that allocates mappings
+        sequentially sees the same order as it would with one probe at
+        a time, but the round trips overlap.
+
+        Returns a list of remote ports (0 where a probe failed.)
+        """
+        if server is None:
+            server = self.ordered_servers()[0]
+        addr = (server["addr"], int(server["port"]))
+        remote_ports = [0] * len(socks)
+        connecting = {} # Socket -> index.
+        reading = {} # Socket -> [index, buf.]
+
+        # Start the connects (in order.)
+        started = time.time()
+        future = started + timeout
+        for i in range(0, len(socks)):
+            s = socks[i]
+            s.setblocking(0)
+            try:
+                err = s.connect_ex(addr)
+            except socket.error:
+                continue
+
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                connecting[s] = i
+
+        # Send SOURCE TCP as each connect finishes and read replies.
+        rtt = None
+        while len(connecting) or len(reading):
+            remaining = future - time.time()
+            if remaining <= 0:
+                break
+
+            r, w, e = select.select(list(reading), list(connecting), [], remaining)
+            for s in w:
+                i = connecting.pop(s)
+                if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    continue
+
+                if rtt is None:
+                    rtt = time.time() - started
+
+                try:
+                    line = "SOURCE TCP " + str(s.getsockname()[1]) + "\r\n"
+                    s.sendall(line.encode("ascii"))
+                except socket.error:
+                    continue
+                reading[s] = [i, u""]
+
+            for s in r:
+                i, buf = reading[s]
+                try:
+                    data = s.recv(1024)
+                except socket.error:
+                    data = b""
+                if not data:
+                    del reading[s]
+                    continue
+
+                buf += data.decode("ascii", "ignore")
+                replies, buf, scanned = split_lines(buf)
+                if len(replies):
+                    remote_ports[i] = self.parse_remote_port(replies[0])
+                    del reading[s]
+                else:
+                    reading[s][1] = buf
+
+        self.record_server_result(
+            server["addr"], server["port"], rtt is not None, rtt
+        )
+
+        return remote_ports
+
+    def bind_reuse_mappings(self):
+        mappings = []
+        for i in range(0, self.nat_tests):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', 0))
+            mappings.append({
+                "source": sock.getsockname()[1],
+                "sock": sock
+            })
+
+        return mappings
+
+    def map_ports(self, bind):
+        """
+        Binds sockets with bind() and asks the rendezvous server for
+        the remote port of each one. A partial answer is no good for
+        the NAT tests so if any probe fails the whole set is probed
+        again against the next server with fresh sockets (a socket
+        can't connect twice) and finally one at a time.
+
+        Mappings that still failed have a remote port of 0 and clear
+        self.nat_test_complete (raises if every probe failed.)
+        """
+        if self.concurrent_nat_tests:
+            for server in self.ordered_servers():
+                mappings = bind()
+                socks = [mapping["sock"] for mapping in mappings]
+                remote_ports = self.probe_mappings(
+                    socks, self.nat_test_timeout, server
+                )
+                for i in range(0, len(mappings)):
+                    mappings[i]["remote"] = int(remote_ports[i])
+                    mappings[i]["sock"].close()
+                if all(remote_ports):
+                    return mappings
+
+        mappings = bind()
+        for mapping in mappings:
+            try:
+                con = self.server_connect(mapping["sock"])
+                con.send_line("SOURCE TCP " + str(mapping["source"]))
+                remote_port = self.parse_remote_port(con.recv_line(timeout=2))
+                con.s.close()
+            except Exception as e:
+                mapping["sock"].close()
+                remote_port = 0
+            mapping["remote"] = int(remote_port)
+
+        remote_ports = [mapping["remote"] for mapping in mappings]
+        if not any(remote_ports):
+            raise Exception("All rendezvous servers are down.")
+        if not all(remote_ports):
+            self.nat_test_complete = 0
+
+        return mappings
+
+    def detect_nat(self):
         nat_type = "random"
 
+        # Cleared by map_ports if a probe fails.
+        self.nat_test_complete = 1
+
         # Check collision ration.
         if self.port_collisions * 5 > self.nat_tests:
             raise Exception("Port collision number is too high compared to nat tests. Collisions must be in ratio 1 : 5 to avoid ambiguity in test results.")
 
         # Load mappings for preserving and delta tests.
-        mappings = sequential_bind(self.nat_tests, self.interface)
-        for i in range(0, self.nat_tests):
-            con = self.server_connect(mappings[i]["sock"])
-            con.send_line("SOURCE TCP " + str(mappings[i]["source"]))
-            remote_port = self.parse_remote_port(con.recv_line(timeout=2))
-            mappings[i]["remote"] = int(remote_port)
-            con.s.close()
+        mappings = self.map_ports(
+            lambda: sequential_bind(self.nat_tests, self.interface)
+        )
 
         # Preserving test.
         preserving = 0
@@ -574,7 +958,7 @@ http://www.researchgate.net/publication/239801764_Implementing_NAT_Traversal_on_
             # Save delta value.
             self.delta = delta_ret["delta"]
 
-            return nat_type
+            return delta_ret["nat_type"]
 
         # Load mappings for reuse test.
         """
@@ -583,21 +967,7 @@ http://www.researchgate.net/publication/239801764_Implementing_NAT_Traversal_on_
         ports to each other because there are NAT types which
         allocate new mappings based on changes to these variables.
         """
-        mappings = []
-        for i in range(0, self.nat_tests):
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(('', 0))
-            con = Sock(blocking=1, interface=self.interface)
-            con.s = sock
-            source_port = con.s.getsockname()[1]
-            con = self.server_connect(sock)
-            con.send_line("SOURCE TCP " + str(source_port))
-            remote_port = self.parse_remote_port(con.recv_line(timeout=2))
-            mappings.append({
-                "source": source_port,
-                "remote": int(remote_port)
-            })
+        mappings = self.map_ports(self.bind_reuse_mappings)
         if len(mappings) < self.nat_tests:
             return nat_type
 
@@ -611,7 +981,6 @@ http://www.researchgate.net/publication/239801764_Implementing_NAT_Traversal_on_
 
         return nat_type
 
-
 if __name__ == "__main__":
     from pyp2p.net import rendezvous_servers
     client = RendezvousClient(nat_type="preserving", rendezvous_servers=rendezvous_servers)
@@ -0,0 +1,480 @@
+"""
+Runs the rendezvous server on several cores.
+
+A single Twisted reactor tops out at one core, so under connection
+churn the server is CPU bound long before the network is. This runs
+several worker processes that all accept on the same port with
+SO_REUSEPORT (the kernel spreads connections between them) while
+still acting as a single server with one node list.
+
+Node state is sharded by IP: the worker shard_of(ip) owns the
+registration, candidates and expiry timers for that IP. A connection
+can land on any worker, so lines that touch another shard are
+forwarded to the owner over a Unix socket between workers:
+
+    SIMULTANEOUS/PASSIVE READY, ACCEPT, CLEAR -> owner of the sender
+    CANDIDATE -> owner of the node being challenged
+    SOURCE TCP -> handled where it arrived
+
+The owner runs the normal RendezvousProtocol handler for the line on
+a RemoteProtocol that stands in for the connection, so anything it
+sends back (PREDICTION SET, CHALLENGE, FIGHT ...) is relayed to the
+worker that holds the real connection. BOOTSTRAP asks every shard for
+a sample and merges them weighted by shard size, so nodes are still
+picked uniformly from the whole network.
+
+Usage: python -m pyp2p.rendezvous_cluster [workers] [port]
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import zlib
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.internet.address import IPv4Address
+from twisted.protocols.basic import LineReceiver
+from twisted.internet import reactor
+from .lib import *
+from . import rendezvous_server
+from .rendezvous_server import *
+
+# Commands handled by the owner of the sender's IP.
+owned_commands = ["SIMULTANEOUS", "PASSIVE", "ACCEPT", "CLEAR"]
+
+
+def shard_of(ip_addr, worker_no):
+    # Same in every process (unlike hash().)
+    return (zlib.crc32(ip_addr.encode("utf-8")) & 0xffffffff) % worker_no
+
+
+def ipc_path(ipc_dir, worker_id):
+    return os.path.join(ipc_dir, "worker-%d.sock" % worker_id)
+
+
+class RemoteTransport():
+    # Just enough of a transport for the handlers.
+    def __init__(self, host, port):
+        self.peer = IPv4Address("TCP", host, port)
+
+    def getPeer(self):
+        return self.peer
+
+
+class RemoteProtocol(RendezvousProtocol):
+    """
+    Stands in for a connection held by another worker. Lines it
+    sends are relayed to that worker.
+    """
+    def __init__(self, factory, worker, con_id, host, port):
+        RendezvousProtocol.__init__(self, factory)
+        self.worker = worker
+        self.con_id = con_id
+        self.makeConnection(RemoteTransport(host, port))
+
+    def send_line(self, msg):
+        # Not connected.
+        if not self.connected:
+            return
+
+        if type(msg) == bytes:
+            msg = msg.decode("ascii")
+
+        self.factory.send(self.worker, {
+            "op": "send",
+            "con": self.con_id,
+            "line": msg
+        })
+
+
+class ClusterProtocol(RendezvousProtocol):
+    def connectionMade(self):
+        self.con_id = next(self.factory.con_ids)
+        self.factory.local_cons[self.con_id] = self
+
+        # Workers holding a RemoteProtocol for this connection.
+        self.owners = set()
+
+        RendezvousProtocol.connectionMade(self)
+
+        # The owner updates simultaneous nodes when they reconnect.
+        owner = self.factory.owner(self.peer.host)
+        if owner != self.factory.worker_id:
+            self.forward(owner, {"op": "opened"})
+
+    def connectionLost(self, reason):
+        RendezvousProtocol.connectionLost(self, reason)
+        self.factory.local_cons.pop(self.con_id, None)
+        for owner in self.owners:
+            self.factory.send(owner, {"op": "closed", "con": self.con_id})
+        self.owners = set()
+
+    def forward(self, worker, msg):
+        msg["con"] = self.con_id
+        msg["host"] = self.peer.host
+        msg["port"] = self.peer.port
+        self.owners.add(worker)
+        self.factory.send(worker, msg)
+
+    def route(self, line):
+        # Worker that owns the state a line touches.
+        command = line.split(" ", 1)[0]
+        if command in owned_commands:
+            return self.factory.owner(self.peer.host)
+
+        if command == "CANDIDATE":
+            match = CANDIDATE_LINE.match(line)
+            if match is not None:
+                return self.factory.owner(match.group(1))
+
+        return self.factory.worker_id
+
+    def lineReceived(self, line):
+        try:
+            text = line.decode("utf-8")
+        except:
+            # Received invalid characters.
+            return
+
+        try:
+            owner = self.route(text)
+            if owner == self.factory.worker_id:
+                return RendezvousProtocol.lineReceived(self, line)
+
+            self.forward(owner, {"op": "line", "line": text})
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(error_log_path, error)
+            rendezvous_server.log.error("ERROR = " + error, self.peer)
+
+    def handle_bootstrap(self, match):
+        n = int(match.group(1))
+
+        # Invalid number.
+        if n < 1 or n > 100:
+            return
+
+        self.factory.bootstrap(self, n)
+
+    commands = dict(RendezvousProtocol.commands)
+    commands["BOOTSTRAP"] = (BOOTSTRAP_LINE, handle_bootstrap)
+
+
+class ClusterFactory(RendezvousFactory):
+    """
+    One worker's shard of the node list. links maps every other
+    worker ID to an object with send_message(msg).
+    """
+    def __init__(self, worker_id, worker_no, reactor=reactor, rand=random):
+        RendezvousFactory.__init__(self, reactor)
+        self.worker_id = worker_id
+        self.worker_no = worker_no
+        self.links = {}
+        self.rand = rand
+
+        # Our connections by ID + stand-ins for other workers'.
+        self.con_ids = itertools.count()
+        self.local_cons = {}
+        self.remote_cons = {}
+
+        # BOOTSTRAPs waiting on other shards.
+        self.request_ids = itertools.count()
+        self.requests = {}
+        self.bootstrap_timeout = 2
+
+        self.handlers = {
+            "opened": self.handle_opened,
+            "line": self.handle_line,
+            "closed": self.handle_closed,
+            "send": self.handle_send,
+            "sample": self.handle_sample,
+            "sampled": self.handle_sampled
+        }
+
+    def owner(self, ip_addr):
+        return shard_of(ip_addr, self.worker_no)
+
+    def send(self, worker, msg):
+        msg["from"] = self.worker_id
+        self.links[worker].send_message(msg)
+
+    def message_received(self, msg):
+        try:
+            handler = self.handlers.get(msg["op"])
+            if handler is not None:
+                handler(msg)
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(error_log_path, error)
+
+    def remote_con(self, msg):
+        key = (msg["from"], msg["con"])
+        protocol = self.remote_cons.get(key)
+        if protocol is None:
+            protocol = RemoteProtocol(
+                self, msg["from"], msg["con"], msg["host"], msg["port"]
+            )
+            self.remote_cons[key] = protocol
+
+        return protocol
+
+    def handle_opened(self, msg):
+        self.remote_con(msg)
+
+    def handle_line(self, msg):
+        self.remote_con(msg).lineReceived(msg["line"].encode("utf-8"))
+
+    def handle_closed(self, msg):
+        protocol = self.remote_cons.pop((msg["from"], msg["con"]), None)
+        if protocol is not None:
+            protocol.connectionLost(None)
+
+    def handle_send(self, msg):
+        protocol = self.local_cons.get(msg["con"])
+        if protocol is not None:
+            protocol.send_line(msg["line"])
+
+    def handle_sample(self, msg):
+        self.send(msg["from"], {
+            "op": "sampled",
+            "id": msg["id"],
+            "size": len(self.nodes["passive"]),
+            "nodes": self.sample_nodes("passive", msg["n"], msg["skip"])
+        })
+
+    def handle_sampled(self, msg):
+        request = self.requests.get(msg["id"])
+        if request is None:
+            return
+
+        request["replies"][msg["from"]] = (msg["size"], msg["nodes"])
+        if len(request["replies"]) == len(self.links) + 1:
+            self.finish_bootstrap(msg["id"])
+
+    def bootstrap(self, protocol, n):
+        # Sample every shard then reply from finish_bootstrap.
+        our_ip = protocol.peer.host
+        request_id = next(self.request_ids)
+        request = {
+            "protocol": protocol,
+            "n": n,
+            "replies": {
+                self.worker_id: (
+                    len(self.nodes["passive"]),
+                    self.sample_nodes("passive", n, our_ip)
+                )
+            },
+            "call": None
+        }
+        self.requests[request_id] = request
+        if not len(self.links):
+            return self.finish_bootstrap(request_id)
+
+        # Reply with what we have if a worker is slow.
+        request["call"] = self.reactor.callLater(
+            self.bootstrap_timeout, self.finish_bootstrap, request_id
+        )
+        for worker in list(self.links):
+            self.send(worker, {
+                "op": "sample",
+                "id": request_id,
+                "n": n,
+                "skip": our_ip
+            })
+
+    def merge_samples(self, replies, n):
+        """
+        Picks up to n nodes from per-shard (size, sample) replies.
+        Each pick comes from a shard with probability proportional to
+        the nodes it has left, which is a uniform sample of the whole
+        network.
+        """
+        pools = [[max(size, len(nodes)), list(nodes)] for size, nodes in replies]
+        chosen = []
+        while len(chosen) < n:
+            pools = [pool for pool in pools if len(pool[1])]
+            if not len(pools):
+                break
+
+            pick = self.rand.randrange(0, sum([pool[0] for pool in pools]))
+            for pool in pools:
+                if pick < pool[0]:
+                    break
+                pick -= pool[0]
+            pool[0] -= 1
+            chosen.append(pool[1].pop(0))
+
+        return chosen
+
+    def finish_bootstrap(self, request_id):
+        request = self.requests.pop(request_id, None)
+        if request is None:
+            return
+
+        call = request["call"]
+        if call is not None and call.active():
+            call.cancel()
+
+        # Bootstrap n passive.
+        msg = "NODES "
+        node_no = 0
+        nodes = self.merge_samples(request["replies"].values(), request["n"])
+        for ip_addr, port in nodes:
+            msg += "p:" + ip_addr + ":" + str(port) + " "
+            node_no += 1
+
+        # No nodes in response.
+        if not node_no:
+            msg = "NODES EMPTY"
+
+        request["protocol"].send_line(msg)
+
+    def buildProtocol(self, addr):
+        return ClusterProtocol(self)
+
+
+class IPCProtocol(LineReceiver):
+    # JSON messages between workers, one per line.
+    MAX_LENGTH = 1024 * 1024
+    delimiter = b"\n"
+
+    def __init__(self, cluster, link=None):
+        self.cluster = cluster
+        self.link = link
+
+    def connectionMade(self):
+        if self.link is not None:
+            self.link.link_up(self)
+
+    def connectionLost(self, reason):
+        if self.link is not None:
+            self.link.link_down(self)
+
+    def lineReceived(self, line):
+        self.cluster.message_received(json.loads(line.decode("utf-8")))
+
+
+class IPCServerFactory(Factory):
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def buildProtocol(self, addr):
+        return IPCProtocol(self.cluster)
+
+
+class IPCLink(ReconnectingClientFactory):
+    """
+    Outbound connection to another worker. Messages sent before it
+    connects (or while it reconnects) are queued.
+    """
+    initialDelay = 0.05
+    maxDelay = 1
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.protocol = None
+        self.queue = []
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return IPCProtocol(self.cluster, self)
+
+    def link_up(self, protocol):
+        self.protocol = protocol
+        queue = self.queue
+        self.queue = []
+        for line in queue:
+            protocol.sendLine(line)
+
+    def link_down(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+
+    def send_message(self, msg):
+        line = json.dumps(msg).encode("utf-8")
+        if self.protocol is None:
+            self.queue.append(line)
+        else:
+            self.protocol.sendLine(line)
+
+
+def listen_reuseport(port, factory, interface="0.0.0.0", reactor=reactor):
+    # Lets every worker accept on the same port.
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise Exception("SO_REUSEPORT isn't supported on this platform.")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(128)
+        sock.setblocking(0)
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor has its own copy.
+        sock.close()
+
+
+def run_worker(worker_id, worker_no, port, ipc_dir, interface="0.0.0.0"):
+    factory = ClusterFactory(worker_id, worker_no)
+    reactor.listenUNIX(ipc_path(ipc_dir, worker_id), IPCServerFactory(factory))
+    for worker in range(0, worker_no):
+        if worker == worker_id:
+            continue
+
+        link = IPCLink(factory)
+        factory.links[worker] = link
+        reactor.connectUNIX(ipc_path(ipc_dir, worker), link)
+
+    listen_reuseport(port, factory, interface)
+    reactor.run()
+
+
+def start_workers(worker_no, port, ipc_dir, interface="0.0.0.0"):
+    # Fresh interpreters -- a forked reactor would share its poller.
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [path for path in [env.get("PYTHONPATH")] if path]
+    )
+
+    workers = []
+    for worker_id in range(0, worker_no):
+        workers.append(subprocess.Popen([
+            sys.executable, "-m", "pyp2p.rendezvous_cluster", "--worker",
+            str(worker_id), str(worker_no), str(port), ipc_dir, interface
+        ], env=env))
+
+    return workers
+
+
+def run_cluster(port=8000, worker_no=None, interface="0.0.0.0"):
+    worker_no = worker_no or multiprocessing.cpu_count()
+    ipc_dir = tempfile.mkdtemp(prefix="pyp2p-rendezvous-")
+    workers = start_workers(worker_no, port, ipc_dir, interface)
+    try:
+        for worker in workers:
+            worker.wait()
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        worker_id, worker_no, port = [int(arg) for arg in sys.argv[2:5]]
+        run_worker(worker_id, worker_no, port, sys.argv[5], sys.argv[6])
+    else:
+        worker_no = int(sys.argv[1]) if len(sys.argv) > 1 else None
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+        print("Starting rendezvous cluster.")
+        run_cluster(port, worker_no)
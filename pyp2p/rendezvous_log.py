@@ -0,0 +1,209 @@
+"""
+Logging for the rendezvous server.
+
+The server used to print a formatted entry for every line sent and
+received and every connection opened and closed, calling
+time.strftime and transport.getPeer() for each one and writing to
+stdout from the reactor thread. Under a connection flood that was the
+server's throughput ceiling.
+
+ServerLog drops entries below its level (and a sample of the chatty
+ones) before doing any work. Entries that are kept are queued as raw
+tuples and a BufferedSink thread formats and writes them in batches,
+so the reactor never formats a timestamp or blocks on the output.
+If the writer falls behind, new entries are dropped and counted
+rather than growing the queue forever.
+"""
+
+import atexit
+import collections
+import random
+import sys
+import threading
+import time
+
+# Levels.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+level_names = {
+    DEBUG: "DEBUG",
+    INFO: "INFO",
+    WARNING: "WARNING",
+    ERROR: "ERROR"
+}
+
+
+def format_entry(when, level, msg, peer=None, direction="none"):
+    # [12:00:00 2015-01-01] INFO BOOTSTRAP 10 <- 1.2.3.4:5000
+    if type(msg) == bytes:
+        msg = msg.decode("utf-8", "replace")
+
+    if direction == "send":
+        direction = " -> "
+    elif direction == "recv":
+        direction = " <- "
+    else:
+        direction = " "
+
+    who = ""
+    if peer is not None:
+        who = "%s:%s" % (str(peer.host), str(peer.port))
+
+    return "[%s] %s %s%s%s" % (when, level_names.get(level, str(level)), msg, direction, who)
+
+
+class BufferedSink():
+    def __init__(self, out=None, flush_interval=0.5, max_backlog=100000):
+        # File path or file object (stdout by default.)
+        self.out = out
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+
+        # Entries waiting to be written.
+        self.backlog = collections.deque()
+        self.dropped = 0
+        self.written = 0
+
+        # Cached strftime for the last second seen.
+        self.last_second = None
+        self.last_when = None
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.running = 0
+        self.file = None
+        self.registered = 0
+
+    def write(self, entry):
+        # Called from the reactor -- never blocks.
+        if len(self.backlog) >= self.max_backlog:
+            self.dropped += 1
+            return 0
+
+        self.backlog.append(entry)
+        if not self.running:
+            self.start()
+
+        return 1
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.running = 1
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+            # Write out what's left on exit.
+            if not self.registered:
+                self.registered = 1
+                atexit.register(self.close)
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def timestamp(self, t):
+        second = int(t)
+        if second != self.last_second:
+            self.last_second = second
+            self.last_when = time.strftime("%H:%M:%S %Y-%m-%d", time.localtime(second))
+
+        return self.last_when
+
+    def flush(self):
+        with self.lock:
+            lines = []
+            while len(self.backlog):
+                t, level, msg, peer, direction = self.backlog.popleft()
+                lines.append(format_entry(self.timestamp(t), level, msg, peer, direction))
+            if not len(lines):
+                return 0
+
+            try:
+                if self.file is None:
+                    if self.out is None:
+                        self.file = sys.stdout
+                    elif hasattr(self.out, "write"):
+                        self.file = self.out
+                    else:
+                        self.file = open(self.out, "a")
+
+                self.file.write("\n".join(lines) + "\n")
+                self.file.flush()
+                self.written += len(lines)
+            except Exception:
+                self.dropped += len(lines)
+
+            return len(lines)
+
+    def close(self):
+        # Stop the writer and write out anything left.
+        with self.lock:
+            self.running = 0
+            thread = self.thread
+            self.thread = None
+        self.wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+        # Only close files we opened.
+        with self.lock:
+            if self.file is not None and self.file is not sys.stdout:
+                if self.file is not self.out:
+                    self.file.close()
+            self.file = None
+
+
+class ServerLog():
+    def __init__(self, level=INFO, sink=None, sample_rate=1.0, rand=random, clock=time.time):
+        # Entries below this level are dropped.
+        self.level = level
+
+        # Fraction of DEBUG and INFO entries kept (WARNING and
+        # above are always kept.)
+        self.sample_rate = sample_rate
+        self.sampled_out = 0
+
+        self.sink = sink or BufferedSink()
+        self.rand = rand
+        self.clock = clock
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, peer=None, direction="none"):
+        if level < self.level:
+            return 0
+
+        # Sample chatty entries.
+        if level < WARNING and self.sample_rate < 1:
+            if self.rand.random() >= self.sample_rate:
+                self.sampled_out += 1
+                return 0
+
+        # Formatted by the sink's thread.
+        return self.sink.write((self.clock(), level, msg, peer, direction))
+
+    def debug(self, msg, peer=None, direction="none"):
+        return self.log(DEBUG, msg, peer, direction)
+
+    def info(self, msg, peer=None, direction="none"):
+        return self.log(INFO, msg, peer, direction)
+
+    def warning(self, msg, peer=None, direction="none"):
+        return self.log(WARNING, msg, peer, direction)
+
+    def error(self, msg, peer=None, direction="none"):
+        return self.log(ERROR, msg, peer, direction)
+
+    def close(self):
+        self.sink.close()
@@ -10,8 +10,8 @@ Notes: Passives nodes don't keep a persistent connection
 to the rendezvous server because they don't need to
 and it would be unnecessarily taxing. For this reason,
 the list of passive nodes retrieved from bootstrapping
-may be stale but they are periodically cleaned every node
-life time. Additionally, well behaved passive nodes
+may be stale but they are removed once their node life
+time passes. Additionally, well behaved passive nodes
 send the clear command which causes the server to remove
 the node details.
 """
@@ -27,36 +27,33 @@ from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor
 from .lib import *
+from .node_registry import NodeRegistry
+from .scheduler import Scheduler
+from .rendezvous_log import ServerLog, DEBUG, INFO
 
 error_log_path = "error.log"
-debug = 1
+
+# Lines and connections are logged at DEBUG, so the default is quiet.
+log = ServerLog(level=INFO)
+
+# Commands are routed on their first token and then checked
+# against one of these.
+BOOTSTRAP_LINE = re.compile(r"^BOOTSTRAP ([0-9]+)")
+READY_LINE = re.compile(r"^(SIMULTANEOUS|PASSIVE) READY ([0-9]+) ([0-9]+)$")
+SOURCE_LINE = re.compile(r"^SOURCE TCP")
+CANDIDATE_LINE = re.compile(r"^CANDIDATE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) (TCP|UDP) ([0-9]+(?: [0-9]+)*)$")
+ACCEPT_LINE = re.compile(r"^ACCEPT ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ([0-9]+(?: [0-9]+)*) (TCP|UDP) ([0-9]+(?:[.][0-9]+)?)$")
+CLEAR_LINE = re.compile(r"^CLEAR")
+PORT_NUMBER = re.compile(r"^[0-9]+$")
 
 class RendezvousProtocol(LineReceiver):
     def __init__(self, factory):
         self.factory = factory
-        self.challege_timeout = 60 * 2 # Seconds.
-        self.node_lifetime = 60 * 60 * 12 # 12 hours.
-        self.cleanup = 5 * 60 # Every 5 minutes.
+        self.challege_timeout = factory.challege_timeout
+        self.node_lifetime = factory.node_lifetime
         self.max_candidates = 100 # Per simultaneous node.
         self.connected = False
-
-    def log_entry(self, msg, direction="none"):
-        if sys.version_info >= (3,0,0):
-            if type(msg) == bytes:
-                msg = msg.decode("utf-8")
-        ip_addr = str(self.transport.getPeer().host)
-        port = str(self.transport.getPeer().port)
-        when = time.strftime("%H:%M:%S %Y-%m-%d")
-        who = """%s:%s""" % (ip_addr, port)
-        if direction == "send":
-            direction = " -> "
-        elif direction == "recv":
-            direction = " <- "
-        else:
-            direction = " "
-
-        entry = """[%s] %s%s%s""" % (when, msg, direction, who)
-        return entry
+        self.peer = None
 
     def send_line(self, msg):
         # Not connected.
@@ -68,13 +65,10 @@ class RendezvousProtocol(LineReceiver):
             if type(msg) != bytes:
                 msg = msg.encode("ascii")
         except Exception as e:
-            print("send line e")
-            print(e)
+            log.error("send line " + str(e), self.peer)
             return
 
-        # stdout for debugging.
-        if debug:
-            print(self.log_entry(msg, "send"))
+        log.debug(msg, self.peer, "send")
 
         self.sendLine(msg)
         
@@ -104,9 +98,9 @@ class RendezvousProtocol(LineReceiver):
         return True
 
     def is_valid_port(self, port):
-        port = re.findall("^[0-9]+$", str(port))
-        if len(port):
-            port = int(port[0])
+        port = str(port)
+        if PORT_NUMBER.match(port) is not None:
+            port = int(port)
             if 0 < port <= 65535:
                 return 1
         return 0
@@ -178,81 +172,205 @@ class RendezvousProtocol(LineReceiver):
     def connectionMade(self):
         try:
             self.connected = True
-            if debug:
-                print(self.log_entry("OPENED =", "none"))
+            self.peer = self.transport.getPeer()
+            log.debug("OPENED =", self.peer)
 
             # Force reconnect if node has candidates and the timeout is old.
             ip_addr = self.transport.getPeer().host
             if ip_addr in self.factory.nodes["simultaneous"]:
                 # Update time.
                 self.factory.nodes["simultaneous"][ip_addr]["time"] = time.time()
+                self.factory.expire_node("simultaneous", ip_addr)
                 self.synchronize_simultaneous(ip_addr)
         except Exception as e:
             error = parse_exception(e)
             log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            log.error("ERROR = " + error, self.peer)
 
     def connectionLost(self, reason):
-        """
-        Mostly handles clean-up of node + candidate structures.
-        Avoids memory exhaustion for a large number of connections.
-        """
+        # Old nodes and candidates are removed by the factory's
+        # expiry timers.
         try:
             self.connected = False
-            if debug:
-                print(self.log_entry("CLOSED =", "none"))
-
-            # Every five minutes: cleanup
-            t = time.time()
-            if time.time() - self.factory.last_cleanup >= self.cleanup:
-                self.factory.last_cleanup = t
-
-                # Delete old passive nodes.
-                old_node_ips = []
-                for node_ip in list(self.factory.nodes["passive"]):
-                    passive_node = self.factory.nodes["passive"][node_ip]
-                    # Gives enough time for passive nodes to receive clients.
-                    if t - passive_node["time"] >= self.node_lifetime:
-                        old_node_ips.append(node_ip)
-                for node_ip in old_node_ips:
-                    del self.factory.nodes["passive"][node_ip]
-
-                # Delete old simultaneous nodes.
-                old_node_ips = []
-                for node_ip in list(self.factory.nodes["simultaneous"]):
-                    simultaneous_node = self.factory.nodes["simultaneous"][node_ip]
-                    # Gives enough time for passive nodes to receive clients.
-                    if t - simultaneous_node["time"] >= self.node_lifetime:
-                        old_node_ips.append(node_ip)
-                for node_ip in old_node_ips:
-                    del self.factory.nodes["simultaneous"][node_ip]
-
-                # Delete old candidates and candidate structs.
-                old_node_ips = []
-                for node_ip in list(self.factory.candidates):
-                    # Record old candidates.
-                    old_candidates = []
-                    for candidate in self.factory.candidates[node_ip]:
-                        # Hole punching is ms time sensitive.
-                        # Candidates older than this is safe to assume they're not needed.
-                        if not node_ip in self.factory.nodes["simultaneous"] and t - candidate["time"] >= self.challenge_timeout * 5:
-                            old_candidates.append(candidate)
-
-                    # Remove old candidates.
-                    for candidate in old_candidates:
-                        self.factory.candidates[node_ip].remove(candidate)
-
-                    # Record old node IPs.
-                    if not len(self.factory.candidates[node_ip]) and not node_ip in self.factory.nodes["simultaneous"]:
-                        old_node_ips.append(node_ip)
-
-                # Remove old node IPs.
-                for node_ip in old_node_ips:
-                    del self.factory.candidates[node_ip]
+            log.debug("CLOSED =", self.peer)
         except Exception as e:
             error = parse_exception(e)
             log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            log.error("ERROR = " + error, self.peer)
+
+    def handle_bootstrap(self, match):
+        # Return nodes for bootstrapping.
+        n = int(match.group(1))
+
+        # Invalid number.
+        if n < 1 or n > 100:
+            return
+
+        # Bootstrap n passive, n .
+        msg = "NODES "
+        node_types = ["passive"]
+        our_ip = self.transport.getPeer().host
+        node_no = 0
+        for node_type in node_types:
+            for ip_addr, port in self.factory.sample_nodes(node_type, n, our_ip):
+                # Append new node.
+                msg += node_type[0] + ":" + ip_addr + ":" + str(port) + " "
+                node_no += 1
+
+        # No nodes in response.
+        if not node_no:
+            msg = "NODES EMPTY"
+
+        # Send nodes list.
+        self.send_line(msg)
+
+    def handle_ready(self, match):
+        # Add node details to relevant sections.
+        node_type, passive_port, max_inbound = match.groups()
+        node_type = node_type.lower()
+
+        # Init / setup.
+        node_ip = self.transport.getPeer().host
+        self.factory.nodes[node_type][node_ip] = {
+            "max_inbound": max_inbound,
+            "no": 0,
+            "port": passive_port,
+            "time": time.time(),
+            "con": self,
+            "ip_list": []
+        }
+        self.factory.expire_node(node_type, node_ip)
+
+        # Passive doesn't have a candidates list.
+        if node_type == "simultaneous":
+            if not node_ip in self.factory.candidates:
+                self.factory.candidates[node_ip] = []
+            else:
+                self.cleanup_candidates(node_ip)
+                self.propogate_candidates(node_ip)
+
+    def handle_source(self, match):
+        # Echo back mapped port.
+        self.send_remote_port()
+
+    def handle_candidate(self, match):
+        # Client wishes to actively initate a simultaneous open.
+        # CANDIDATE 192.168.0.1 TCP 4552 345
+        node_ip, proto, predictions = match.groups()
+        predictions = predictions.split(" ")
+        client_ip = self.transport.getPeer().host
+
+        # Invalid IP address.
+        if not self.is_valid_ipv4_address(node_ip):
+            log.debug("Candidate invalid ip4" + str(node_ip), self.peer)
+            return
+        if node_ip not in self.factory.nodes["simultaneous"]:
+            log.debug("Candidate: node ip not in factory nodes sim.", self.peer)
+            return
+        if node_ip == client_ip:
+            log.debug("Candidate node ip == clietn ip", self.peer)
+            return
+
+        # Valid port.
+        valid_ports = 1
+        for port in predictions:
+            if not self.is_valid_port(port):
+                valid_ports = 0
+        if not valid_ports:
+            log.debug("Candidate not valid port", self.peer)
+            return
+
+        # Not connected.
+        if not self.factory.nodes["simultaneous"][node_ip]["con"].connected:
+            log.debug("Candidate not connected.", self.peer)
+            return
+
+        candidate = {
+            "ip_addr": client_ip,
+            "time": time.time(),
+            "predictions": predictions,
+            "proto": proto,
+            "con": self,
+            "propogated": 0
+        }
+
+        # Delete candidate if it already exists.
+        if node_ip in self.factory.candidates:
+            # Max candidates reached.
+            if len(self.factory.candidates[node_ip]) >= self.max_candidates:
+                log.debug("Candidate max candidates reached.", self.peer)
+                return
+
+            for test_candidate in self.factory.candidates[node_ip]:
+                if test_candidate["ip_addr"] == client_ip:
+                    self.factory.candidates[node_ip].remove(test_candidate)
+                    log.debug("Candidate removign test canadidate.", self.peer)
+                    break
+
+        self.factory.candidates[node_ip].append(candidate)
+        self.factory.expire_candidate(node_ip, candidate)
+        msg = "PREDICTION SET"
+        self.send_line(msg)
+
+        # Synchronize simultaneous node.
+        self.synchronize_simultaneous(node_ip)
+
+    def handle_accept(self, match):
+        # Node wishes to respond to a simultaneous open challenge from a client.
+        # ACCEPT 192.168.0.1 4552 345 TCP 1412137849.288068
+        client_ip, predictions, proto, ntp = match.groups()
+
+        # Invalid IP address.
+        node_ip = self.transport.getPeer().host
+        if node_ip not in self.factory.candidates:
+            return
+
+        # Invalid predictions.
+        predictions = predictions.split(" ")
+        valid_ports = 1
+        for port in predictions:
+            if not self.is_valid_port(port):
+                valid_ports = 0
+        if not valid_ports:
+            return
+
+        # Invalid NTP.
+        t = time.time()
+        minute = 60 * 10
+        if int(float(ntp)) < t - minute or int(float(ntp)) > t + minute:
+            return
+
+        # Relay fight to client_ip.
+        # FIGHT 192.168.0.1 4552 345 34235 TCP 123123123.1
+        msg = "FIGHT %s %s %s %s" % (node_ip, " ".join(map(str, predictions)), proto, str(ntp))
+        for candidate in self.factory.candidates[node_ip]:
+            if candidate["ip_addr"] == client_ip:
+                candidate["con"].send_line(msg)
+
+                """
+                Signal to propogate_candidates() not to relay this candidate again. Note that this occurs after a valid accept which thus counts as acknowledging receiving the challenge.
+                """
+                candidate["propogated"] = 1
+                break
+
+    def handle_clear(self, match):
+        # Remove node details.
+        ip_addr = self.transport.getPeer().host
+        for node_type in ["passive", "simultaneous"]:
+            if ip_addr in self.factory.nodes[node_type]:
+                del self.factory.nodes[node_type][ip_addr]
+                self.factory.expiry.cancel((node_type, ip_addr))
+
+    # First token -> (validator, handler.)
+    commands = {
+        "BOOTSTRAP": (BOOTSTRAP_LINE, handle_bootstrap),
+        "SIMULTANEOUS": (READY_LINE, handle_ready),
+        "PASSIVE": (READY_LINE, handle_ready),
+        "SOURCE": (SOURCE_LINE, handle_source),
+        "CANDIDATE": (CANDIDATE_LINE, handle_candidate),
+        "ACCEPT": (ACCEPT_LINE, handle_accept),
+        "CLEAR": (CLEAR_LINE, handle_clear)
+    }
 
     def lineReceived(self, line):
         # Unicode for text patterns.
@@ -261,228 +379,25 @@ class RendezvousProtocol(LineReceiver):
         except:
             # Received invalid characters.
             return
-        if debug:
-            print(self.log_entry(line, "recv"))
+        log.debug(line, self.peer, "recv")
 
         try:
-            # Return nodes for bootstrapping.
-            if re.match("^BOOTSTRAP", line) is not None:
-                parts = re.findall("^BOOTSTRAP ([0-9]+)", line)
-                while 1:
-                    # Invalid response.
-                    if not len(parts):
-                        break
-                    n = int(parts[0])
-            
-                    # Invalid number.
-                    if n < 1 or n > 100:
-                        break
-
-                    # Bootstrap n passive, n .
-                    msg = "NODES "
-                    node_types = ["passive"]
-                    our_ip = self.transport.getPeer().host
-                    node_no = 0
-                    for node_type in node_types:
-                        ip_addr_list = list(self.factory.nodes[node_type])
-                        for i in range(0, n):
-                            # There's no nodes left to bootstrap with.
-                            ip_addr_list_len = len(ip_addr_list)
-                            if not ip_addr_list_len:
-                                break
-
-                            # Choose a random node.
-                            rand_index = random.randrange(0, ip_addr_list_len)
-                            ip_addr = ip_addr_list[rand_index]
-                            element = self.factory.nodes[node_type][ip_addr]
-
-                            # Skip our own IP.
-                            if our_ip == ip_addr or ip_addr == "127.0.0.1":
-                                i -= 1
-                                ip_addr_list.remove(ip_addr)
-                                continue
-
-                            # Not connected.
-                            if node_type == "simultaneous" and not element["con"].connected:
-                                i -= 1
-                                ip_addr_list.remove(ip_addr)
-                                continue
-
-                            # Append new node.
-                            msg += node_type[0] + ":" + ip_addr + ":" + str(element["port"]) + " "
-                            ip_addr_list.remove(ip_addr)
-                            node_no += 1
-
-                    # No nodes in response.
-                    if not node_no:
-                        msg = "NODES EMPTY"
-
-                    # Send nodes list.
-                    self.send_line(msg)
-                    break
-
-            # Add node details to relevant sections.
-            if re.match("^(SIMULTANEOUS|PASSIVE) READY [0-9]+ [0-9]+$", line) is not None:
-                # Get type.
-                node_type, passive_port, max_inbound = re.findall("^(SIMULTANEOUS|PASSIVE) READY ([0-9]+) ([0-9]+)", line)[0]
-                node_type = node_type.lower()
-                valid_node_types = ["simultaneous", "passive"]
-                if node_type not in valid_node_types:
-                    return
-
-                # Init / setup.
-                node_ip = self.transport.getPeer().host
-                self.factory.nodes[node_type][node_ip] = {
-                    "max_inbound": max_inbound,
-                    "no": 0,
-                    "port": passive_port,
-                    "time": time.time(),
-                    "con": self,
-                    "ip_list": []
-                }
-
-                # Passive doesn't have a candidates list.
-                if node_type == "simultaneous":
-                    if not node_ip in self.factory.candidates:
-                        self.factory.candidates[node_ip] = []
-                    else:
-                        self.cleanup_candidates(node_ip)
-                        self.propogate_candidates(node_ip)
-
-            # Echo back mapped port.
-            if re.match("^SOURCE TCP", line) is not None:
-                self.send_remote_port()
-
-            # Client wishes to actively initate a simultaneous open.
-            if re.match("^CANDIDATE", line) is not None:
-                # CANDIDATE 192.168.0.1 TCP.
-                parts = re.findall("^CANDIDATE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) (TCP|UDP) ((?:[0-9]+\s?)+)$", line)
-                while 1:
-                    # Invalid response.
-                    if not len(parts):
-                        break
-                    node_ip, proto, predictions = parts[0]
-                    predictions = predictions.split(" ")
-                    client_ip = self.transport.getPeer().host
-
-                    # Invalid IP address.
-                    if not self.is_valid_ipv4_address(node_ip):
-                        print("Candidate invalid ip4" + str(node_ip))
-                        break
-                    if node_ip not in self.factory.nodes["simultaneous"]:
-                        print("Candidate: node ip not in factory nodes sim.")
-                        break
-                    if node_ip == client_ip:
-                        print("Candidate node ip == clietn ip")
-                        break
-
-                    # Valid port.
-                    valid_ports = 1
-                    for port in predictions:
-                        if not self.is_valid_port(port):
-                            valid_ports = 0
-                    if not valid_ports:
-                        print("Candidate not valid port")
-                        break
-
-                    # Not connected.
-                    if not self.factory.nodes["simultaneous"][node_ip]["con"].connected:
-                        print("Candidate not connected.")
-                        break
-
-                    candidate = {
-                        "ip_addr": client_ip,
-                        "time": time.time(),
-                        "predictions": predictions,
-                        "proto": proto,
-                        "con": self,
-                        "propogated": 0
-                    }
-
-                    # Delete candidate if it already exists.
-                    if node_ip in self.factory.candidates:
-                        # Max candidates reached.
-                        if len(self.factory.candidates[node_ip]) >= self.max_candidates:
-                            print("Candidate max candidates reached.")
-                            break
-
-                        for test_candidate in self.factory.candidates[node_ip]:
-                            if test_candidate["ip_addr"] == client_ip:
-                                self.factory.candidates[node_ip].remove(test_candidate)
-                                print("Candidate removign test canadidate.")
-                                break
-
-                    self.factory.candidates[node_ip].append(candidate)
-                    candidate_index = len(self.factory.candidates[node_ip]) - 1
-
-                    # Update predictions.
-                    self.factory.candidates[node_ip][candidate_index]["predictions"] = predictions
-                    msg = "PREDICTION SET"
-                    self.send_line(msg)
-
-                    # Synchronize simultaneous node.
-                    self.synchronize_simultaneous(node_ip)
-                    break
-
-
-            # Node wishes to respond to a simultaneous open challenge from a client.
-            if re.match("^ACCEPT", line) is not None:
-                # ACCEPT 192.168.0.1 4552 345 TCP 1412137849.288068
-                parts = re.findall("^ACCEPT ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP) ([0-9]+(?:[.][0-9]+)?)$", line)
-                while 1:
-                    # Invalid reply.
-                    if not len(parts):
-                        break
-                    client_ip, predictions, proto, ntp = parts[0]
-
-                    # Invalid IP address.
-                    node_ip = self.transport.getPeer().host                
-                    if node_ip not in self.factory.candidates:
-                        break
-
-                    # Invalid predictions.
-                    predictions = predictions.split(" ")
-                    valid_ports = 1
-                    for port in predictions:
-                        if not self.is_valid_port(port):
-                            valid_ports = 0
-                    if not valid_ports:
-                        break
-
-                    # Invalid NTP.
-                    ntp = ntp
-                    t = time.time()
-                    minute = 60 * 10
-                    if int(float(ntp)) < t - minute or int(float(ntp)) > t + minute:
-                        break
-
-                    # Relay fight to client_ip.
-                    # FIGHT 192.168.0.1 4552 345 34235 TCP 123123123.1
-                    msg = "FIGHT %s %s %s %s" % (node_ip, " ".join(map(str, predictions)), proto, str(ntp))
-                    for candidate in self.factory.candidates[node_ip]:
-                        if candidate["ip_addr"] == client_ip:
-                            candidate["con"].send_line(msg)
-
-                            """
-                            Signal to propogate_candidates() not to relay this candidate again. Note that this occurs after a valid accept which thus counts as acknowledging receiving the challenge.
-                            """
-                            candidate["propogated"] = 1
-                            break
-
-                    break
+            # Route on the first token -- at most one handler runs.
+            command = self.commands.get(line.split(" ", 1)[0])
+            if command is None:
+                return
 
-            # Remove node details.
-            if re.match("^CLEAR", line) is not None:
-                ip_addr = self.transport.getPeer().host
-                if ip_addr in self.factory.nodes["passive"]:
-                    del self.factory.nodes["passive"][ip_addr]
-                if ip_addr in self.factory.nodes["simultaneous"]:
-                    del self.factory.nodes["simultaneous"][ip_addr]
+            # Invalid line for the command.
+            validator, handler = command
+            match = validator.match(line)
+            if match is None:
+                return
 
+            handler(self, match)
         except Exception as e:
             error = parse_exception(e)
             log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            log.error("ERROR = " + error, self.peer)
 
 
 class RendezvousFactory(Factory):
@@ -530,12 +445,20 @@ class RendezvousFactory(Factory):
     used for bootstrapping.
     """
 
-    def __init__(self):
-        self.last_cleanup = time.time()
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.challege_timeout = 60 * 2 # Seconds.
+        self.node_lifetime = 60 * 60 * 12 # 12 hours.
+
+        # Node and candidate expiry deadlines in a heap. One
+        # reactor.callLater is kept pending for the earliest.
+        self.expiry = Scheduler(clock=reactor.seconds)
+        self.expiry_call = None
+
         self.candidates = {}
         self.nodes = {
-            'passive': {},
-            'simultaneous': {},
+            'passive': NodeRegistry(),
+            'simultaneous': NodeRegistry(),
             'active': {},
             'relay': {},
             'bootstrap': {}
@@ -556,10 +479,92 @@ class RendezvousFactory(Factory):
         self.candidates[test_ip] = []
         """
 
+    def sample_nodes(self, node_type, n, our_ip):
+        # Up to n random (ip, port) pairs for bootstrapping.
+        def skip(ip_addr, element):
+            # Skip our own IP.
+            if our_ip == ip_addr or ip_addr == "127.0.0.1":
+                return 1
+
+            # Not connected.
+            if node_type == "simultaneous" and not element["con"].connected:
+                return 1
+
+            return 0
+
+        nodes = self.nodes[node_type]
+        return [(ip_addr, nodes[ip_addr]["port"]) for ip_addr in nodes.sample(n, skip)]
+
+    def expire_node(self, node_type, ip_addr):
+        # (Re)starts a node's life time.
+        def expire():
+            if ip_addr in self.nodes[node_type]:
+                del self.nodes[node_type][ip_addr]
+
+            # Candidates only outlive their node while they're fresh.
+            candidates = self.candidates.get(ip_addr)
+            if node_type == "simultaneous" and candidates is not None:
+                if not len(candidates):
+                    del self.candidates[ip_addr]
+
+        self.expire_later((node_type, ip_addr), self.node_lifetime, expire)
+
+    def expire_candidate(self, node_ip, candidate):
+        def expire():
+            candidates = self.candidates.get(node_ip)
+            if candidates is None:
+                return
+
+            # May have been replaced by a newer candidate already.
+            for i in range(0, len(candidates)):
+                if candidates[i] is candidate:
+                    del candidates[i]
+                    break
+
+            if not len(candidates) and node_ip not in self.nodes["simultaneous"]:
+                del self.candidates[node_ip]
+
+        name = ("candidate", node_ip, candidate["ip_addr"])
+        self.expire_later(name, self.challege_timeout, expire)
+
+    def expire_later(self, name, delay, callback):
+        self.expiry.schedule(name, delay, callback)
+        self.schedule_expiry()
+
+    def schedule_expiry(self):
+        # Keep one timer pending for the earliest deadline.
+        wait = self.expiry.time_until_next()
+        if wait is None:
+            return
+
+        deadline = self.reactor.seconds() + wait
+        if self.expiry_call is not None and self.expiry_call.active():
+            if self.expiry_call.getTime() <= deadline:
+                return
+            self.expiry_call.cancel()
+
+        self.expiry_call = self.reactor.callLater(wait, self.run_expiry)
+
+    def run_expiry(self):
+        self.expiry_call = None
+        try:
+            self.expiry.run_due()
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(error_log_path, error)
+        self.schedule_expiry()
+
     def buildProtocol(self, addr):
         return RendezvousProtocol(self)
 
 if __name__ == "__main__":
+    # Logs every line at DEBUG -- sample it under load.
+    if "--debug" in sys.argv:
+        log.level = DEBUG
+        log.sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+    if os.environ.get("LOG_PATH"):
+        log.sink.out = os.environ["LOG_PATH"]
+
     print("Starting rendezvous server.")
     factory = RendezvousFactory()
     reactor.listenTCP(8000, factory, interface="0.0.0.0")
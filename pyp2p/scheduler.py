@@ -0,0 +1,210 @@
+"""
+Deadlines for periodic Net tasks (bootstrapping, advertising, DHT
+polling, reverse query expiry and simultaneous open rate limiting.)
+
+Tasks are kept in a heap so the next deadline is always known and
+Net.poll() can sleep until then instead of waking up on a fixed
+interval. A task either has a callback (run by run_due(), then
+rescheduled if it has an interval) or is just a deadline that the
+owner checks with is_due() and reschedules itself.
+
+Intervals can have jitter so that a lot of nodes started at the same
+time don't all contact the rendezvous server in lockstep.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class Scheduler():
+    def __init__(self, clock=time.time):
+        self.clock = clock
+
+        # Heap of (deadline, seq, name) with at most one live entry
+        # per task. Entries for cancelled tasks are skipped.
+        self.timers = []
+        self.seq = itertools.count()
+
+        # Name -> task.
+        self.tasks = {}
+
+        # Tasks may be scheduled from other threads (e.g. UNL.connect.)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def jittered(self, delay, jitter):
+        # +/- jitter as a fraction of the delay.
+        if not jitter:
+            return delay
+
+        return max(0, delay * (1 + random.uniform(-jitter, jitter)))
+
+    def schedule(self, name, delay, callback=None, interval=None, jitter=0):
+        """
+        (Re)schedules name to be due in delay seconds. Callback is
+        called with no arguments by run_due() and if interval is set
+        it's rescheduled every interval seconds after that.
+        """
+        with self.lock:
+            task = {
+                "deadline": self.clock() + self.jittered(delay, jitter),
+                "callback": callback,
+                "interval": interval,
+                "jitter": jitter,
+
+                # Heap entry for the task (None if it has none.)
+                "seq": None,
+                "queued": None
+            }
+
+            # A task keeps one heap entry. If the old one is due no
+            # later it's kept and moved to the new deadline when it
+            # reaches the top.
+            old = self.tasks.get(name)
+            if old is not None and old["queued"] is not None:
+                if old["queued"] <= task["deadline"]:
+                    task["seq"] = old["seq"]
+                    task["queued"] = old["queued"]
+
+            self.tasks[name] = task
+            if task["queued"] is None:
+                self.push(name, task)
+
+        return task["deadline"]
+
+    def push(self, name, task):
+        task["seq"] = next(self.seq)
+        task["queued"] = task["deadline"]
+        heapq.heappush(self.timers, (task["deadline"], task["seq"], name))
+
+        # Cancelled tasks and deadlines moved earlier leave stale
+        # entries behind -- drop them if they start to dominate.
+        if len(self.timers) > 2 * len(self.tasks) + 64:
+            self.compact()
+
+    def compact(self):
+        self.timers = [
+            (task["queued"], task["seq"], name)
+            for name, task in self.tasks.items()
+            if task["queued"] is not None
+        ]
+        heapq.heapify(self.timers)
+
+    def cancel(self, name):
+        with self.lock:
+            if name in self.tasks:
+                del self.tasks[name]
+
+    def deadline(self, name):
+        task = self.tasks.get(name)
+        if task is None:
+            return None
+
+        return task["deadline"]
+
+    def is_due(self, name, now=None):
+        # Tasks that were never scheduled are due.
+        task = self.tasks.get(name)
+        if task is None:
+            return 1
+
+        if now is None:
+            now = self.clock()
+
+        return task["deadline"] <= now
+
+    def is_stale(self, seq, name):
+        task = self.tasks.get(name)
+        return task is None or task["seq"] != seq
+
+    def time_until_next(self, now=None):
+        """
+        Seconds until the next deadline (0 if one has passed) or None
+        if nothing is scheduled.
+        """
+        if now is None:
+            now = self.clock()
+
+        with self.lock:
+            while len(self.timers):
+                deadline, seq, name = self.timers[0]
+                if self.is_stale(seq, name):
+                    heapq.heappop(self.timers)
+                    continue
+
+                # Deadline moved later since the entry was pushed.
+                task = self.tasks[name]
+                if task["deadline"] > deadline:
+                    heapq.heappop(self.timers)
+                    self.push(name, task)
+                    continue
+
+                # Passed deadlines without callbacks have already been
+                # seen by their owner (who reschedules them when ready.)
+                if deadline <= now and task["callback"] is None:
+                    heapq.heappop(self.timers)
+                    task["queued"] = None
+                    continue
+
+                return max(0, deadline - now)
+
+        return None
+
+    def run_due(self, now=None):
+        """
+        Runs the callbacks of every task whose deadline has passed.
+        Returns the number of callbacks run.
+        """
+        if now is None:
+            now = self.clock()
+
+        ran = 0
+        while 1:
+            with self.lock:
+                task = self.pop_due(now)
+            if task is None:
+                break
+
+            task["callback"]()
+            ran += 1
+
+        return ran
+
+    def pop_due(self, now):
+        # Next due task with a callback (or None.)
+        while len(self.timers) and self.timers[0][0] <= now:
+            deadline, seq, name = heapq.heappop(self.timers)
+            if self.is_stale(seq, name):
+                continue
+
+            # Deadline moved later since the entry was pushed.
+            task = self.tasks[name]
+            task["queued"] = None
+            if task["deadline"] > deadline:
+                self.push(name, task)
+                continue
+
+            if task["callback"] is None:
+                continue
+
+            # Periodic tasks are rescheduled before running so the
+            # callback can cancel or reschedule them.
+            if task["interval"] is not None:
+                self.schedule(
+                    name, task["interval"], task["callback"],
+                    task["interval"], task["jitter"]
+                )
+            else:
+                del self.tasks[name]
+
+            return task
+
+        return None
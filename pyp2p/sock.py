@@ -19,9 +19,12 @@ fast as it could - there would be a max message limit
 per check period.
 
 Quirks:
-* send_line will block until the entire line has been sent even if the socket has been set to non-blocking to make things easier. If you need a non-blocking way to send a line: use send(). Note that you will have to check for the number of bytes sent and resend if needed just like the real send function.
+* On a blocking socket send_line will block until the entire line has been sent. On a non-blocking socket it sends what the socket will take right away and queues the rest (see queue_line), so it never waits on a slow peer; it only returns 0 if the send queue is full.
+* queue_line / queue_send are the non-blocking alternative: data goes into a per-connection queue (bounded by max_send_buf) that flush() drains when the socket is writable. send_paused / backpressure_handler report when the queue passes the high water mark and when it drains below the low water mark again.
 * connect has the same behaviour as above to make things simpler (so will block regardless of whether socket is in non-blocking mode or not.) If you want to bypass this behaviour you can always connect the socket outside this class and then pass it to set_socket.
 
+* In binary mode (binary=1) the receive buffer is a bytearray, lines are only decoded once complete, and recv() returns memoryviews that share memory with the received data instead of copies. recv() and recv_line() also share the same buffer in this mode.
+
 Otherwise, all functions in this class behave how you would expect them to (depending on whether you're using non-blocking mode or blocking mode.) It's assumed that all blocking operations have a timeout by default. This can't be disabled.
 
 Todo: test various functions under connection exit.
@@ -34,19 +37,173 @@ import ssl
 import select
 import errno
 import platform
+from collections import deque
 from .lib import *
 
 error_log_path = "error.log"
 
-class Sock:
-    def __init__(self, addr=None, port=None, blocking=0, timeout=5, interface="default", use_ssl=0, debug=0):
-        self.nonce = None
+def split_lines(buf, scanned=0, delimiter=u"\r\n"):
+    """
+    Splits a buffer into delimited replies. Scanned is the number of
+    characters at the start of buf that are already known not to
+    contain a delimiter (it's returned by the previous call so only
+    new data is searched.) Empty replies are dropped.
+
+    Returns a tuple of (replies, remaining buf, scanned.)
+    """
+    # A delimiter may straddle the old and new data.
+    start = scanned - len(delimiter) + 1
+    if start < 0:
+        start = 0
+
+    # No complete reply yet.
+    end = buf.rfind(delimiter, start)
+    if end == -1:
+        return [], buf, len(buf)
+
+    # Everything up to the last delimiter is made up of replies.
+    replies = [reply for reply in buf[:end].split(delimiter) if len(reply)]
+    buf = buf[end + len(delimiter):]
+
+    return replies, buf, len(buf)
+
+def connect_many(addrs, want=None, timeout=5, max_in_flight=10, interface="default", stagger=0, on_result=None):
+    """
+    Connects to several (addr, port) pairs at once using non-blocking
+    connects. At most max_in_flight connects are pending at a time and
+    everything has to finish before one overall timeout. Stops once
+    want connections (default: all of them) have succeeded.
+
+    With stagger set, connects are started in order stagger seconds
+    apart (or as soon as the previous one fails) like happy eyeballs.
+    on_result is called with (addr, port, connected, rtt) for every
+    attempt that finishes. Attempts given up on count as timeouts
+    (connected = 0) if they were started before the first connection
+    that succeeded or nothing connected in time. Ones started later
+    only lost the race so they aren't reported.
+
+    Returns a list of (addr, port, socket) in the order they connected.
+    The sockets are left in non-blocking mode.
+    """
+    if want is None:
+        want = len(addrs)
+
+    src_ip = None
+    if interface != "default":
+        src_ip = get_lan_ip(interface)
+
+    def result(addr, port, connected, started):
+        if on_result is not None:
+            on_result(addr, port, connected, time.time() - started)
+
+    future = time.time() + timeout
+    next_start = 0
+    pending = list(addrs)
+    pending.reverse()
+    in_flight = {} # Socket -> (addr, port, started.)
+    connected = []
+    first_started = None # When the first successful connect began.
+    try:
+        while len(connected) < want and (len(pending) or len(in_flight)):
+            # Start new connects up to the in flight cap.
+            while len(pending) and len(in_flight) < max_in_flight:
+                # Wait for the stagger delay unless nothing is running.
+                now = time.time()
+                if stagger and len(in_flight) and now < next_start:
+                    break
+
+                addr, port = pending.pop()
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(0)
+                next_start = now + stagger
+                try:
+                    if src_ip is not None:
+                        s.bind((src_ip, 0))
+                    err = s.connect_ex((addr, int(port)))
+                except (socket.error, ValueError, OverflowError):
+                    s.close()
+                    result(addr, port, 0, now)
+                    continue
+
+                if err == 0:
+                    connected.append((addr, port, s))
+                    if first_started is None:
+                        first_started = now
+                    result(addr, port, 1, now)
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                    in_flight[s] = (addr, port, now)
+                else:
+                    s.close()
+                    result(addr, port, 0, now)
+
+                if stagger:
+                    break
+
+            remaining = future - time.time()
+            if remaining <= 0:
+                break
+            if not len(in_flight):
+                continue
+
+            # Wake up to start the next staggered connect.
+            wait = remaining
+            if stagger and len(pending):
+                wait = max(0, min(wait, next_start - time.time()))
+
+            # Writable = connect finished (either way.)
+            r, w, e = select.select([], list(in_flight), list(in_flight), wait)
+            for s in set(w + e):
+                addr, port, started = in_flight.pop(s)
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                result(addr, port, err == 0, started)
+                if err == 0 and len(connected) < want:
+                    connected.append((addr, port, s))
+                    if first_started is None:
+                        first_started = started
+                else:
+                    s.close()
+
+                # Start the next connect straight away on failure.
+                if err != 0:
+                    next_start = 0
+    finally:
+        # Give up on anything still connecting.
+        for s in in_flight:
+            s.close()
+            addr, port, started = in_flight[s]
+            if first_started is None or started < first_started:
+                result(addr, port, 0, started)
+
+    return connected
+
+class Sock(object):
+    def __init__(self, addr=None, port=None, blocking=0, timeout=5, interface="default", use_ssl=0, debug=0, binary=0):
+        # Called with (self, name, old, new) when the nonce or UNL changes.
+        self.change_handlers = []
+        self._nonce = None
+        self._unl = None
+
+        # Connection ID (set by Net once the nonce is known.)
+        self.con_id = None
+
         self.nonce_buf = u""
         self.reply_filter = None
-        self.buf = u""
+        self.buf_scanned = 0
         self.max_buf = 1024 * 1024 # 1 MB.
         self.max_chunks = 1024 # Prevents spamming of multiple short messages.
         self.chunk_size = 1024 * 4
+
+        # Binary mode keeps received data as bytes and only decodes
+        # complete lines. Raw recv() returns memoryviews.
+        self.binary = binary
+        if self.binary:
+            self._buf = bytearray()
+            self.chunk_view = memoryview(bytearray(self.chunk_size))
+        else:
+            self._buf = u""
+
+        # Reused by recv_into_view (grown to the largest recv.)
+        self.recv_view = None
         self.replies = []
         self.blocking = blocking
         self.timeout = timeout
@@ -54,7 +211,24 @@ class Sock:
         # self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.use_ssl = use_ssl
         self.alive = time.time()
-        self.unl = None
+
+        # Called with this object when the socket is closed.
+        self.close_handlers = []
+
+        # Outbound queue flushed when the socket is writable.
+        # Accounting is in bytes and bounded like max_buf.
+        self.send_queue = deque()
+        self.send_queue_offset = 0 # Sent bytes of send_queue[0].
+        self.send_queue_size = 0 # Unsent bytes in the queue.
+        self.max_send_buf = 1024 * 1024 # 1 MB.
+        self.send_high_water = 256 * 1024
+        self.send_low_water = 64 * 1024
+        self.send_paused = 0
+
+        # Called with (self, paused) when the high / low water marks
+        # are crossed and with self when the queue stops being empty.
+        self.backpressure_handler = None
+        self.send_queue_handlers = []
         if self.use_ssl:
             self.s = ssl.wrap_socket(self.s)
 
@@ -78,6 +252,57 @@ class Sock:
         else:
             self.set_blocking(self.blocking, self.timeout)
 
+    @property
+    def nonce(self):
+        return self._nonce
+
+    @nonce.setter
+    def nonce(self, value):
+        self.set_attr("nonce", value)
+
+    @property
+    def unl(self):
+        return self._unl
+
+    @unl.setter
+    def unl(self, value):
+        self.set_attr("unl", value)
+
+    def set_attr(self, name, value):
+        old = getattr(self, "_" + name)
+        setattr(self, "_" + name, value)
+        if old != value:
+            for handler in self.change_handlers[:]:
+                handler(self, name, old, value)
+
+    # Tells change handlers a closed Sock is connected again.
+    def notify_connected(self):
+        for handler in self.change_handlers[:]:
+            handler(self, "connected", 0, 1)
+
+    def add_change_handler(self, handler):
+        self.change_handlers.append(handler)
+
+    def remove_change_handler(self, handler):
+        if handler in self.change_handlers:
+            self.change_handlers.remove(handler)
+
+    @property
+    def buf(self):
+        return self._buf
+
+    @buf.setter
+    def buf(self, value):
+        if self.binary:
+            value = bytearray(value)
+
+        # Appending (buf += data) keeps the scan offset, anything
+        # else invalidates it.
+        old = self._buf
+        if len(value) < len(old) or not value.startswith(old):
+            self.buf_scanned = 0
+        self._buf = value
+
     def debug_print(self, msg):
         msg = "> " + str(msg)
         if self.debug:
@@ -146,6 +371,9 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
         except:
             self.connected = 0
 
+        if self.connected:
+            self.notify_connected()
+
     def reconnect(self):
         if not self.connected:
             if self.addr != None and self.port != None:
@@ -186,11 +414,37 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             log_exception(error_log_path, error)
             raise socket.error("Socket connect failed.")
 
+        self.notify_connected()
+
+    def fileno(self):
+        # Lets Sock objects be used directly with select / selectors.
+        if self.s is None:
+            raise ValueError("Sock is closed.")
+
+        return self.s.fileno()
+
+    def add_close_handler(self, handler):
+        self.close_handlers.append(handler)
+
+    def remove_close_handler(self, handler):
+        if handler in self.close_handlers:
+            self.close_handlers.remove(handler)
+
     def close(self):
         self.connected = 0
 
         self.debug_print("Closing con!!!")
 
+        # Handlers run before the socket is gone so they can
+        # still unregister its file descriptor.
+        if self.s is not None:
+            for handler in self.close_handlers[:]:
+                try:
+                    handler(self)
+                except Exception as e:
+                    error = parse_exception(e)
+                    log_exception(error_log_path, error)
+
         # Attempt graceful shutdown.
         try:
             try:
@@ -203,45 +457,202 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
 
         self.s = None
 
+        # Queued data can't be sent anymore.
+        self.send_queue.clear()
+        self.send_queue_offset = 0
+        self.send_queue_size = 0
+        self.send_paused = 0
+
+    def set_send_watermarks(self, high, low):
+        assert(low <= high)
+        self.send_high_water = high
+        self.send_low_water = low
+        self.update_backpressure()
+
+    def add_send_queue_handler(self, handler):
+        self.send_queue_handlers.append(handler)
+
+    def remove_send_queue_handler(self, handler):
+        if handler in self.send_queue_handlers:
+            self.send_queue_handlers.remove(handler)
+
+    def update_backpressure(self):
+        paused = self.send_paused
+        if not paused and self.send_queue_size >= self.send_high_water:
+            self.send_paused = 1
+        elif paused and self.send_queue_size <= self.send_low_water:
+            self.send_paused = 0
+
+        # Tell the application to stop / resume producing.
+        if paused != self.send_paused and self.backpressure_handler is not None:
+            try:
+                self.backpressure_handler(self, self.send_paused)
+            except Exception as e:
+                error = parse_exception(e)
+                log_exception(error_log_path, error)
+
+    def queue_send(self, data):
+        """
+        Non-blocking send. Data is added to the outbound queue and as
+        much of the queue as the socket will take is sent right away.
+        The rest is sent by flush() when the socket is writable.
+
+        Returns 0 if not connected or the queue would grow past
+        max_send_buf (nothing is queued), otherwise 1.
+        """
+        # Not connected.
+        if not self.connected:
+            return 0
+
+        # Convert to bytes Python 2 & 3
+        if sys.version_info >= (3,0,0):
+            if type(data) == str:
+                data = data.encode("ascii")
+        else:
+            if type(data) == unicode:
+                data = str(data)
+
+        # Nothing to send.
+        if not len(data):
+            return 1
+
+        # Enforce the queue limit.
+        if self.send_queue_size + len(data) > self.max_send_buf:
+            self.debug_print("Send queue full")
+            return 0
+
+        was_empty = not len(self.send_queue)
+        self.send_queue.append(data)
+        self.send_queue_size += len(data)
+        self.flush()
+
+        # Let the event loop know to wait for writability.
+        if was_empty and len(self.send_queue):
+            for handler in self.send_queue_handlers[:]:
+                handler(self)
+
+        return 1
+
+    def queue_line(self, msg):
+        # Convert delimiter to bytes.
+        if sys.version_info >= (3,0,0):
+            if type(msg) == str:
+                msg = msg.encode("ascii")
+            msg += self.delimiter.encode("ascii")
+        else:
+            msg = str(msg) + str(self.delimiter)
+
+        return self.queue_send(msg)
+
+    def flush(self, block=0, timeout=5):
+        """
+        Sends as much of the outbound queue as the socket will accept
+        without blocking. With block set it keeps trying until the queue
+        is empty or the timeout expires. Returns the number of bytes sent.
+        """
+        total_sent = 0
+        future = time.time() + (timeout or self.timeout)
+        while len(self.send_queue) and self.connected:
+            data = self.send_queue[0]
+            try:
+                view = memoryview(data)[self.send_queue_offset:]
+                bytes_sent = self.s.send(view[:self.chunk_size])
+            except socket.timeout as e:
+                bytes_sent = None
+            except ssl.SSLError as e:
+                # Will block on non-blocking SSL sockets.
+                if e.errno == ssl.SSL_ERROR_WANT_WRITE:
+                    bytes_sent = None
+                else:
+                    self.close()
+                    break
+            except socket.error as e:
+                err = e.args[0]
+                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                    bytes_sent = None
+                else:
+                    # Connection closed or other problem.
+                    self.debug_print("Con flush: " + str(e))
+                    self.close()
+                    break
+
+            # Socket buffer is full.
+            if bytes_sent is None:
+                if not block or time.time() >= future:
+                    break
+
+                # Avoid 100% CPU.
+                time.sleep(0.002)
+                continue
+
+            # Connection broken.
+            if not bytes_sent:
+                self.close()
+                break
+
+            total_sent += bytes_sent
+            self.send_queue_size -= bytes_sent
+            self.send_queue_offset += bytes_sent
+            if self.send_queue_offset >= len(data):
+                self.send_queue.popleft()
+                self.send_queue_offset = 0
+
+        if total_sent:
+            self.alive = time.time()
+        self.update_backpressure()
+
+        return total_sent
+
     def parse_buf(self):
         """
         Since TCP is a stream-orientated protocol, responses aren't guaranteed
         to be complete when they arrive. The buffer stores all the data and
         this function splits the data into replies based on the new line
         delimiter.
+
+        Only data that arrived since the last call is scanned for the
+        delimiter so that repeated polling of a long partial line stays
+        linear in the amount of data received.
         """
-        buf_len = len(self.buf)
-        replies = []
-        reply = u""
-        chop = 0
-        skip = 0
-        i = 0
-        for ch in self.buf:
-            if skip:
-                skip -= 1
-                i += 1
-                continue
+        if self.binary:
+            return self.parse_binary_buf()
 
-            nxt = i + 1
-            if nxt < buf_len:
-                if ch == u"\r" and self.buf[nxt] == u"\n":
-                    # Append new reply.
-                    if reply != u"":
-                        replies.append(reply)
-                        reply = u""
-
-                    # Truncate the whole buf if chop is out of bounds.
-                    chop = nxt + 1
-                    skip = 1
-                    i += 1
-                    continue
+        replies, self._buf, self.buf_scanned = split_lines(
+            self._buf, self.buf_scanned, self.delimiter
+        )
 
-            reply += ch
-            i += 1
+        return replies
+
+    def parse_binary_buf(self):
+        """
+        Binary mode version of parse_buf. Lines are decoded once
+        they're complete and consumed data is removed from the
+        bytearray in place. Lines that aren't valid UTF-8 are dropped.
+        """
+        delimiter = self.delimiter.encode("ascii")
+        start = self.buf_scanned - len(delimiter) + 1
+        if start < 0:
+            start = 0
 
-        # Truncate buf.
-        if chop:
-            self.buf = self.buf[chop:]
+        # No complete reply yet.
+        end = self._buf.rfind(delimiter, start)
+        if end == -1:
+            self.buf_scanned = len(self._buf)
+            return []
+
+        replies = []
+        pos = 0
+        while pos < end:
+            nxt = self._buf.find(delimiter, pos, end + len(delimiter))
+            if nxt > pos:
+                try:
+                    replies.append(self._buf[pos:nxt].decode("utf-8"))
+                except UnicodeDecodeError:
+                    self.debug_print("Parse buf: can't decode line.")
+            pos = nxt + len(delimiter)
+
+        del self._buf[:end + len(delimiter)]
+        self.buf_scanned = len(self._buf)
 
         return replies
 
@@ -290,7 +701,13 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
                     break
                 
                 try:
-                    chunk = self.s.recv(chunk_size)
+                    if self.binary:
+                        if len(self.chunk_view) < chunk_size:
+                            self.chunk_view = memoryview(bytearray(chunk_size))
+                        got = self.s.recv_into(self.chunk_view, chunk_size)
+                        chunk = self.chunk_view[:got]
+                    else:
+                        chunk = self.s.recv(chunk_size)
                 except socket.timeout as e:
                     self.debug_print("Get chunks timed out.")
                     self.debug_print(e)
@@ -322,17 +739,20 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
                         self.close()
                         return
                 else:
-                    if chunk == b"":
+                    if not len(chunk):
                         self.debug_print("Get chunk: b''")
                         self.close()
                         return
 
                     # Avoid decoding errors.
                     try:
-                        if encoding == "unicode":
-                            self.buf += chunk.decode("utf-8")
+                        if self.binary:
+                            # Lines are decoded in parse_buf.
+                            self._buf += chunk
+                        elif encoding == "unicode":
+                            self._buf += chunk.decode("utf-8")
                         else:
-                            self.buf += chunk.decode("latin-1")
+                            self._buf += chunk.decode("latin-1")
                         self.alive = time.time()
                     except Exception as e:
                         self.debug_print(e)
@@ -357,7 +777,10 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             if self.blocking:
                 if fixed_limit == None and encoding == "unicode":
                     # Partial response.
-                    if self.delimiter not in self.buf:
+                    delimiter = self.delimiter
+                    if self.binary:
+                        delimiter = delimiter.encode("ascii")
+                    if delimiter not in self._buf:
                         repeat = 1
                         time.sleep(wait)
 
@@ -367,7 +790,9 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
     # Called to check for replies and update buffers.
     def update(self):
         self.get_chunks()
-        self.replies = self.parse_buf()
+
+        # Keep replies that haven't been read yet.
+        self.replies += self.parse_buf()
 
     # Blocking or non-blocking.
     def send(self, msg, send_all=0, timeout=5):
@@ -409,9 +834,10 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
                     # This won't work if the network buffer is already full.
                     try:
                         self.debug_print("Attempting to send: ")
-                        self.debug_print(str(len(msg[total_sent:self.chunk_size])))
+                        chunk = msg[total_sent:total_sent + self.chunk_size]
+                        self.debug_print(str(len(chunk)))
                         self.debug_print("Blocking mode = " + str(self.s.gettimeout()))
-                        bytes_sent = self.s.send(msg[total_sent:self.chunk_size])
+                        bytes_sent = self.s.send(chunk)
                     except socket.timeout as e:
                         err = e.args[0]
                         self.debug_print("Con send: " + str(e))
@@ -495,6 +921,10 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
                 else:
                     return b""
 
+            # Binary mode reads straight into a new buffer.
+            if self.binary:
+                return self.recv_into_view(n, encoding, timeout)
+
             # Save current buffer state.
             temp_buf = self.buf[:]
 
@@ -525,21 +955,7 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             if encoding != "unicode":
                 # Convert from unicode string with latin-1 encoding
                 # To a byte string.
-                if sys.version_info >= (3,0,0):
-                    codes = []
-                    for ch in ret:
-                        codes.append(ord(ch))
-
-                    if len(codes):
-                        return bytes(codes)
-                    else:
-                        return b""
-                else:
-                    byte_str = b""
-                    for ch in ret:
-                        byte_str += chr(ord(ch))
-
-                    return byte_str
+                return ret.encode("latin-1")
 
             return ret
         except Exception as e:
@@ -552,6 +968,73 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             else:
                 return b""
 
+    def recv_into_view(self, n, encoding="unicode", timeout=5):
+        """
+        Binary mode recv. Buffered bytes that haven't been parsed
+        into lines are returned first, then the socket is read
+        directly into the result with recv_into. Returns a memoryview
+        (no copies are made) unless encoding is unicode.
+
+        The memoryview is into a buffer the Sock reuses so it's only
+        valid until the next recv (copy it with bytes() to keep it.)
+        """
+        if self.recv_view is None or len(self.recv_view) < n:
+            self.recv_view = memoryview(bytearray(n))
+        view = self.recv_view
+
+        # Use up any buffered data first.
+        got = len(self._buf)
+        if got > n:
+            got = n
+        if got:
+            view[:got] = self._buf[:got]
+            del self._buf[:got]
+            self.buf_scanned = 0
+
+        future = time.time() + (timeout or self.timeout)
+        while got < n and self.connected:
+            try:
+                bytes_recv = self.s.recv_into(view[got:], n - got)
+            except socket.timeout as e:
+                break
+            except ssl.SSLError as e:
+                # Will block on non-blocking SSL sockets.
+                if e.errno == ssl.SSL_ERROR_WANT_READ:
+                    break
+                else:
+                    self.close()
+                    break
+            except socket.error as e:
+                err = e.args[0]
+                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                    if not self.blocking:
+                        break
+                else:
+                    # Connection closed or other problem.
+                    self.close()
+                    break
+            else:
+                if not bytes_recv:
+                    self.close()
+                    break
+
+                got += bytes_recv
+                self.alive = time.time()
+                continue
+
+            # Avoid looping forever.
+            if time.time() >= future:
+                break
+
+            # Avoid 100% CPU.
+            time.sleep(0.002)
+
+        ret = view[:got]
+        if encoding == "unicode":
+            return ret.tobytes().decode("utf-8", "ignore")
+
+        return ret
+
     # Sends a new message delimitered by a new line.
     # Blocking: blocks until entire line is sent for simplicity.
     def send_line(self, msg, timeout=5):
@@ -589,8 +1072,26 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             else:
                 msg += str(self.delimiter)
 
+            # Non-blocking: send what the socket takes now and queue
+            # the rest for flush() (behind anything already queued so
+            # lines stay in order.) A queued line counts as sent -- 0
+            # means the queue was full and the line was dropped.
+            if not self.blocking:
+                if not self.queue_send(msg):
+                    return 0
+
+                return len(msg)
+
+            # Blocking: queued data has to go out first.
+            if len(self.send_queue):
+                if not self.queue_send(msg):
+                    return 0
+                self.flush(block=1, timeout=timeout)
+
+                return len(msg)
+
             """
-            The inclusion of the send_all flag makes this function behave like a blocking socket for the purposes of sending a full line even if the socket is non-blocking. It's assumed that lines will be small and if the network buffer is full this code won't end up as a bottleneck. (Otherwise you would have to check the number of bytes returned every time you sent a line which is quite annoying.)
+            The inclusion of the send_all flag makes this function send a full line. It's assumed that lines will be small and if the network buffer is full this code won't end up as a bottleneck. (Otherwise you would have to check the number of bytes returned every time you sent a line which is quite annoying.)
             """
             ret = self.send(msg, send_all=1, timeout=timeout)
 
@@ -617,15 +1118,19 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
             else:
                 assert(blocking == 0.0)
 
-        old_buf = self.buf[:]
-        self.buf = u""
+        # Binary mode has a single buffer for lines and raw data.
+        if not self.binary:
+            old_buf = self.buf[:]
+            self.buf = u""
         try:
             future = time.time() + (timeout or self.timeout)
             while True:
-                self.update()
+                # Don't block reading when a reply is already waiting.
+                if not len(self.replies):
+                    self.update()
 
                 # Socket is disconnected.
-                if not self.connected:
+                if not self.connected and not len(self.replies):
                     return u""
 
                 # Non-blocking.
@@ -648,7 +1153,8 @@ It activates after 1 second (after_idle_sec) of idleness, then sends a keepalive
         except:
             pass
         finally:
-            self.buf = old_buf
+            if not self.binary:
+                self.buf = old_buf
 
     """
     These functions here make the class behave like a list. The
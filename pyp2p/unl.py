@@ -33,9 +33,14 @@ class UNL():
         self.nat_type_lookup = {
             "m": "random",
             "g": "preserving",
-            "e": "reuse"
+            "e": "reuse",
+            "a": "delta",
+            "n": "unknown"
         }
 
+        # NAT types older peers can decode (others are sent as random.)
+        self.wire_nat_types = ["random", "preserving", "reuse"]
+
         self.forwarding_type_lookup = {
             "f": "forwarded",
             "m": "manual",
@@ -467,6 +472,10 @@ class UNL():
         if "nat_type" in details:
             nat_type = details["nat_type"]
 
+        # Older peers reject UNLs with NAT codes they don't know.
+        if nat_type not in self.wire_nat_types:
+            nat_type = "random"
+
         # Forwarding type.
         forwarding_type = self.net.forwarding_type
         if "forwarding_type" in details:
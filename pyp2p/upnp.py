@@ -5,9 +5,18 @@ import re, sys, select, socket, time
 try:
     from urllib.request import urlopen
     from urllib.request import Request
+    from urllib.parse import urljoin
+    from urllib.error import HTTPError
 except:
     from urllib2 import urlopen
     from urllib2 import Request
+    from urllib2 import HTTPError
+    from urlparse import urljoin
+
+try:
+    from queue import Queue, Empty
+except:
+    from Queue import Queue, Empty
 
 import multiprocessing
 import threading
@@ -27,6 +36,61 @@ Credits to "Anarchy Angel", "Ngharo", and www.dc414.org
 for the code.
 """
 
+# How long found gateways and control URLs are reused for.
+gateway_ttl = 10 * 60
+
+# Ports routers commonly serve their UPnP description on.
+likely_gateway_ports = [80, 1780, 1900, 1981, 2468, 5555, 5678, 49000, 55345, 65535]
+
+# Interface -> {"addr", "expires"} for the last gateway found.
+found_gateways = {}
+
+# Gateway address -> {"control_url", "service_type", "expires"}.
+control_urls = {}
+
+def forget_gateway(gateway_addr):
+    # Drop cached details for a gateway that stopped answering.
+    for interface in list(found_gateways):
+        if found_gateways[interface]["addr"] == gateway_addr:
+            del found_gateways[interface]
+
+    if gateway_addr in control_urls:
+        del control_urls[gateway_addr]
+
+def is_soap_fault(e):
+    # Gateways report failed actions as an HTTP 500 with a SOAP fault.
+    if not isinstance(e, HTTPError) or e.code != 500:
+        return 0
+
+    try:
+        body = e.read().decode("utf-8", "ignore")
+    except:
+        return 0
+
+    return "Fault" in body
+
+def parse_control_url(gateway_addr, desc):
+    """
+    Finds the WAN connection service in a gateway's device
+    description. Returns {"control_url", "service_type"}.
+    """
+    desc = desc.replace('\r', '').replace('\n', '').replace('\t', '')
+    services = re.findall("<service>(.*?)</service>", desc)
+    for wanted in ["WANIPConnection", "WANPPPConnection"]:
+        for service in services:
+            service_type = re.findall("<serviceType>([^<]+)</serviceType>", service)
+            control_url = re.findall("<controlURL>([^<]+)</controlURL>", service)
+            if not len(service_type) or not len(control_url):
+                continue
+
+            if wanted in service_type[0]:
+                return {
+                    "control_url": urljoin(gateway_addr, control_url[0].strip()),
+                    "service_type": service_type[0].strip()
+                }
+
+    raise Exception("Gateway has no WAN connection service.")
+
 class UPnP():
     def __init__(self, interface=u"default"):
         """
@@ -56,10 +120,88 @@ class UPnP():
         # Address of a UPnP gateway.
         self.gateway = []
 
+        # Gateway address from a previous run (skips discovery.)
+        self.gateway_addr = None
+
+        # Device descriptions fetched while finding the gateway.
+        self.descriptions = {}
+
+    def check_gateway(self, gateway_addr):
+        # Gateway address if it serves an IGD description (or None.)
+        try:
+            desc = urlopen(gateway_addr, timeout=self.timeout).read().decode("utf-8")
+        except:
+            return None
+
+        if "InternetGatewayDevice" not in desc:
+            return None
+
+        self.descriptions[gateway_addr] = desc
+        return gateway_addr
+
+    def scan_gateway(self, ip, ports=None, timeout=5):
+        """
+        Looks for a gateway's description by trying likely ports
+        at the same time. Returns the first one found or None.
+        """
+        if ports is None:
+            ports = likely_gateway_ports
+
+        results = Queue()
+        def check(port):
+            gateway_addr = None
+            try:
+                # Fast connect() / SYN open scanning.
+                s = Sock(ip, port, blocking=1, timeout=timeout, interface=self.interface)
+                s.close()
+
+                # Check response is XML and device is a router.
+                gateway_addr = self.check_gateway("http://" + str(ip) + ":" + str(port) + "/")
+            except:
+                pass
+            finally:
+                results.put(gateway_addr)
+
+        for port in ports:
+            t = Thread(target=check, args=(port,))
+            t.daemon = True
+            t.start()
+
+        # First hit wins.
+        future = time.time() + timeout
+        for i in range(0, len(ports)):
+            remaining = future - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                gateway_addr = results.get(timeout=remaining)
+            except Empty:
+                break
+
+            if gateway_addr is not None:
+                self.gateway.append(gateway_addr)
+                return gateway_addr
+
+        return None
+
     # Uses broadcasting to find default UPnP compatible gateway.
     def find_gateway(self):
-        replies = []
+        # Found recently.
+        cached = found_gateways.get(self.interface)
+        if cached is not None and cached["expires"] > time.time():
+            return cached["addr"]
+
+        gateway_addr = self.discover_gateway()
+        if gateway_addr is not None:
+            found_gateways[self.interface] = {
+                "addr": gateway_addr,
+                "expires": time.time() + gateway_ttl
+            }
+
+        return gateway_addr
 
+    def discover_gateway(self):
         # Create socket for UDP broadcasts.
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.bind(('', self.upnp_port)) #All addresses.
@@ -68,7 +210,7 @@ class UPnP():
 
         # Broadcast search message to multicast address.
         search_msg =  b"M-SEARCH * HTTP/1.1\r\n"
-        search_msg += b"HOST: %s" + self.multicast + b":"
+        search_msg += b"HOST: " + self.multicast + b":"
         if sys.version_info >= (3,0,0):
             search_msg += str(self.upnp_port).encode("ascii")
         else:
@@ -79,155 +221,222 @@ class UPnP():
         search_msg += b"\r\n"
         s.sendto(search_msg, (self.multicast, self.upnp_port))
 
-        # Receive replies for n seconds..
-        old_time = time.time()
-        while (int(time.time()) - int(old_time)) < self.reply_wait:
-            res = select.select([s], [], [], self.timeout)
-            if len(res[0]):
-                (string, addr) = res[0][0].recvfrom(1024)
-                replies.append([addr[0], string])
+        # Check replies as they arrive for up to n seconds.
+        gateway_addr = None
+        checked = set()
+        future = time.time() + self.reply_wait
+        try:
+            while gateway_addr is None:
+                remaining = future - time.time()
+                if remaining <= 0:
+                    break
 
-        # Cleanup socket.
-        if s != None:
+                res = select.select([s], [], [], remaining)
+                if not len(res[0]):
+                    break
+
+                (string, addr) = s.recvfrom(1024)
+                location = re.findall("(?im)^location:\\s*(\\S+)", string.decode("utf-8", "ignore"))
+                if not len(location) or location[0] in checked:
+                    continue
+
+                # Every service on a device replies to ssdp:all.
+                checked.add(location[0])
+                gateway_addr = self.check_gateway(location[0])
+        finally:
+            # Cleanup socket.
             s.close()
-            s = None
 
-        # Error: no UPnP replies - try guess gateway.
-        if replies == []:
-            default_gateway = get_default_gateway(self.interface)
-            if default_gateway == None:
-                return None
-            else:
-                # Optimise scanning.
-                likely_candidates = [80, 1780, 1900, 1981, 2468, 5555, 5678, 49000, 55345, 65535]
-
-                def check_gateway(self, ip, port):
-                    try:
-                        # Fast connect() / SYN open scanning.
-                        s = Sock(ip, port, blocking=1, timeout=5, interface=self.interface)
-                        s.close()
-
-                        # Build http request.
-                        gateway_addr = "http://" + str(ip) + ":" + str(port) + "/"
-                        buf = urlopen(gateway_addr, timeout=self.timeout).read().decode("utf-8")
-
-                        # Check response is XML and device is a router.
-                        if 'InternetGatewayDevice' in buf:
-                            return self.gateway.append(gateway_addr)
-                    except:
-                        return
-
-                # Brute force port by scanning.
-                for port in likely_candidates:
-                    t = Thread(target=check_gateway, args=(self, default_gateway, port))
-                    t.start()
-
-                time.sleep(5)
-                if len(self.gateway):
-                    return self.gateway[0]
-                else:
-                    return None
-
-        # Find gateway address in replies.
-        gateway_addr = None
-        pdata = list(dict((x[0], x) for x in replies).values())
-        # return None
-        rh = []
-        for L in pdata:
-            rh.append(L[0])
-        hosts = []
-        pd = []
-        for host in rh:
-            try:
-                spot = rh.index(host)
-                hdata = pdata[spot][1]
-                url = 'http://' + host + ':'
-                port = re.findall("http:\/\/[0-9\.]+:(\d.+)",
-                                  hdata.decode("utf-8"))
-                url += port[0]
-                p = urlopen(url, timeout=self.timeout)
-                rd = re.findall('schemas-upnp-org:device:([^:]+)',
-                                p.read().decode("utf-8"))
-                if rd[0] == 'InternetGatewayDevice':
-                    gateway_addr = url
-                    break
-            except:
-                continue
+        if gateway_addr is not None:
+            return gateway_addr
 
-        return gateway_addr
+        # Error: no UPnP replies - try guess gateway.
+        default_gateway = get_default_gateway(self.interface)
+        if default_gateway == None:
+            return None
 
-    def forward_port(self, proto, src_port, dest_ip, dest_port=None):
-        """
-        Creates a new mapping for the default gateway to forward ports.
-        Source port is from the perspective of the original client.
-        For example, if a client tries to connect to us on port 80,
-        the source port is port 80. The destination port isn't
-        necessarily 80, however. We might wish to run our web server
-        on a different port so we can have the router forward requests
-        for port 80 to another port (what I call the destination port.)
+        return self.scan_gateway(default_gateway)
 
-        If the destination port isn't specified, it defaults to the
-        source port. Proto is either TCP or UDP. Function returns None
-        on success, otherwise it raises an exception.
-        """
+    def get_control_url(self, gateway_addr):
+        # Cached control URL or fetched from the gateway's description.
+        entry = control_urls.get(gateway_addr)
+        if entry is not None and entry["expires"] > time.time():
+            return entry
 
-        proto = proto.upper()
-        valid_protos = ["TCP", "UDP"]
-        if proto not in valid_protos:
-            raise Exception("Invalid protocol for forwarding.")
+        desc = self.descriptions.pop(gateway_addr, None)
+        if desc is None:
+            desc = urlopen(gateway_addr, timeout=self.timeout).read().decode("utf-8")
 
-        valid_ports = range(1, 65535)
-        if src_port not in valid_ports:
-            raise Exception("Invalid port for forwarding.")
+        entry = parse_control_url(gateway_addr, desc)
+        entry["expires"] = time.time() + gateway_ttl
+        control_urls[gateway_addr] = entry
 
-        # Source port is forwarded to same destination port number.
-        if dest_port == None:
-            dest_port = src_port
+        return entry
 
-        # Use UPnP binary for forwarding on Windows.
-        if platform.system() == "Windows":
-            cmd = "upnpc-static.exe -a %s %s %s %s" % (get_lan_ip(), str(src_port), str(dest_port), proto)
-            subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-            return
+    def find_control_url(self):
+        """
+        Returns (gateway address, control URL details, cached) using
+        the known gateway if it still answers, otherwise discovering
+        it again.
+        """
+        gateway_addr = self.gateway_addr
+        if gateway_addr is None:
+            cached = found_gateways.get(self.interface)
+            if cached is not None and cached["expires"] > time.time():
+                gateway_addr = cached["addr"]
+
+        if gateway_addr is not None:
+            cached = gateway_addr in control_urls
+            try:
+                return gateway_addr, self.get_control_url(gateway_addr), cached
+            except:
+                forget_gateway(gateway_addr)
 
         # Find gateway address.
         gateway_addr = self.find_gateway()
         if gateway_addr == None:
             raise Exception("Unable to find UPnP compatible gateway.")
 
-        # Get control URL.
-        rhost = re.findall('([^/]+)', gateway_addr)
-        res = urlopen(gateway_addr, timeout=self.timeout).read().decode("utf-8")
-        res = res.replace('\r', '')
-        res = res.replace('\n', '')
-        res = res.replace('\t', '')
-        pres = res.split('<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>')
-        p2res = pres[1].split('</controlURL>')
-        p3res = p2res[0].split('<controlURL>')
-        ctrl = p3res[1]
-        rip = res.split('<presentationURL>')
-        rip1 = rip[1].split('</presentationURL>')
-        routerIP = rip1[0]
+        return gateway_addr, self.get_control_url(gateway_addr), 0
 
-        port_map_desc = "PyP2P"
+    def soap_request(self, control, action, args):
+        # Calls action on the gateway's WAN connection service.
+        service_type = control["service_type"]
+        body = ""
+        for name, value in args:
+            body += "<" + name + ">" + str(value) + "</" + name + ">"
         msg = \
-            '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:AddPortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1"><NewRemoteHost></NewRemoteHost><NewExternalPort>' \
-            + str(src_port) \
-            + '</NewExternalPort><NewProtocol>' + str(proto) + '</NewProtocol><NewInternalPort>' \
-            + str(dest_port) + '</NewInternalPort><NewInternalClient>' + str(dest_ip) \
-            + '</NewInternalClient><NewEnabled>1</NewEnabled><NewPortMappingDescription>' + str(port_map_desc) + '</NewPortMappingDescription><NewLeaseDuration>0</NewLeaseDuration></u:AddPortMapping></s:Body></s:Envelope>'
-
-        # Attempt to add new port map.
-        x = 'http://' + rhost[1] + '/' + ctrl
+            '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:' + action + ' xmlns:u="' + service_type + '">' \
+            + body \
+            + '</u:' + action + '></s:Body></s:Envelope>'
+
         if sys.version_info >= (3,0,0):
             msg = bytes(msg, "utf-8")
 
-        req = Request('http://' + rhost[1] + '/' + ctrl, msg)
+        req = Request(control["control_url"], msg)
         req.add_header('SOAPAction',
-                       '"urn:schemas-upnp-org:service:WANIPConnection:1#AddPortMapping"'
+                       '"' + service_type + '#' + action + '"'
                        )
         req.add_header('Content-type', 'application/xml')
-        res = urlopen(req, timeout=self.timeout)
+        return urlopen(req, timeout=self.timeout)
+
+    def add_port_mapping(self, control, proto, src_port, dest_ip, dest_port, lifetime=0):
+        """
+        Attempts to add a new port map. Returns the lease granted (0
+        means permanent.)
+        """
+        port_map_desc = "PyP2P"
+        def add(lifetime):
+            self.soap_request(control, "AddPortMapping", [
+                ("NewRemoteHost", ""),
+                ("NewExternalPort", src_port),
+                ("NewProtocol", proto),
+                ("NewInternalPort", dest_port),
+                ("NewInternalClient", dest_ip),
+                ("NewEnabled", 1),
+                ("NewPortMappingDescription", port_map_desc),
+                ("NewLeaseDuration", lifetime)
+            ])
+
+        try:
+            add(lifetime)
+        except Exception as e:
+            # Some gateways only support permanent leases (they reply
+            # with a SOAP fault, e.g. OnlyPermanentLeasesSupported.)
+            if not lifetime or not is_soap_fault(e):
+                raise
+            add(0)
+            lifetime = 0
+
+        return lifetime
+
+    def delete_port_mapping(self, control, proto, src_port):
+        self.soap_request(control, "DeletePortMapping", [
+            ("NewRemoteHost", ""),
+            ("NewExternalPort", src_port),
+            ("NewProtocol", proto)
+        ])
+
+    def forward_ports(self, mappings, dest_ip, lifetime=0):
+        """
+        Forwards a list of (proto, src_port, dest_port) mappings to
+        dest_ip with one gateway lookup. Lifetime is the lease to ask
+        for in seconds (0 is permanent.) Returns a list of the leases
+        granted.
+        """
+        mappings = parse_port_mappings(mappings)
+
+        # Use UPnP binary for forwarding on Windows.
+        if platform.system() == "Windows":
+            for proto, src_port, dest_port in mappings:
+                cmd = "upnpc-static.exe -a %s %s %s %s" % (get_lan_ip(), str(src_port), str(dest_port), proto)
+                subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+            return [0] * len(mappings)
+
+        def add_all(control):
+            granted = []
+            for proto, src_port, dest_port in mappings:
+                granted.append(self.add_port_mapping(
+                    control, proto, src_port, dest_ip, dest_port, lifetime
+                ))
+
+            return granted
+
+        # Control URL (cached after the first lookup.)
+        gateway_addr, control, cached = self.find_control_url()
+        self.gateway_addr = gateway_addr
+        try:
+            return add_all(control)
+        except:
+            if not cached:
+                raise
+
+            # The gateway may have changed (e.g. router restarted.)
+            forget_gateway(gateway_addr)
+            self.gateway_addr = None
+            gateway_addr, control, cached = self.find_control_url()
+            self.gateway_addr = gateway_addr
+            return add_all(control)
+
+    def remove_ports(self, mappings):
+        """
+        Removes (proto, src_port, dest_port) mappings added by
+        forward_ports(). Returns the number removed.
+        """
+        mappings = parse_port_mappings(mappings)
+        if platform.system() == "Windows":
+            for proto, src_port, dest_port in mappings:
+                cmd = "upnpc-static.exe -d %s %s" % (str(src_port), proto)
+                subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+            return len(mappings)
+
+        gateway_addr, control, cached = self.find_control_url()
+        self.gateway_addr = gateway_addr
+        removed = 0
+        for proto, src_port, dest_port in mappings:
+            try:
+                self.delete_port_mapping(control, proto, src_port)
+                removed += 1
+            except:
+                continue
+
+        return removed
+
+    def forward_port(self, proto, src_port, dest_ip, dest_port=None):
+        """
+        Creates a new mapping for the default gateway to forward ports.
+        Source port is from the perspective of the original client.
+        For example, if a client tries to connect to us on port 80,
+        the source port is port 80. The destination port isn't
+        necessarily 80, however. We might wish to run our web server
+        on a different port so we can have the router forward requests
+        for port 80 to another port (what I call the destination port.)
+
+        If the destination port isn't specified, it defaults to the
+        source port. Proto is either TCP or UDP. Function returns None
+        on success, otherwise it raises an exception.
+        """
+        self.forward_ports([(proto, src_port, dest_port)], dest_ip)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+"""
+Fakes shared by the tests.
+"""
+
+import socket
+import threading
+import time
+
+
+class LineServer():
+    # Minimal rendezvous server: replies to BOOTSTRAP / SOURCE TCP.
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.accepted = 0
+        self.ignore_source = 0 # SOURCE TCP requests left unanswered.
+        self.lines = []
+        self.cons = []
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while 1:
+            try:
+                con, addr = self.listener.accept()
+            except socket.error:
+                return
+
+            self.accepted += 1
+            self.cons.append(con)
+            thread = threading.Thread(target=self.handle, args=(con, addr))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, con, addr):
+        buf = b""
+        while 1:
+            try:
+                data = con.recv(1024)
+            except socket.error:
+                return
+            if not data:
+                return
+
+            buf += data
+            while b"\r\n" in buf:
+                line, buf = buf.split(b"\r\n", 1)
+                line = line.decode("ascii")
+                self.lines.append(line)
+                if line.startswith("BOOTSTRAP"):
+                    con.sendall(b"NODES EMPTY\r\n")
+                if line.startswith("SOURCE TCP"):
+                    if self.ignore_source:
+                        self.ignore_source -= 1
+                        continue
+
+                    time.sleep(0.05)
+                    reply = "REMOTE TCP %d\r\n" % addr[1]
+                    con.sendall(reply.encode("ascii"))
+
+    def drop_cons(self):
+        for con in self.cons:
+            con.shutdown(socket.SHUT_RDWR)
+            con.close()
+        self.cons = []
+
+    def close(self):
+        self.drop_cons()
+        self.listener.close()
@@ -0,0 +1,94 @@
+from unittest import TestCase
+from pyp2p.aio import AsyncNet
+import asyncio
+import hashlib
+
+
+class test_aio(TestCase):
+    def run_coroutine(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_line_framing(self):
+        async def test():
+            net = AsyncNet(passive_bind="127.0.0.1", passive_port=0,
+                           wan_ip="8.8.4.4")
+            net.net.enable_duplicate_ip_cons = 1
+            net.net.disable_duplicates()
+            await net.start_server()
+
+            con = await net.add_node("127.0.0.1", net.net.passive_port,
+                                     "passive")
+            assert(con is not None)
+            con.send(b"first\r")
+            con.send(b"\n\r\nsecond\r\n")
+            await asyncio.sleep(0.1)
+            assert(len(net.inbound) == 1)
+            inbound = net.inbound[0]
+            assert(await inbound.recv_line() == u"first")
+            assert(await inbound.recv_line() == u"second")
+            assert(await inbound.recv_line(timeout=0.1) == u"")
+
+            con.close()
+            await asyncio.sleep(0.1)
+            assert(not len(net))
+            await net.stop()
+
+        self.run_coroutine(test())
+
+    def test_wait_for_nonce(self):
+        async def test():
+            net = AsyncNet(net_type="direct", passive_bind="127.0.0.1",
+                           passive_port=0, wan_ip="8.8.4.4")
+            await net.start_server()
+            nonce = hashlib.sha256(b"nonce").hexdigest()
+            con_id = net.net.generate_con_id(nonce, "127.0.0.1", "8.8.4.4")
+
+            async def connect():
+                await asyncio.sleep(0.1)
+                con = await net.add_node("127.0.0.1", net.net.passive_port,
+                                         "passive")
+                con.nonce = nonce
+                con.send(nonce)
+                con.send_line("hello")
+
+            asyncio.ensure_future(connect())
+            con = await net.wait_for_con(con_id, timeout=5, by_id=1)
+            assert(con is not None)
+            assert(con.nonce == nonce)
+            assert(await con.recv_line() == u"hello")
+            await net.stop()
+
+        self.run_coroutine(test())
+
+    def test_shared_scheduler(self):
+        async def test():
+            net = AsyncNet(passive_bind="127.0.0.1", passive_port=0,
+                           wan_ip="8.8.4.4")
+            net.net.max_outbound = 0
+            net.net.node_type = "active"
+            net.net.is_net_started = 1
+            scheduler = net.net.scheduler
+
+            # Async calls schedule the next run on Net's scheduler.
+            assert(await net.bootstrap() is net)
+            assert(await net.advertise() is net)
+            for name in ["bootstrap", "advertise"]:
+                assert(not scheduler.is_due(name))
+
+            # ... which both front ends respect.
+            assert(await net.bootstrap() is None)
+            assert(await net.advertise() is None)
+            assert(net.net.bootstrap() is None)
+            assert(net.net.advertise() is None)
+
+            # And the other way round.
+            scheduler.cancel("bootstrap")
+            net.net.bootstrap()
+            assert(not scheduler.is_due("bootstrap"))
+            assert(await net.bootstrap() is None)
+
+        self.run_coroutine(test())
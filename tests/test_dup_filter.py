@@ -0,0 +1,69 @@
+from unittest import TestCase
+from pyp2p.dup_filter import SeenCache, RotatingBloomFilter, msg_digest
+
+
+class test_dup_filter(TestCase):
+    def test_seen_cache(self):
+        now = [1000.0]
+        cache = SeenCache(ttl=60, max_size=3, retransmit_interval=5,
+                          max_times=2, clock=lambda: now[0])
+
+        # Digests are raw 32 byte keys.
+        assert(len(msg_digest(u"test")) == 32)
+        assert(msg_digest(u"test") == msg_digest(b"test"))
+
+        # Duplicates inside the retransmit interval.
+        assert(not cache.check(u"a", record_seen=1))
+        assert(cache.check(u"a", record_seen=1))
+        assert(u"a" in cache)
+
+        # Allowed again after the interval until max_times.
+        now[0] += 5
+        assert(not cache.check(u"a", record_seen=1))
+        now[0] += 5
+        assert(cache.check(u"a", record_seen=1))
+        assert(cache.hits == 2)
+        assert(cache.misses == 2)
+
+        # Size based eviction drops the least recently seen.
+        cache.check(u"b", record_seen=1)
+        cache.check(u"c", record_seen=1)
+        cache.check(u"d", record_seen=1)
+        assert(len(cache) == 3)
+        assert(u"a" not in cache)
+        assert(cache.evictions == 1)
+
+        # TTL based expiry.
+        now[0] += 61
+        cache.expire()
+        assert(len(cache) == 0)
+        assert(cache.stats()["evictions"] == 4)
+
+    def test_rotating_bloom_filter(self):
+        bloom = RotatingBloomFilter(capacity=1000, error_rate=0.01)
+        assert(bloom.current.hash_no == 7)
+
+        # No false negatives.
+        for i in range(0, 1000):
+            bloom.check(str(i), record_seen=1)
+        for i in range(0, 1000):
+            assert(bloom.check(str(i)))
+
+        # False positives stay near the error rate.
+        false_positives = 0
+        for i in range(1000, 11000):
+            false_positives += bloom.check(str(i))
+        assert(false_positives < 300)
+
+        # Old generations are dropped once full.
+        for i in range(20000, 22001):
+            bloom.record(str(i))
+        assert(bloom.rotations == 2)
+
+        # Sized from a memory budget.
+        bloom = RotatingBloomFilter(error_rate=0.001, max_bytes=64 * 1024)
+        assert(bloom.memory_usage() <= 32 * 1024)
+        bloom.record(u"test")
+        assert(u"test" in bloom)
+        bloom.clear()
+        assert(u"test" not in bloom)
@@ -0,0 +1,63 @@
+from unittest import TestCase
+from pyp2p.event_loop import EventLoop
+import pyp2p.event_loop
+import socket
+import time
+
+
+class test_event_loop(TestCase):
+    def setUp(self):
+        # Needs Python 3.4+.
+        if pyp2p.event_loop.selectors is None:
+            self.skipTest("selectors isn't available")
+
+    def test_read_write_callbacks(self):
+        a, b = socket.socketpair()
+        loop = EventLoop()
+        events = []
+
+        def on_read(sock):
+            events.append(("read", sock.recv(10)))
+
+        def on_write(sock):
+            events.append(("write", None))
+            loop.set_write(sock, None)
+
+        # Only write interest at first.
+        loop.register(a, write=on_write)
+        assert(loop.poll(0) == 1)
+        assert(events == [("write", None)])
+        assert(loop.poll(0) == 0)
+
+        # Read once data arrives.
+        loop.set_read(a, on_read)
+        assert(loop.poll(0) == 0)
+        b.sendall(b"hello")
+        loop.poll(1)
+        assert(events[-1] == ("read", b"hello"))
+
+        # Unregistered objects aren't polled.
+        loop.unregister(a)
+        b.sendall(b"x")
+        assert(loop.poll(0) == 0)
+
+        loop.close()
+        a.close()
+        b.close()
+
+    def test_idle_poll(self):
+        loop = EventLoop()
+        idle_timeout = pyp2p.event_loop.idle_timeout
+        pyp2p.event_loop.idle_timeout = 0.2
+        try:
+            # Nothing registered: sleeps rather than returning at once.
+            start = time.time()
+            assert(loop.poll() == 0)
+            assert(time.time() - start >= 0.15)
+
+            start = time.time()
+            assert(loop.poll(0) == 0)
+            assert(time.time() - start < 0.15)
+        finally:
+            pyp2p.event_loop.idle_timeout = idle_timeout
+            loop.close()
@@ -0,0 +1,60 @@
+from unittest import TestCase
+from pyp2p.lease_manager import *
+import time
+
+
+class Forwarder():
+    # Records calls instead of talking to a gateway.
+    def __init__(self, granted=1):
+        self.granted = granted
+        self.forwarded = []
+        self.removed = []
+        self.fail = 0
+
+    def forward_ports(self, mappings, dest_ip, lifetime):
+        if self.fail:
+            self.fail -= 1
+            raise Exception("Gateway is down.")
+
+        self.forwarded.append((list(mappings), dest_ip, lifetime))
+        return [self.granted] * len(mappings)
+
+    def remove_ports(self, mappings):
+        self.removed.append(list(mappings))
+        return len(mappings)
+
+
+class test_lease_manager(TestCase):
+    def test_renewal(self):
+        leases = LeaseManager(renew_fraction=0.5, retry_interval=0.1)
+        forwarder = Forwarder(granted=0.4)
+        leases.renew_delay = lambda granted: granted * 0.5
+        mappings = [("TCP", 50500, None), ("UDP", 50500, None)]
+        name = leases.add(forwarder, mappings, "192.168.0.2", 2)
+        assert(forwarder.forwarded[0] == (mappings, "192.168.0.2", 2))
+
+        # Renewed as a batch before each lease runs out.
+        time.sleep(0.5)
+        assert(len(forwarder.forwarded) >= 2)
+        assert(leases.leases[name]["renewals"] >= 1)
+
+        # Failed renewals are retried.
+        forwarder.fail = 1
+        renewals = leases.leases[name]["renewals"]
+        time.sleep(0.5)
+        assert(leases.leases[name]["renewals"] > renewals)
+
+        # Removed on close.
+        assert(leases.close() == 1)
+        assert(forwarder.removed == [mappings])
+        forwarded = len(forwarder.forwarded)
+        time.sleep(0.3)
+        assert(len(forwarder.forwarded) == forwarded)
+        assert(not len(leases))
+
+    def test_permanent(self):
+        leases = LeaseManager()
+        forwarder = Forwarder(granted=0)
+        leases.add(forwarder, [("TCP", 50500, None)], "192.168.0.2")
+        assert(leases.scheduler.time_until_next() is None)
+        assert(leases.close() == 1)
@@ -150,3 +150,25 @@ class test_lib(TestCase):
 
     def test_get_wan_ip(self):
         assert (is_ip_valid(get_wan_ip()))
+
+    def test_disk_cache(self):
+        import tempfile
+        import shutil
+        cache_dir = tempfile.mkdtemp()
+        path = os.path.join(cache_dir, "sub", "cache.json")
+        now = [1000.0]
+        cache = DiskCache(path, ttl=60, clock=lambda: now[0])
+        assert(cache.get("nat") is None)
+        assert(cache.set("nat", {"nat_type": "delta", "delta": 2}))
+
+        # Survives a restart until it expires.
+        cache = DiskCache(path, ttl=60, clock=lambda: now[0])
+        assert(cache.get("nat") == {"nat_type": "delta", "delta": 2})
+        now[0] += 61
+        assert(cache.get("nat") is None)
+
+        # Corrupt files are ignored.
+        with open(path, "w") as cache_file:
+            cache_file.write("{")
+        assert(DiskCache(path).get("nat") is None)
+        shutil.rmtree(cache_dir)
@@ -10,3 +10,46 @@ class test_nat_pmp(TestCase):
         except Exception as e:
             print(e)
             assert ("does not support NAT-PMP" in str(e))
+
+    def test_forward_ports(self):
+        import struct
+        import socket
+        import threading
+
+        # Fake gateway (needs the NAT-PMP port.)
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server.bind(("127.0.0.1", NATPMP_PORT))
+        except socket.error:
+            server.close()
+            return
+
+        requests = []
+        def serve():
+            while 1:
+                try:
+                    data, addr = server.recvfrom(1024)
+                except socket.error:
+                    return
+                version, opcode, reserved, private_port, public_port, lifetime = struct.unpack("!BBHHHI", data)
+                requests.append((opcode, private_port, public_port, lifetime))
+                reply = struct.pack("!BBHIHHI", 0, opcode + 128, 0, 1, private_port, public_port, lifetime)
+                server.sendto(reply, addr)
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        nat_pmp = NatPMP()
+        nat_pmp.gateway_ip = "127.0.0.1"
+        mappings = [("TCP", 50500, None), ("UDP", 50501, 50502)]
+        assert(nat_pmp.forward_ports(mappings, lifetime=60) == [60, 60])
+        assert((NATPMP_PROTOCOL_TCP, 50500, 50500, 60) in requests)
+        assert((NATPMP_PROTOCOL_UDP, 50502, 50501, 60) in requests)
+
+        response = nat_pmp.forward_port("TCP", 50503, "127.0.0.1")
+        assert(response.public_port == 50503)
+        assert(response.opcode == NATPMP_PROTOCOL_TCP + 128)
+
+        assert(nat_pmp.remove_ports(mappings[:1]) == 1)
+        assert(requests[-1] == (NATPMP_PROTOCOL_TCP, 50500, 0, 0))
+        server.close()
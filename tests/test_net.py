@@ -2,10 +2,31 @@ from unittest import TestCase
 from pyp2p.lib import *
 from pyp2p.dht_msg import DHT
 from pyp2p.net import *
+import pyp2p.net
 import random
 from threading import Thread
 import time
 
+try:
+    from tests.helpers import LineServer
+except ImportError:
+    # Run from inside tests/.
+    from helpers import LineServer
+
+
+# A Net with a passive server on localhost that never talks to the
+# rendezvous server.
+def local_net(**kwargs):
+    net = Net(passive_bind="127.0.0.1", passive_port=0, wan_ip="8.8.4.4",
+              **kwargs)
+    net.disable_advertise()
+    net.disable_bootstrap()
+    net.enable_duplicate_ip_cons = 1
+    net.start_passive_server()
+
+    return net
+
+
 class test_net(TestCase):
     def test_nat_tcp_hole_punch(self):
         """
@@ -483,7 +504,7 @@ class test_net(TestCase):
         assert(len(replies) >= 1)
 
         # Disable duplicates.
-        clear_seen_messages()
+        net.seen_messages.clear()
         net.enable_duplicates = 1
         con.send_line("SOURCE TCP")
         con.send_line("SOURCE TCP 0")
@@ -601,3 +622,290 @@ class test_net(TestCase):
         assert(len(net.unl.pending_sim_open) == 2)
         net.stop()
 
+
+    def test_poll(self):
+        net = local_net()
+
+        replies = []
+
+        def reply_handler(con, reply):
+            replies.append(reply)
+
+        net.add_reply_handler(reply_handler)
+
+        # Accept inbound con.
+        client = Sock("127.0.0.1", net.passive_port, blocking=1)
+        net.poll(1)
+        assert(len(net.inbound) == 1)
+
+        # Replies are dispatched to handlers.
+        client.send_line("test 1")
+        client.send_line("test 2")
+        end_time = time.time() + 5
+        while len(replies) < 2 and time.time() < end_time:
+            net.poll(1)
+        assert(replies == ["test 1", "test 2"])
+
+        # Closed cons are reaped.
+        client.close()
+        end_time = time.time() + 5
+        while len(net.inbound) and time.time() < end_time:
+            net.poll(1)
+        assert(not len(net.inbound))
+
+        net.stop()
+
+    def test_idle_poll(self):
+        net = local_net()
+        net.poll(0)
+
+        # Nothing scheduled: poll(None) returns after idle_poll_timeout.
+        idle_poll_timeout = pyp2p.net.idle_poll_timeout
+        pyp2p.net.idle_poll_timeout = 0.2
+        try:
+            assert(net.scheduler.time_until_next() is None)
+            start = time.time()
+            net.poll()
+            assert(0.15 <= time.time() - start < 2)
+
+            # The next deadline wins when it's sooner.
+            net.scheduler.schedule("test", 0.05, lambda: None)
+            start = time.time()
+            net.poll()
+            assert(time.time() - start < 0.15)
+        finally:
+            pyp2p.net.idle_poll_timeout = idle_poll_timeout
+            net.stop()
+
+    def test_con_indexes(self):
+        net = local_net()
+        client = Sock("127.0.0.1", net.passive_port, blocking=1)
+        net.poll(1)
+        assert(len(net.inbound) == 1)
+        con = net.inbound[0]["con"]
+
+        # Indexed by IP.
+        assert(net.con_by_ip("127.0.0.1") is con)
+        net.enable_duplicate_ip_cons = 0
+        net.nodes_by_ip["8.8.8.8"] = net.nodes_by_ip["127.0.0.1"]
+        assert(not net.validate_node("8.8.8.8"))
+        del net.nodes_by_ip["8.8.8.8"]
+
+        # Indexed by UNL.
+        con.unl = "unl 1"
+        assert(net.con_by_unl("unl 1") is con)
+        con.unl = "unl 2"
+        assert(net.con_by_unl("unl 1") is None)
+        assert(net.con_by_unl("unl 2") is con)
+
+        # Indexed by con ID once the nonce is set.
+        nonce = "0" * 64
+        con_id = net.generate_con_id(nonce, "127.0.0.1", net.wan_ip)
+        assert(net.con_by_id(con_id) is None)
+        con.nonce = nonce
+        assert(con.con_id == con_id)
+        assert(net.con_by_id(con_id) is con)
+
+        # Reaped cons are removed from every index.
+        client.close()
+        end_time = time.time() + 5
+        while len(net.inbound) and time.time() < end_time:
+            net.poll(1)
+        assert(not len(net.inbound))
+        assert(net.con_by_ip("127.0.0.1") is None)
+        assert(net.con_by_unl("unl 2") is None)
+        assert(net.con_by_id(con_id) is None)
+        assert(not len(net.nodes_by_ip))
+
+        net.stop()
+
+    def test_generate_con_id(self):
+        net = Net(passive_port=0, wan_ip="8.8.4.4")
+        nonce = "1" * 64
+
+        # Both sides derive the same ID.
+        con_id = net.generate_con_id(nonce, "1.2.3.4", "5.6.7.8")
+        assert(net.generate_con_id(nonce, "5.6.7.8", "1.2.3.4") == con_id)
+        assert(net.generate_con_id(nonce, b"1.2.3.4", "5.6.7.8") == con_id)
+        assert(net.generate_con_id("2" * 64, "1.2.3.4", "5.6.7.8") != con_id)
+
+        # Fingerprints are memoized per IP pair.
+        assert(("1.2.3.4", "5.6.7.8") in net.con_fingerprints)
+        net.con_fingerprints[("1.2.3.4", "5.6.7.8")] = b"x"
+        assert(net.generate_con_id(nonce, "1.2.3.4", "5.6.7.8") != con_id)
+
+    def test_connectivity_profile(self):
+        import tempfile
+        import shutil
+        cache_dir = tempfile.mkdtemp()
+        path = os.path.join(cache_dir, "cache.json")
+        net = Net(passive_port=50613, wan_ip="8.8.4.4", profile_path=path)
+        if net.profile_key() is None:
+            shutil.rmtree(cache_dir)
+            self.skipTest("no network fingerprint")
+
+        net.nat_type = "delta"
+        net.rendezvous.delta = 2
+        net.node_type = "passive"
+        net.forwarding_type = "UPnP"
+        net.upnp_gateway = "http://192.168.0.1:5000/rootDesc.xml"
+        assert(net.save_profile())
+
+        # Restarts skip WAN IP, NAT and node detection.
+        net = Net(passive_port=50613, profile_path=path)
+        assert(net.wan_ip == "8.8.4.4")
+        assert(net.apply_profile() == set(["nat_type", "node_type"]))
+        assert(net.nat_type == "delta")
+        assert(net.rendezvous.delta == 2)
+        assert(net.node_type == "passive")
+        assert(net.forwarding_type == "UPnP")
+        assert(net.upnp_gateway == "http://192.168.0.1:5000/rootDesc.xml")
+
+        # Manually set details win.
+        net = Net(passive_port=50613, profile_path=path, nat_type="random")
+        assert(net.apply_profile() == set(["node_type"]))
+        assert(net.nat_type == "random")
+
+        # Profiles are per port.
+        net = Net(passive_port=50614, wan_ip="8.8.4.4", profile_path=path)
+        assert(net.apply_profile() == set())
+        shutil.rmtree(cache_dir)
+
+    def test_background_start(self):
+        server = LineServer()
+        net = Net(
+            net_type="direct", passive_port=0, wan_ip="8.8.4.4",
+            profile_path=None
+        )
+        net.rendezvous.rendezvous_servers = [
+            {"addr": "127.0.0.1", "port": server.port}
+        ]
+        net.disable_forwarding()
+
+        # Returns straight away as an active node accepting cons.
+        start = time.time()
+        net.start(background=1)
+        assert(time.time() - start < 0.5)
+        assert(net.node_type == "active")
+        unl = net.unl.value
+        con = Sock("127.0.0.1", net.passive_port, blocking=1)
+        con.close()
+
+        # Upgrades once detection finishes.
+        assert(net.wait_ready(10))
+        assert(net.phases["rendezvous"].is_set())
+        assert(not len(net.phase_errors))
+        assert(net.nat_type == "preserving")
+        assert(net.node_type == "simultaneous")
+        assert(net.unl.value != unl)
+        assert(net.unl.deconstruct(net.unl.value)["node_type"] == "simultaneous")
+
+        # Listens for challenges straight away.
+        assert(net.rendezvous.server_con is not None)
+        end_time = time.time() + 5
+        while "SIMULTANEOUS READY 0 0" not in server.lines:
+            assert(time.time() < end_time)
+            time.sleep(0.01)
+
+        net.stop()
+        server.close()
+
+    def test_synchronize_incremental(self):
+        net = local_net(net_type="direct")
+        client = Sock("127.0.0.1", net.passive_port, blocking=1)
+        net.synchronize()
+        assert(len(net.inbound) == 1)
+        con = net.inbound[0]["con"]
+
+        # Only cons without a nonce are read for one.
+        assert(net.nonce_pending == set([con]))
+        nonce = "1" * 64
+        client.send(nonce, send_all=1)
+        end_time = time.time() + 5
+        while con.nonce is None and time.time() < end_time:
+            net.synchronize()
+        assert(con.nonce == nonce)
+        assert(not len(net.nonce_pending))
+
+        # Reverse queries time out.
+        net.reverse_query_expiry = 0
+        net.add_reverse_query({
+            "unl": "test",
+            "con": con,
+            "timestamp": time.time()
+        })
+        net.synchronize()
+        assert(not len(net.pending_reverse_queries))
+        assert(not con.connected)
+
+        # Closed cons are reaped.
+        assert(con in net.closed_cons)
+        net.synchronize()
+        assert(not len(net.inbound))
+        assert(not len(net.closed_cons))
+        assert(not len(net.node_by_con))
+
+        client.close()
+        net.stop()
+
+    def test_reconnect_not_reaped(self):
+        net = local_net()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(5)
+        con = Sock("127.0.0.1", server.getsockname()[1], blocking=1)
+        node = {
+            "con": con,
+            "type": "passive",
+            "ip": "127.0.0.1",
+            "port": server.getsockname()[1]
+        }
+        net.add_connection(node, net.outbound)
+        net.poll(0)
+
+        # Closing queues the con for reaping, reconnecting cancels it.
+        con.close()
+        assert(con in net.closed_cons)
+        con.reconnect()
+        assert(con.connected)
+        assert(con not in net.closed_cons)
+        assert(net.event_loop.is_registered(con))
+        net.poll(0)
+        assert(net.outbound == [node])
+
+        con.close()
+        server.close()
+        net.stop()
+
+    def test_queue_broadcast(self):
+        net = local_net()
+
+        clients = []
+        for i in range(0, 3):
+            clients.append(Sock("127.0.0.1", net.passive_port, blocking=1))
+            net.poll(1)
+        assert(len(net.inbound) == 3)
+
+        # Paused cons are skipped.
+        paused = net.inbound[0]["con"]
+        paused.send_paused = 1
+        results = net.queue_broadcast("test")
+        assert(results["skipped"] == [paused])
+        assert(len(results["accepted"]) == 2)
+        paused.send_paused = 0
+
+        # Everyone except the source gets the message.
+        source = net.inbound[1]["con"]
+        results = net.queue_broadcast("test 2", source_con=source)
+        assert(len(results["accepted"]) == 2)
+        assert(source not in results["accepted"])
+        net.poll(0)
+
+        lines = []
+        for client in clients:
+            lines.append(client.recv_line())
+        assert(sorted(lines) == ["test", "test", "test 2"])
+
+        for client in clients:
+            client.close()
+        net.stop()
@@ -0,0 +1,65 @@
+from unittest import TestCase
+from pyp2p.node_registry import NodeRegistry
+import random
+
+
+class test_node_registry(TestCase):
+    def test_insert_delete(self):
+        nodes = NodeRegistry()
+        for i in range(0, 5):
+            nodes["1.1.1.%d" % i] = {"port": i}
+        assert(len(nodes) == 5)
+        assert("1.1.1.2" in nodes)
+        assert(nodes["1.1.1.2"]["port"] == 2)
+
+        # Updates keep one entry.
+        nodes["1.1.1.2"] = {"port": 20}
+        assert(len(nodes) == 5)
+        assert(nodes.get("1.1.1.2")["port"] == 20)
+
+        # Deletes swap the last key into the hole.
+        del nodes["1.1.1.1"]
+        del nodes["1.1.1.4"]
+        assert(len(nodes) == 3)
+        assert("1.1.1.1" not in nodes)
+        assert(nodes.get("1.1.1.1") is None)
+        assert(sorted(nodes) == ["1.1.1.0", "1.1.1.2", "1.1.1.3"])
+        for key in nodes:
+            assert(nodes.keys[nodes.positions[key]] == key)
+
+        # Safe to delete while iterating.
+        for key in nodes:
+            del nodes[key]
+        assert(not len(nodes))
+
+    def test_sample(self):
+        nodes = NodeRegistry(random.Random(1))
+        for i in range(0, 100):
+            nodes["1.1.1.%d" % i] = {"port": i}
+
+        # Distinct keys, never more than asked for or registered.
+        sample = nodes.sample(10)
+        assert(len(sample) == 10)
+        assert(len(set(sample)) == 10)
+        assert(sorted(nodes.sample(1000)) == sorted(nodes))
+        assert(NodeRegistry().sample(5) == [])
+
+        # Skipped keys don't count.
+        def skip(key, value):
+            return value["port"] % 2
+        sample = nodes.sample(50, skip)
+        assert(len(sample) == 50)
+        assert(all([nodes[key]["port"] % 2 == 0 for key in sample]))
+
+        # Sampling doesn't reorder the registry.
+        keys = list(nodes.keys)
+        nodes.sample(50)
+        assert(nodes.keys == keys)
+
+        # Roughly uniform.
+        counts = dict([(key, 0) for key in nodes])
+        for i in range(0, 2000):
+            for key in nodes.sample(5):
+                counts[key] += 1
+        assert(min(counts.values()) > 50)
+        assert(max(counts.values()) < 150)
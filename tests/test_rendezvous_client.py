@@ -2,6 +2,13 @@ from unittest import TestCase
 from pyp2p.lib import *
 from pyp2p.rendezvous_client import *
 import random
+import threading
+
+try:
+    from tests.helpers import LineServer
+except ImportError:
+    # Run from inside tests/.
+    from helpers import LineServer
 
 # if sys.version_info >= (3,0,0):
 
@@ -15,6 +22,180 @@ class test_rendezvous_client(TestCase):
         assert(con != None)
         con.close()
 
+    def test_server_race(self):
+        # Dead server: connects hang once its backlog is full.
+        dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dead.bind(("127.0.0.1", 0))
+        dead.listen(0)
+        fill = []
+        for i in range(0, 5):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(0)
+            s.connect_ex(dead.getsockname())
+            fill.append(s)
+
+        live = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        live.bind(("127.0.0.1", 0))
+        live.listen(5)
+        servers = [
+            {"addr": "127.0.0.1", "port": dead.getsockname()[1]},
+            {"addr": "127.0.0.1", "port": live.getsockname()[1]}
+        ]
+        client = RendezvousClient(nat_type="preserving", rendezvous_servers=servers)
+
+        # Live server wins after one stagger delay.
+        start = time.time()
+        con = client.server_connect()
+        assert(time.time() - start < 1)
+        assert(con.connected)
+        assert(con.port == servers[1]["port"])
+        con.close()
+
+        # The hung connect it gave up on counts as a timeout.
+        stats = client.server_stats[("127.0.0.1", servers[1]["port"])]
+        assert(stats["rtt"] is not None)
+        stats = client.server_stats[("127.0.0.1", servers[0]["port"])]
+        assert(stats["failures"] == 1)
+
+        # Servers that answer are tried first next time, then servers
+        # without history, then ones that failed.
+        unknown = {"addr": "127.0.0.1", "port": 1}
+        client.rendezvous_servers.append(unknown)
+        assert(client.ordered_servers() == [servers[1], unknown, servers[0]])
+        client.rendezvous_servers.remove(unknown)
+
+        # And the next race doesn't wait on the hung server.
+        start = time.time()
+        con = client.server_connect()
+        assert(time.time() - start < 0.2)
+        assert(con.port == servers[1]["port"])
+        con.close()
+
+        for s in fill + [dead, live]:
+            s.close()
+
+    def test_session(self):
+        server = LineServer()
+        servers = [{"addr": "127.0.0.1", "port": server.port}]
+        client = RendezvousClient(nat_type="preserving", rendezvous_servers=servers)
+        session = client.session
+
+        # Replies are matched to commands in order.
+        replies = session.pipeline([
+            "PASSIVE READY 50500 10",
+            "SOURCE TCP",
+            "BOOTSTRAP 5",
+            "CLEAR"
+        ])
+        assert(replies[0] is None)
+        assert(replies[1] == "REMOTE TCP %d" % session.con.s.getsockname()[1])
+        assert(replies[2] == "NODES EMPTY")
+        assert(replies[3] is None)
+
+        # Commands share one connection.
+        assert(client.passive_listen(50500))
+        assert(client.leave_fight())
+        assert(session.request("BOOTSTRAP 5") == "NODES EMPTY")
+        assert(server.accepted == 1)
+
+        # Reconnects when the server drops the connection.
+        server.drop_cons()
+        time.sleep(0.1)
+        assert(session.request("BOOTSTRAP 5") == "NODES EMPTY")
+        assert(server.accepted == 2)
+        assert(session.connects == 2)
+
+        # Commands without a reply don't go to a dropped connection.
+        server.drop_cons()
+        time.sleep(0.1)
+        assert(client.leave_fight())
+        end_time = time.time() + 5
+        while server.lines[-1] != "CLEAR" and time.time() < end_time:
+            time.sleep(0.01)
+        assert(server.lines[-1] == "CLEAR")
+        assert(server.accepted == 3)
+
+        # Idle connections are replaced.
+        session.last_used -= session.idle_timeout
+        assert(client.leave_fight())
+        assert(session.connects == 4)
+
+        session.close()
+        server.close()
+
+    def test_determine_nat(self):
+        import tempfile
+        import shutil
+        server = LineServer()
+        servers = [{"addr": "127.0.0.1", "port": server.port}]
+        cache_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(cache_dir, "cache.json")
+        client = RendezvousClient(
+            nat_type="unknown", rendezvous_servers=servers,
+            cache_path=cache_path
+        )
+
+        # Probes overlap (each reply is delayed by the server.)
+        start = time.time()
+        socks = [mapping["sock"] for mapping in sequential_bind(5)]
+        remote_ports = client.probe_mappings(socks)
+        assert(time.time() - start < 0.2)
+        assert(remote_ports == [s.getsockname()[1] for s in socks])
+        for s in socks:
+            s.close()
+
+        # Loopback preserves ports.
+        assert(client.determine_nat() == "preserving")
+
+        # Restarts use the cached result.
+        if client.nat_cache_key() is not None:
+            accepted = server.accepted
+            client = RendezvousClient(
+                nat_type="unknown", rendezvous_servers=servers,
+                cache_path=cache_path
+            )
+            assert(client.determine_nat() == "preserving")
+            assert(server.accepted == accepted)
+
+        server.close()
+        shutil.rmtree(cache_dir)
+
+    def test_partial_probes(self):
+        import tempfile
+        import shutil
+        flaky = LineServer()
+        good = LineServer()
+        servers = [
+            {"addr": "127.0.0.1", "port": flaky.port},
+            {"addr": "127.0.0.1", "port": good.port}
+        ]
+        cache_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(cache_dir, "cache.json")
+        client = RendezvousClient(
+            nat_type="unknown", rendezvous_servers=servers,
+            cache_path=cache_path
+        )
+        client.nat_test_timeout = 0.3
+
+        # One unanswered probe: the next server is asked for all of them.
+        flaky.ignore_source = 1
+        mappings = client.map_ports(lambda: sequential_bind(5))
+        assert(all([m["remote"] == m["source"] for m in mappings]))
+        assert(good.accepted == 5)
+
+        # Nothing but the flaky server: the guess isn't cached.
+        client.rendezvous_servers = servers[:1]
+        flaky.ignore_source = 6
+        assert(client.determine_nat() == "preserving")
+        assert(not client.nat_test_complete)
+        cache_key = client.nat_cache_key()
+        if cache_key is not None:
+            assert(client.nat_cache.get(cache_key) is None)
+
+        flaky.close()
+        good.close()
+        shutil.rmtree(cache_dir)
+
     def test_00001(self):
         from pyp2p.net import rendezvous_servers
         client = RendezvousClient(nat_type="preserving", rendezvous_servers=rendezvous_servers)
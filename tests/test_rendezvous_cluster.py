@@ -0,0 +1,248 @@
+from unittest import TestCase
+import pyp2p.rendezvous_server
+from pyp2p.rendezvous_cluster import *
+from pyp2p.rendezvous_log import *
+from twisted.internet.task import Clock
+import json
+import shutil
+import socket
+import tempfile
+import time
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+
+class LoopbackLink():
+    # Delivers messages straight to another in-process worker.
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.sent = 0
+
+    def send_message(self, msg):
+        self.sent += 1
+        self.cluster.message_received(json.loads(json.dumps(msg)))
+
+
+def build_cluster(worker_no):
+    clock = Clock()
+    workers = [ClusterFactory(i, worker_no, reactor=clock) for i in range(0, worker_no)]
+    for worker in workers:
+        for other in workers:
+            if other is not worker:
+                worker.links[other.worker_id] = LoopbackLink(other)
+
+    return clock, workers
+
+
+def connect(factory, ip, port=40000):
+    protocol = factory.buildProtocol(None)
+    transport = StringTransport(peerAddress=IPv4Address("TCP", ip, port))
+    protocol.makeConnection(transport)
+    return protocol, transport
+
+
+def sent_lines(transport):
+    lines = transport.value().decode("ascii").split("\r\n")[:-1]
+    transport.clear()
+    return lines
+
+
+def not_owner(workers, ip):
+    # A worker that doesn't own ip.
+    owner = shard_of(ip, len(workers))
+    return workers[(owner + 1) % len(workers)]
+
+
+class test_rendezvous_cluster(TestCase):
+    def setUp(self):
+        self.log = pyp2p.rendezvous_server.log
+        pyp2p.rendezvous_server.log = ServerLog(level=ERROR)
+
+    def tearDown(self):
+        pyp2p.rendezvous_server.log = self.log
+
+    def test_shard_of(self):
+        # Stable across processes and spread over the workers.
+        assert(shard_of("1.2.3.4", 4) == shard_of(u"1.2.3.4", 4))
+        shards = [shard_of("10.0.%d.%d" % (i // 256, i % 256), 4) for i in range(0, 1000)]
+        for shard in range(0, 4):
+            assert(shards.count(shard) > 150)
+
+    def test_registration(self):
+        clock, workers = build_cluster(3)
+
+        # Nodes register through whichever worker they land on.
+        ips = ["1.1.1.%d" % i for i in range(1, 31)]
+        for i in range(0, len(ips)):
+            node, transport = connect(workers[i % 3], ips[i])
+            node.lineReceived(b"PASSIVE READY 50500 10")
+            node.connectionLost(None)
+
+        # Only the owner has each node.
+        for ip in ips:
+            for worker in workers:
+                owned = worker.worker_id == shard_of(ip, 3)
+                assert((ip in worker.nodes["passive"]) == owned)
+        assert(sum([len(worker.nodes["passive"]) for worker in workers]) == 30)
+
+        # BOOTSTRAP samples every shard.
+        client, client_transport = connect(workers[0], "8.8.8.8")
+        client.lineReceived(b"BOOTSTRAP 100")
+        reply = sent_lines(client_transport)[0].split(" ")
+        nodes = sorted([node.split(":")[1] for node in reply[1:] if len(node)])
+        assert(nodes == sorted(ips))
+        client.lineReceived(b"BOOTSTRAP 10")
+        reply = sent_lines(client_transport)[0].split(" ")
+        assert(len(set([node for node in reply[1:] if len(node)])) == 10)
+
+        # Never return the node asking.
+        asker, asker_transport = connect(workers[2], ips[0])
+        asker.lineReceived(b"BOOTSTRAP 100")
+        reply = sent_lines(asker_transport)[0].split(" ")
+        assert(len([node for node in reply[1:] if len(node)]) == 29)
+        assert("p:%s:50500" % ips[0] not in reply)
+
+        # CLEAR reaches the owner.
+        node, transport = connect(not_owner(workers, ips[0]), ips[0])
+        node.lineReceived(b"CLEAR")
+        assert(not any([ips[0] in worker.nodes["passive"] for worker in workers]))
+
+        # Closed connections don't leave stand-ins behind.
+        for protocol in [client, asker, node]:
+            protocol.connectionLost(None)
+        for worker in workers:
+            assert(not len(worker.remote_cons))
+            assert(not len(worker.local_cons))
+
+    def test_bootstrap_timeout(self):
+        clock, workers = build_cluster(2)
+        node, transport = connect(workers[0], "1.1.1.1")
+        node.lineReceived(b"PASSIVE READY 50500 10")
+
+        # A worker that never answers only delays the reply.
+        workers[0].links[1] = LoopbackLink(ClusterFactory(1, 2, reactor=clock))
+        workers[0].links[1].send_message = lambda msg: None
+        client, client_transport = connect(workers[0], "8.8.8.8")
+        client.lineReceived(b"BOOTSTRAP 10")
+        assert(sent_lines(client_transport) == [])
+        clock.advance(workers[0].bootstrap_timeout)
+        reply = sent_lines(client_transport)
+        assert(len(reply) == 1 and reply[0].startswith("NODES"))
+        assert(not len(workers[0].requests))
+
+    def test_merge_samples(self):
+        clock, workers = build_cluster(1)
+
+        # Picks follow shard sizes.
+        counts = {"big": 0, "small": 0}
+        for i in range(0, 2000):
+            replies = [
+                (900, [("big", 1)]),
+                (100, [("small", 1)])
+            ]
+            counts[workers[0].merge_samples(replies, 1)[0][0]] += 1
+        assert(1650 < counts["big"] < 1950)
+
+        # Exhausted samples are skipped.
+        replies = [(1000, [("a", 1)]), (5, [("b", 1), ("c", 1)])]
+        assert(len(workers[0].merge_samples(replies, 10)) == 3)
+
+    def test_simultaneous(self):
+        clock, workers = build_cluster(3)
+        sim_ip = "2.2.2.2"
+        client_ip = "3.3.3.3"
+
+        # Node and client both connect to the worker that owns
+        # neither of them.
+        owners = [shard_of(sim_ip, 3), shard_of(client_ip, 3)]
+        assert(owners[0] != owners[1])
+        other = workers[3 - sum(owners)]
+        sim, sim_transport = connect(other, sim_ip)
+        sim.lineReceived(b"SIMULTANEOUS READY 0 0")
+        owner = workers[shard_of(sim_ip, 3)]
+        assert(sim_ip in owner.nodes["simultaneous"])
+        assert(sim_ip in owner.candidates)
+
+        client, client_transport = connect(other, client_ip)
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 5001")
+        assert(sent_lines(client_transport) == ["PREDICTION SET"])
+        assert(sent_lines(sim_transport) == ["CHALLENGE 3.3.3.3 5000 5001 TCP"])
+        assert(len(owner.candidates[sim_ip]) == 1)
+
+        # FIGHT is relayed back to the client's worker.
+        ntp = str(time.time())
+        sim.lineReceived(("ACCEPT 3.3.3.3 6000 6001 TCP " + ntp).encode("ascii"))
+        assert(sent_lines(client_transport) == ["FIGHT 2.2.2.2 6000 6001 TCP " + ntp])
+
+        # The owner sees the node go away.
+        sim.connectionLost(None)
+        assert(not owner.nodes["simultaneous"][sim_ip]["con"].connected)
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 5001")
+        assert(sent_lines(client_transport) == [])
+
+        # Candidates still expire on the owner's timers.
+        clock.advance(owner.challege_timeout)
+        assert(owner.candidates[sim_ip] == [])
+
+    def test_local_lines(self):
+        clock, workers = build_cluster(2)
+        ip = "4.4.4.4"
+        owner = workers[shard_of(ip, 2)]
+        protocol, transport = connect(owner, ip, 40001)
+
+        # Nothing crosses workers for the owner's own lines.
+        protocol.lineReceived(b"SOURCE TCP")
+        protocol.lineReceived(b"PASSIVE READY 50500 10")
+        assert(sent_lines(transport) == ["REMOTE TCP 40001"])
+        assert(ip in owner.nodes["passive"])
+        for link in owner.links.values():
+            assert(not link.sent)
+
+    def test_processes(self):
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+            return
+
+        # Free port.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        ipc_dir = tempfile.mkdtemp()
+        workers = start_workers(2, port, ipc_dir, "127.0.0.1")
+        try:
+            def send_line(line, source_ip="127.0.0.1"):
+                for i in range(0, 100):
+                    try:
+                        con = socket.create_connection(
+                            ("127.0.0.1", port), 5, (source_ip, 0)
+                        )
+                        break
+                    except socket.error:
+                        time.sleep(0.1)
+                con.sendall(line + b"\r\n")
+                return con
+
+            # Nodes land on both workers.
+            ips = ["127.0.0.%d" % i for i in range(2, 22)]
+            for ip in ips:
+                send_line(b"PASSIVE READY 50500 10", ip).close()
+
+            nodes = []
+            for i in range(0, 50):
+                con = send_line(b"BOOTSTRAP 100")
+                reply = con.makefile("rb").readline().decode("ascii").strip()
+                con.close()
+                nodes = [node.split(":")[1] for node in reply.split(" ")[1:]]
+                if len(nodes) == len(ips):
+                    break
+                time.sleep(0.1)
+            assert(sorted(nodes) == sorted(ips))
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+            shutil.rmtree(ipc_dir, ignore_errors=True)
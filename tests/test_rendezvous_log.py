@@ -0,0 +1,89 @@
+from unittest import TestCase
+from pyp2p.rendezvous_log import *
+from twisted.internet.address import IPv4Address
+import os
+import random
+import tempfile
+import time
+
+
+class test_rendezvous_log(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def read_lines(self):
+        with open(self.path) as log_file:
+            return log_file.read().splitlines()
+
+    def test_levels(self):
+        sink = BufferedSink(self.path)
+        log = ServerLog(level=INFO, sink=sink)
+        assert(not log.enabled(DEBUG))
+        assert(log.enabled(ERROR))
+        assert(not log.debug("hidden"))
+        assert(log.info("shown"))
+        assert(log.error("broken"))
+        log.close()
+
+        lines = self.read_lines()
+        assert(len(lines) == 2)
+        assert(lines[0].endswith("] INFO shown "))
+        assert(lines[1].endswith("] ERROR broken "))
+
+    def test_sampling(self):
+        log = ServerLog(
+            level=DEBUG, sink=BufferedSink(self.path),
+            sample_rate=0.1, rand=random.Random(1)
+        )
+        kept = 0
+        for i in range(0, 1000):
+            kept += log.debug("line")
+        assert(50 < kept < 150)
+        assert(kept + log.sampled_out == 1000)
+
+        # Warnings and errors are never sampled out.
+        for i in range(0, 100):
+            assert(log.warning("warning"))
+        log.close()
+        assert(len(self.read_lines()) == kept + 100)
+
+    def test_buffered_sink(self):
+        sink = BufferedSink(self.path, flush_interval=0.01)
+        log = ServerLog(level=DEBUG, sink=sink)
+        peer = IPv4Address("TCP", "1.2.3.4", 5000)
+        log.debug(b"BOOTSTRAP 10", peer, "recv")
+        log.debug("NODES EMPTY", peer, "send")
+
+        # Written by the sink's thread without a close.
+        for i in range(0, 500):
+            if sink.written == 2:
+                break
+            time.sleep(0.01)
+        lines = self.read_lines()
+        assert(lines[0].endswith("] DEBUG BOOTSTRAP 10 <- 1.2.3.4:5000"))
+        assert(lines[1].endswith("] DEBUG NODES EMPTY -> 1.2.3.4:5000"))
+        log.close()
+
+    def test_backlog_limit(self):
+        # A stopped writer can't block the caller -- entries past
+        # the backlog limit are dropped and counted.
+        sink = BufferedSink(self.path, max_backlog=10)
+        sink.running = 1
+        log = ServerLog(level=DEBUG, sink=sink)
+        for i in range(0, 15):
+            log.debug("line %d" % i)
+        assert(len(sink.backlog) == 10)
+        assert(sink.dropped == 5)
+
+        sink.running = 0
+        log.close()
+        assert(self.read_lines()[-1].endswith("line 9 "))
+
+    def test_format_entry(self):
+        peer = IPv4Address("TCP", "1.2.3.4", 5000)
+        entry = format_entry("12:00:00 2015-01-01", WARNING, "OPENED =", peer)
+        assert(entry == "[12:00:00 2015-01-01] WARNING OPENED = 1.2.3.4:5000")
@@ -1,7 +1,18 @@
 from unittest import TestCase
 from pyp2p.lib import *
 from pyp2p.sock import *
+import pyp2p.rendezvous_server
+from pyp2p.rendezvous_server import RendezvousFactory
+from pyp2p.rendezvous_log import *
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
 import random
+import time
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
 
 # if sys.version_info >= (3,0,0):
 
@@ -28,3 +39,189 @@ class test_rendezvous_client(TestCase):
 
         s.close()
 
+
+
+def connect(factory, ip, port=40000):
+    # Protocol instance talking to ip:port over a fake transport.
+    protocol = factory.buildProtocol(None)
+    transport = StringTransport(peerAddress=IPv4Address("TCP", ip, port))
+    protocol.makeConnection(transport)
+    return protocol, transport
+
+
+class ListSink():
+    # Keeps entries instead of writing them.
+    def __init__(self):
+        self.entries = []
+
+    def write(self, entry):
+        self.entries.append(entry)
+        return 1
+
+
+def sent_lines(transport):
+    lines = transport.value().decode("ascii").split("\r\n")[:-1]
+    transport.clear()
+    return lines
+
+
+class test_rendezvous_server(TestCase):
+    def setUp(self):
+        self.log = pyp2p.rendezvous_server.log
+        pyp2p.rendezvous_server.log = ServerLog(level=ERROR, sink=ListSink())
+
+    def tearDown(self):
+        pyp2p.rendezvous_server.log = self.log
+
+    def test_bootstrap(self):
+        factory = RendezvousFactory()
+        protocol, transport = connect(factory, "8.8.8.8")
+        protocol.lineReceived(b"BOOTSTRAP 10")
+        assert(sent_lines(transport) == ["NODES EMPTY"])
+
+        # Passive nodes register themselves.
+        for i in range(0, 50):
+            node, node_transport = connect(factory, "1.1.1.%d" % i)
+            node.lineReceived(b"PASSIVE READY 50500 10")
+        assert(len(factory.nodes["passive"]) == 50)
+
+        # Distinct random nodes, never the node asking.
+        asker, asker_transport = connect(factory, "1.1.1.0")
+        asker.lineReceived(b"BOOTSTRAP 10")
+        reply = sent_lines(asker_transport)[0].split(" ")
+        assert(reply[0] == "NODES")
+        nodes = [node for node in reply[1:] if len(node)]
+        assert(len(nodes) == 10)
+        assert(len(set(nodes)) == 10)
+        for node in nodes:
+            node_type, ip, port = node.split(":")
+            assert(node_type == "p")
+            assert(ip != "1.1.1.0")
+            assert(port == "50500")
+
+        # Cleared nodes are gone.
+        for i in range(1, 50):
+            node, node_transport = connect(factory, "1.1.1.%d" % i)
+            node.lineReceived(b"CLEAR")
+        asker.lineReceived(b"BOOTSTRAP 10")
+        assert(sent_lines(asker_transport) == ["NODES EMPTY"])
+
+    def test_expiry(self):
+        clock = Clock()
+        factory = RendezvousFactory(reactor=clock)
+        passive, passive_transport = connect(factory, "1.1.1.1")
+        passive.lineReceived(b"PASSIVE READY 50500 10")
+        sim, sim_transport = connect(factory, "2.2.2.2")
+        sim.lineReceived(b"SIMULTANEOUS READY 0 0")
+        client, client_transport = connect(factory, "3.3.3.3")
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 5001")
+        assert(sent_lines(client_transport) == ["PREDICTION SET"])
+        assert(len(factory.candidates["2.2.2.2"]) == 1)
+
+        # One timer for everything.
+        assert(len(clock.getDelayedCalls()) == 1)
+
+        # Candidates go when the challenge times out.
+        clock.advance(factory.challege_timeout - 1)
+        assert(len(factory.candidates["2.2.2.2"]) == 1)
+        clock.advance(1)
+        assert(factory.candidates["2.2.2.2"] == [])
+
+        # Relisting restarts a node's life time.
+        clock.advance(factory.node_lifetime - factory.challege_timeout - 10)
+        passive.lineReceived(b"PASSIVE READY 50500 10")
+        clock.advance(10)
+        assert("1.1.1.1" in factory.nodes["passive"])
+        assert("2.2.2.2" not in factory.nodes["simultaneous"])
+        assert("2.2.2.2" not in factory.candidates)
+        clock.advance(factory.node_lifetime - 10)
+        assert("1.1.1.1" not in factory.nodes["passive"])
+        assert(not len(clock.getDelayedCalls()))
+
+        # Cleared nodes don't leave timers behind.
+        passive.lineReceived(b"PASSIVE READY 50500 10")
+        passive.lineReceived(b"CLEAR")
+        assert(not len(factory.nodes["passive"]))
+        assert(factory.expiry.time_until_next() is None)
+
+    def test_expiry_heap_bounded(self):
+        clock = Clock()
+        factory = RendezvousFactory(reactor=clock)
+
+        # One node registered earlier keeps its entry on top.
+        first, first_transport = connect(factory, "1.1.1.1")
+        first.lineReceived(b"PASSIVE READY 50500 10")
+
+        # Nodes re-advertise every 10 minutes.
+        nodes = [connect(factory, "2.2.%d.%d" % (i // 256, i % 256))[0] for i in range(0, 100)]
+        for i in range(0, 60):
+            clock.advance(600)
+            for node in nodes:
+                node.lineReceived(b"PASSIVE READY 50500 10")
+            assert(len(factory.expiry.timers) <= 2 * len(factory.expiry) + 64)
+        assert(len(factory.expiry.timers) == 101)
+
+        # Re-registered nodes live on, the first one expires.
+        clock.advance(factory.node_lifetime - 60 * 600)
+        assert("1.1.1.1" not in factory.nodes["passive"])
+        assert(len(factory.nodes["passive"]) == 100)
+
+    def test_dispatch(self):
+        factory = RendezvousFactory()
+        sim, sim_transport = connect(factory, "2.2.2.2")
+        client, client_transport = connect(factory, "3.3.3.3", 40001)
+
+        # Unknown commands and invalid lines are ignored.
+        for line in [b"", b"HELLO", b"BOOTSTRAPX 1", b"BOOTSTRAP", b"bootstrap 1",
+                     b"PASSIVE READY x 10", b"SIMULTANEOUS NOT READY 0 0",
+                     b"SOURCE UDP", b"CANDIDATE 2.2.2.2 TCP ", b"\xff"]:
+            client.lineReceived(line)
+        assert(sent_lines(client_transport) == [])
+        assert(not len(factory.nodes["passive"]))
+
+        # One reply per command.
+        client.lineReceived(b"SOURCE TCP")
+        assert(sent_lines(client_transport) == ["REMOTE TCP 40001"])
+        sim.lineReceived(b"SIMULTANEOUS READY 0 0")
+        assert("2.2.2.2" in factory.nodes["simultaneous"])
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 5001")
+        assert(sent_lines(client_transport) == ["PREDICTION SET"])
+        assert(sent_lines(sim_transport) == ["CHALLENGE 3.3.3.3 5000 5001 TCP"])
+        ntp = str(time.time())
+        sim.lineReceived(("ACCEPT 3.3.3.3 6000 6001 TCP " + ntp).encode("ascii"))
+        assert(sent_lines(client_transport) == ["FIGHT 2.2.2.2 6000 6001 TCP " + ntp])
+
+        # Ports are range checked.
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP 5000 70000")
+        assert(sent_lines(client_transport) == [])
+
+        # Malformed predictions fail fast (no backtracking blow up.)
+        start = time.time()
+        client.lineReceived(b"CANDIDATE 2.2.2.2 TCP " + b"1 " * 5000 + b"x")
+        sim.lineReceived(b"ACCEPT 3.3.3.3 " + b"1 " * 5000 + b"x")
+        assert(time.time() - start < 1)
+        assert(sent_lines(client_transport) == [])
+
+    def test_logging(self):
+        sink = ListSink()
+        pyp2p.rendezvous_server.log = ServerLog(level=DEBUG, sink=sink)
+        factory = RendezvousFactory()
+        client, client_transport = connect(factory, "3.3.3.3")
+        client.lineReceived(b"SOURCE TCP")
+        client.connectionLost(None)
+        logged = [(level, msg, direction) for t, level, msg, peer, direction in sink.entries]
+        assert(logged == [
+            (DEBUG, "OPENED =", "none"),
+            (DEBUG, "SOURCE TCP", "recv"),
+            (DEBUG, b"REMOTE TCP 40000", "send"),
+            (DEBUG, "CLOSED =", "none")
+        ])
+        for entry in sink.entries:
+            assert(entry[3].host == "3.3.3.3")
+
+        # Nothing below the level is queued.
+        sink.entries = []
+        pyp2p.rendezvous_server.log.level = INFO
+        client, client_transport = connect(factory, "3.3.3.3")
+        client.lineReceived(b"SOURCE TCP")
+        assert(sink.entries == [])
@@ -0,0 +1,87 @@
+from unittest import TestCase
+from pyp2p.scheduler import Scheduler
+
+
+class test_scheduler(TestCase):
+    def test_scheduler(self):
+        now = [100.0]
+        scheduler = Scheduler(clock=lambda: now[0])
+        ran = []
+
+        # Nothing scheduled.
+        assert(scheduler.time_until_next() is None)
+        assert(scheduler.is_due("bootstrap"))
+
+        # Deadlines without callbacks.
+        scheduler.schedule("bootstrap", 30)
+        assert(not scheduler.is_due("bootstrap"))
+        assert(scheduler.time_until_next() == 30)
+
+        # Callbacks, periodic and one shot.
+        scheduler.schedule("dht", 5, lambda: ran.append("dht"), 5)
+        scheduler.schedule("once", 10, lambda: ran.append("once"))
+        assert(scheduler.time_until_next() == 5)
+        now[0] += 10
+        assert(scheduler.run_due() == 2)
+        assert(ran == ["dht", "once"])
+        assert("once" not in scheduler)
+        assert(scheduler.deadline("dht") == 115)
+
+        # Rescheduling replaces the old deadline.
+        scheduler.schedule("dht", 1, lambda: ran.append("dht 2"))
+        now[0] += 1
+        scheduler.run_due()
+        assert(ran == ["dht", "once", "dht 2"])
+
+        # Passed deadlines without callbacks don't cause wakeups.
+        now[0] += 30
+        assert(scheduler.is_due("bootstrap"))
+        assert(scheduler.time_until_next() is None)
+
+        # Cancelled tasks never run.
+        scheduler.schedule("cancel", 1, lambda: ran.append("cancel"))
+        scheduler.cancel("cancel")
+        now[0] += 1
+        assert(not scheduler.run_due())
+
+    def test_jitter(self):
+        scheduler = Scheduler(clock=lambda: 0)
+        deadlines = set()
+        for i in range(0, 20):
+            deadline = scheduler.schedule("bootstrap", 100, jitter=0.1)
+            assert(90 <= deadline <= 110)
+            deadlines.add(deadline)
+        assert(len(deadlines) > 1)
+
+    def test_one_entry_per_task(self):
+        now = [0.0]
+        scheduler = Scheduler(clock=lambda: now[0])
+        ran = []
+        scheduler.schedule("first", 50, lambda: ran.append("first"))
+
+        # Pushing a deadline back reuses the task's heap entry.
+        for i in range(0, 100):
+            scheduler.schedule("node", 10 + i, lambda: ran.append("node"))
+        assert(len(scheduler.timers) == 2)
+
+        # The entry is moved on the way up, not run early.
+        now[0] = 50
+        assert(scheduler.run_due() == 1)
+        assert(ran == ["first"])
+        assert(scheduler.time_until_next() == 59)
+        now[0] = 109
+        assert(scheduler.run_due() == 1)
+        assert(ran == ["first", "node"])
+
+        # Bringing a deadline forward still fires on time.
+        scheduler.schedule("node", 100, lambda: ran.append("late"))
+        scheduler.schedule("node", 1, lambda: ran.append("early"))
+        now[0] += 1
+        assert(scheduler.run_due() == 1)
+        assert(ran[-1] == "early")
+
+        # Stale entries from cancels don't pile up.
+        for i in range(0, 1000):
+            scheduler.schedule("cancel %d" % i, 5)
+            scheduler.cancel("cancel %d" % i)
+        assert(len(scheduler.timers) <= 2 * len(scheduler) + 65)
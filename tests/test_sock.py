@@ -21,6 +21,16 @@ else:
     from urlparse import urlparse
 
 
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, addr = listener.accept()
+    listener.close()
+    return a, b
+
+
 class test_sock(TestCase):
     def test_http_upload_post(self):
         class SockUpload():
@@ -332,3 +342,224 @@ class test_sock(TestCase):
         s.update()
         assert (s.pop_reply(), "reply 1")
         assert (s.replies[0], "reply 2")
+
+    def test_parse_buf_incremental(self):
+        s = Sock()
+
+        # Delimiter split across chunks (appended like update() does.)
+        s._buf += u"abc\r"
+        assert(s.parse_buf() == [])
+        assert(s.buf_scanned == 4)
+        s._buf += u"\ndef"
+        assert(s.parse_buf() == [u"abc"])
+        assert(s.buf == u"def")
+
+        # Long partial line is only scanned once.
+        for i in range(0, 100):
+            s._buf += u"x"
+            assert(s.parse_buf() == [])
+            assert(s.buf_scanned == len(s.buf))
+        s._buf += u"\r\n\r\ny\r\n"
+        x = s.parse_buf()
+        assert(x == [u"def" + u"x" * 100, u"y"])
+        assert(s.buf == u"")
+
+        # Appending through the property keeps the scan offset.
+        s.buf += u"abc"
+        s.parse_buf()
+        s.buf += u"d"
+        assert(s.buf_scanned == 3)
+
+        # Replacing the buffer resets the scan.
+        s.buf = u"zzzz"
+        s.parse_buf()
+        s.buf = u"a\r\nb"
+        assert(s.buf_scanned == 0)
+        assert(s.parse_buf() == [u"a"])
+        s.close()
+
+    def test_binary_mode(self):
+        a, b = tcp_pair()
+        s = Sock(binary=1)
+        s.set_sock(a)
+
+        # Lines are decoded once complete.
+        b.sendall(b"abc\r")
+        time.sleep(0.1)
+        assert(s.recv_line() == u"")
+        b.sendall(b"\n\r\n\xe2\x82\xac\r\nraw")
+        time.sleep(0.1)
+        s.update()
+        assert(s.replies == [u"abc", u"€"])
+
+        # Raw recv uses the remaining buffer then the socket.
+        b.sendall(b"data")
+        time.sleep(0.1)
+        ret = s.recv(7, encoding="ascii")
+        assert(type(ret) == memoryview)
+        assert(ret == b"rawdata")
+
+        # The receive buffer is reused.
+        b.sendall(b"ab")
+        time.sleep(0.1)
+        ret = s.recv(2, encoding="ascii")
+        assert(ret == b"ab")
+        assert(len(s.recv_view) == 7)
+
+        # Unicode recv still returns text.
+        b.sendall(b"xyz")
+        time.sleep(0.1)
+        assert(s.recv(3) == u"xyz")
+
+        s.close()
+        b.close()
+
+    def test_recv_latin_1(self):
+        a, b = tcp_pair()
+        s = Sock()
+        s.set_sock(a)
+        b.sendall(b"\x00\xff\x80")
+        time.sleep(0.1)
+        assert(s.recv(3, encoding="ascii") == b"\x00\xff\x80")
+        s.close()
+        b.close()
+
+    def test_send_queue(self):
+        a, b = tcp_pair()
+        a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        s = Sock(blocking=0)
+        s.set_sock(a)
+
+        # Long sends used to resend the first chunk.
+        line = u"x" * (s.chunk_size * 3)
+        assert(s.send_line(line))
+        data = b""
+        b.settimeout(0.01)
+        future = time.time() + 5
+        while len(data) < len(line) + 2 and time.time() < future:
+            s.flush()
+            try:
+                data += b.recv(len(line) + 2 - len(data))
+            except socket.timeout:
+                pass
+        b.settimeout(None)
+        assert(data == line.encode("ascii") + b"\r\n")
+
+        # Fill the queue past the high water mark.
+        events = []
+        s.set_send_watermarks(8 * 1024, 2 * 1024)
+        s.backpressure_handler = lambda con, paused: events.append(paused)
+        queued = []
+        s.add_send_queue_handler(lambda con: queued.append(con))
+        msg = b"y" * 1024
+        sent = 0
+        while not s.send_paused:
+            assert(s.queue_send(msg))
+            sent += len(msg)
+        assert(events == [1])
+        assert(queued == [s])
+
+        # The queue is bounded.
+        s.max_send_buf = s.send_queue_size
+        assert(not s.queue_send(msg))
+        assert(not s.send_line(u"z", timeout=0.1))
+
+        # Lines still queued after flushing count as sent.
+        s.max_send_buf = 64 * 1024 * 1024
+        while s.flush() or s.send_queue_size < 1024 * 1024:
+            assert(s.queue_send(msg))
+            sent += len(msg)
+        assert(s.send_line(u"z", timeout=0.1) == 3)
+        assert(s.send_queue[-1] == b"z\r\n")
+        sent += 3
+
+        # Draining the peer lets flush() empty the queue.
+        b.setblocking(0)
+        got = 0
+        future = time.time() + 5
+        while got < sent and time.time() < future:
+            s.flush()
+            try:
+                got += len(b.recv(65536))
+            except socket.error:
+                time.sleep(0.01)
+        assert(got == sent)
+        assert(s.send_queue_size == 0)
+        assert(events == [1, 0])
+        s.close()
+        b.close()
+
+    def test_send_line_nonblocking(self):
+        a, b = tcp_pair()
+        s = Sock(blocking=0)
+        s.set_sock(a)
+        s.max_send_buf = 64 * 1024 * 1024
+
+        # Fill the kernel buffers until nothing more is accepted.
+        msg = b"y" * 65536
+        while not len(s.send_queue):
+            assert(s.queue_send(msg))
+        s.send_queue.clear()
+        s.send_queue_offset = 0
+        s.send_queue_size = 0
+
+        # The line is queued without waiting on the peer.
+        start = time.time()
+        assert(s.send_line(u"hello", timeout=1) == 7)
+        assert(time.time() - start < 0.5)
+        assert(list(s.send_queue) == [b"hello\r\n"])
+
+        # A full queue drops the line (also without waiting.)
+        s.max_send_buf = s.send_queue_size
+        start = time.time()
+        assert(s.send_line(u"dropped", timeout=1) == 0)
+        assert(time.time() - start < 0.5)
+        assert(list(s.send_queue) == [b"hello\r\n"])
+        s.close()
+        b.close()
+
+    def test_connect_many(self):
+        # Live listeners.
+        live = []
+        for i in range(0, 2):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(5)
+            live.append(listener)
+
+        # Dead listener: connects hang once its backlog is full.
+        dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dead.bind(("127.0.0.1", 0))
+        dead.listen(0)
+        fill = []
+        for i in range(0, 5):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(0)
+            s.connect_ex(dead.getsockname())
+            fill.append(s)
+        time.sleep(0.1)
+
+        # Refused: nothing listening.
+        refused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        refused.bind(("127.0.0.1", 0))
+        refused_addr = refused.getsockname()
+        refused.close()
+
+        addrs = [dead.getsockname(), refused_addr]
+        addrs += [listener.getsockname() for listener in live]
+        start = time.time()
+        connected = connect_many(addrs, want=2, timeout=3)
+        assert(time.time() - start < 1)
+        assert(len(connected) == 2)
+        ports = sorted([port for addr, port, s in connected])
+        assert(ports == sorted([l.getsockname()[1] for l in live]))
+
+        # Everything fails within the deadline.
+        start = time.time()
+        assert(connect_many([dead.getsockname()], timeout=0.5) == [])
+        assert(time.time() - start < 1.5)
+
+        for addr, port, s in connected:
+            s.close()
+        for s in live + fill + [dead]:
+            s.close()
@@ -151,6 +151,18 @@ class test_unl(TestCase):
         for direct in [alice_direct, bob_direct]:
             direct.stop()
 
+    def test_nat_type_codes(self):
+        net = Net(passive_port=0, wan_ip="8.8.4.4", node_type="active")
+        unl = UNL(net, wan_ip="8.8.4.4")
+
+        # Only NAT codes older peers understand go out.
+        for nat_type in ["random", "preserving", "reuse"]:
+            value = unl.construct({"nat_type": nat_type})
+            assert(unl.deconstruct(value)["nat_type"] == nat_type)
+        for nat_type in ["delta", "unknown"]:
+            value = unl.construct({"nat_type": nat_type})
+            assert(unl.deconstruct(value)["nat_type"] == "random")
+
     def test_00001(self):
         """
 force_master: 0, 1
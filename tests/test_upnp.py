@@ -1,6 +1,67 @@
 from unittest import TestCase
 from pyp2p.upnp import *
 from pyp2p.lib import *
+import pyp2p.upnp
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+igd_desc = """<?xml version="1.0"?>
+<root><device><deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>
+<serviceList><service>
+<serviceType>urn:schemas-upnp-org:service:Layer3Forwarding:1</serviceType>
+<controlURL>/ctl/L3F</controlURL>
+</service><service>
+<serviceType>urn:schemas-upnp-org:service:WANIPConnection:1</serviceType>
+<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+<controlURL>/ctl/IPConn</controlURL>
+</service></serviceList></device></root>"""
+
+
+class GatewayServer():
+    # Fake IGD: serves its description and accepts SOAP requests.
+    def __init__(self):
+        requests = self.requests = []
+        gateway = self
+        self.permanent_only = 0
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(("GET", self.path, None))
+                self.reply(igd_desc)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                body = body.decode("utf-8")
+                requests.append(("POST", self.path, self.headers["SOAPAction"]))
+                if gateway.permanent_only:
+                    if "<NewLeaseDuration>0<" not in body and "AddPortMapping" in body:
+                        fault = "<s:Fault><detail><UPnPError><errorCode>725</errorCode></UPnPError></detail></s:Fault>"
+                        return self.reply(fault, 500)
+                self.reply("<ok/>")
+
+            def reply(self, body, code=200):
+                body = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        self.addr = "http://127.0.0.1:%d/rootDesc.xml" % self.port
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 
 class test_upnp(TestCase):
@@ -10,3 +71,83 @@ class test_upnp(TestCase):
         except Exception as e:
             assert ("Unable to find UPnP compatible gateway" in str(
                 e) or "Failed to add port" in str(e))
+
+    def test_control_url_cache(self):
+        gateway = GatewayServer()
+        control = parse_control_url(gateway.addr, igd_desc)
+        assert(control["control_url"] == "http://127.0.0.1:%d/ctl/IPConn" % gateway.port)
+        assert("WANIPConnection" in control["service_type"])
+
+        # Description is only fetched once per gateway.
+        upnp = UPnP()
+        upnp.gateway_addr = gateway.addr
+        upnp.forward_port("TCP", 50500, "192.168.0.2")
+        upnp = UPnP()
+        upnp.gateway_addr = gateway.addr
+        upnp.forward_port("TCP", 50501, "192.168.0.2")
+        methods = [request[0] for request in gateway.requests]
+        assert(methods == ["GET", "POST", "POST"])
+        assert(gateway.requests[1][1] == "/ctl/IPConn")
+        assert("AddPortMapping" in gateway.requests[1][2])
+
+        # Expired entries are fetched again.
+        pyp2p.upnp.control_urls[gateway.addr]["expires"] = 0
+        upnp.forward_port("TCP", 50502, "192.168.0.2")
+        assert(gateway.requests[-2][0] == "GET")
+        forget_gateway(gateway.addr)
+        gateway.close()
+
+    def test_forward_ports(self):
+        gateway = GatewayServer()
+        upnp = UPnP()
+        upnp.gateway_addr = gateway.addr
+        mappings = [("TCP", 50500, None), ("UDP", 50500, 50501)]
+
+        # One lookup for the whole batch.
+        assert(upnp.forward_ports(mappings, "192.168.0.2", 3600) == [3600, 3600])
+        methods = [request[0] for request in gateway.requests]
+        assert(methods == ["GET", "POST", "POST"])
+
+        # Falls back to permanent leases on a SOAP fault.
+        gateway.permanent_only = 1
+        assert(upnp.forward_ports(mappings[:1], "192.168.0.2", 3600) == [0])
+
+        # Other errors aren't retried.
+        gateway.close()
+        try:
+            upnp.add_port_mapping(
+                pyp2p.upnp.control_urls[gateway.addr], "TCP", 50500,
+                "192.168.0.2", 50500, 3600
+            )
+            assert(0)
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+
+        # Removing.
+        gateway = GatewayServer()
+        upnp.gateway_addr = gateway.addr
+        assert(upnp.remove_ports(mappings) == 2)
+        assert("DeletePortMapping" in gateway.requests[-1][2])
+        forget_gateway(gateway.addr)
+        gateway.close()
+
+    def test_scan_gateway(self):
+        gateway = GatewayServer()
+        dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dead.bind(("127.0.0.1", 0))
+        dead_port = dead.getsockname()[1]
+        dead.close()
+
+        # Returns on the first hit instead of waiting out the timeout.
+        start = time.time()
+        upnp = UPnP()
+        ports = [dead_port, gateway.port]
+        gateway_addr = upnp.scan_gateway("127.0.0.1", ports, timeout=5)
+        assert(gateway_addr == "http://127.0.0.1:%d/" % gateway.port)
+        assert(time.time() - start < 2)
+
+        # Nothing found.
+        assert(upnp.scan_gateway("127.0.0.1", [dead_port], timeout=1) is None)
+        gateway.close()